@@ -0,0 +1,316 @@
+"""
+REST API benchmark
+
+Seeds a dataset of N users, M orders per user and K items per order with
+the bulk insert path, serves the Flask app in-process and drives every
+route of service/routes.py at a fixed request rate. For each endpoint it
+reports p50/p95/p99 latency, achieved requests/sec and the number of SQL
+statements per request as a JSON report that can be compared between
+commits with benchmarks/compare.py.
+
+Runs against the database of DATABASE_URI, PostgreSQL or SQLite:
+	DATABASE_URI=sqlite:////tmp/bench.db python benchmarks/api_benchmark.py --reset -o report.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from service import app  # noqa: E402  pylint: disable=wrong-import-position
+from service.common.cache import order_cache  # noqa: E402  pylint: disable=wrong-import-position
+from service.common.log_handlers import REQUEST_ID_HEADER  # noqa: E402  pylint: disable=wrong-import-position
+from service.common.metrics import when_complete  # noqa: E402  pylint: disable=wrong-import-position
+from service.models import db, Order, Items  # noqa: E402  pylint: disable=wrong-import-position
+
+
+######################################################################
+# Dataset
+######################################################################
+
+
+class Dataset:
+	"""The seeded orders the scenarios pick their targets from"""
+
+	def __init__(self, users, orders_per_user, items_per_order):
+		self.users = users
+		self.orders_per_user = orders_per_user
+		self.items_per_order = items_per_order
+		self.user_ids = list(range(1, users + 1))
+		self.order_ids = []
+
+	def seed(self, batch_size=1000):
+		"""Inserts the orders and their items through Order.create_bulk"""
+		create_time = int(time.time())
+		pending = []
+		for user_id in self.user_ids:
+			for _ in range(self.orders_per_user):
+				pending.append({
+					"user_id": user_id,
+					"create_time": create_time,
+					"status": random.choice((1, 2, 3)),
+					"items": list(range(1, self.items_per_order + 1)),
+				})
+				if len(pending) == batch_size:
+					self.order_ids += [order.id for order, _ in Order.create_bulk(pending)]
+					pending = []
+		if pending:
+			self.order_ids += [order.id for order, _ in Order.create_bulk(pending)]
+		db.session.remove()
+
+
+def reset_tables():
+	"""Removes every order and item"""
+	db.session.query(Items).delete()
+	db.session.query(Order).delete()
+	db.session.commit()
+	order_cache.clear()
+
+
+######################################################################
+# Scenarios
+######################################################################
+
+
+class Scenario:
+	"""One endpoint and how to build each request to it"""
+
+	def __init__(self, name, method, build):
+		self.name = name
+		self.method = method
+		self.build = build  # (target order id,) -> (path, json body or None)
+
+
+def order_payload(data):
+	"""A valid order body for the dataset"""
+	return {"user_id": random.choice(data.user_ids), "create_time": int(time.time()), "status": 1, "items": [1, 2, 3]}
+
+
+def scenarios(data):
+	"""Every route of the service, destructive ones last"""
+	pick = lambda: random.choice(data.order_ids)  # noqa: E731
+	user = lambda: random.choice(data.user_ids)  # noqa: E731
+	item = lambda: random.randint(1, max(data.items_per_order, 1))  # noqa: E731
+	return [
+		Scenario("GET /health", "GET", lambda n: ("/health", None)),
+		Scenario("GET /health/pool", "GET", lambda n: ("/health/pool", None)),
+		Scenario("GET /health/cache", "GET", lambda n: ("/health/cache", None)),
+		Scenario("GET /", "GET", lambda n: ("/", None)),
+		Scenario("GET /orders?user_id", "GET", lambda n: (f"/orders?user_id={user()}", None)),
+		Scenario("GET /orders?user_id&expand=items", "GET", lambda n: (f"/orders?user_id={user()}&expand=items", None)),
+		Scenario("GET /orders?user_id&status", "GET", lambda n: (f"/orders?user_id={user()}&status=1", None)),
+		Scenario("GET /orders?user_id&item_id", "GET", lambda n: (f"/orders?user_id={user()}&item_id={item()}", None)),
+		Scenario("GET /orders/all", "GET", lambda n: ("/orders/all?limit=100", None)),
+		Scenario("GET /orders/export", "GET", lambda n: ("/orders/export", None)),
+		Scenario("GET /orders/stats", "GET", lambda n: ("/orders/stats", None)),
+		Scenario("GET /orders/<id>", "GET", lambda n: (f"/orders/{pick()}", None)),
+		Scenario("GET /orders/<id>/items", "GET", lambda n: (f"/orders/{pick()}/items", None)),
+		Scenario("GET /orders/<id>/items/<item_id>", "GET", lambda n: (f"/orders/{pick()}/items/{item()}", None)),
+		Scenario("POST /orders", "POST", lambda n: ("/orders", order_payload(data))),
+		Scenario("POST /orders/bulk", "POST", lambda n: ("/orders/bulk", [order_payload(data) for _ in range(10)])),
+		Scenario("PUT /orders/<id>", "PUT", lambda n: (f"/orders/{pick()}", dict(order_payload(data), status=2))),
+		Scenario("POST /orders/<id>/items", "POST",
+				lambda n: (f"/orders/{n[0]}/items", {"order_id": n[0], "item_id": item()})),
+		Scenario("PUT /orders/<id>/items", "PUT",
+				lambda n: (f"/orders/{n[0]}/items", [item() for _ in range(data.items_per_order)])),
+		Scenario("PUT /orders/<id>/items/<item_id>", "PUT",
+				lambda n: (f"/orders/{n[0]}/items/{item()}", {"order_id": n[0], "item_id": item()})),
+		Scenario("POST /orders/<id>/cancel", "POST", lambda n: (f"/orders/{pick()}/cancel", None)),
+		Scenario("POST /orders/cancel", "POST", lambda n: ("/orders/cancel", {"user_id": user()})),
+		Scenario("POST /orders/status", "POST", lambda n: ("/orders/status", {"new_status": 2, "user_id": user()})),
+		Scenario("DELETE /orders/<id>/items/<item_id>", "DELETE", lambda n: (f"/orders/{n[0]}/items/{item()}", None)),
+		Scenario("DELETE /orders/<id>", "DELETE", lambda n: (f"/orders/{n[0]}", None)),
+	]
+
+
+######################################################################
+# Load generation
+######################################################################
+
+
+class StatementCounts:
+	"""The SQL statements counted by service.common.metrics for each request id
+
+	A header cannot carry the count, since a streamed body like GET
+	/orders/export runs its queries after the headers are sent, so each
+	count is recorded when the response closes and read by the client.
+	"""
+
+	def __init__(self):
+		self._counts = {}
+		self._closed = threading.Condition()
+
+	def install(self):
+		"""Records the count of every request sending an X-Request-ID"""
+
+		@app.after_request
+		def count_on_close(response):
+			request_id = request.headers.get(REQUEST_ID_HEADER)
+			if request_id is not None:
+				when_complete(response, lambda counters: self._record(request_id, counters.get("sql_statements", 0)))
+			return response
+
+	def _record(self, request_id, count):
+		with self._closed:
+			self._counts[request_id] = count
+			self._closed.notify_all()
+
+	def pop(self, request_id, timeout=5.0):
+		"""Waits for the response of request_id to close and returns its count"""
+		with self._closed:
+			self._closed.wait_for(lambda: request_id in self._counts, timeout)
+			return self._counts.pop(request_id, 0)
+
+
+statement_counts = StatementCounts()
+request_ids = itertools.count()
+
+
+def send(base_url, method, path, body):
+	"""Sends one request and returns (latency seconds, status, statement count)"""
+	data = None if body is None else json.dumps(body).encode()
+	request_id = f"bench-{next(request_ids)}"
+	http_request = urllib.request.Request(base_url + path, data=data, method=method)
+	http_request.add_header(REQUEST_ID_HEADER, request_id)
+	if data is not None:
+		http_request.add_header("Content-Type", "application/json")
+	start = time.perf_counter()
+	try:
+		with urllib.request.urlopen(http_request) as response:
+			response.read()
+			code = response.status
+	except urllib.error.HTTPError as error:
+		code = error.code
+	latency = time.perf_counter() - start
+	return latency, code, statement_counts.pop(request_id)
+
+
+def percentile(values, fraction):
+	"""Nearest-rank percentile of sorted values"""
+	if not values:
+		return 0.0
+	index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+	return values[index]
+
+
+def run_scenario(base_url, scenario, rate, duration, concurrency, targets):
+	"""Sends requests at a fixed rate for duration seconds and summarizes them"""
+	total = max(1, int(rate * duration))
+	results = []
+	lock = threading.Lock()
+
+	def fire(counter):
+		path, body = scenario.build(counter)
+		outcome = send(base_url, scenario.method, path, body)
+		with lock:
+			results.append(outcome)
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as pool:
+		for index in range(total):
+			delay = start + index / rate - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+			pool.submit(fire, (next(targets),))
+	elapsed = time.perf_counter() - start
+
+	latencies = sorted(latency for latency, _, _ in results)
+	statements = [count for _, _, count in results]
+	errors = sum(1 for _, code, _ in results if code >= 500)
+	return {
+		"requests": len(results),
+		"errors": errors,
+		"status_codes": dict(Counter(str(code) for _, code, _ in results)),
+		"rps": round(len(results) / elapsed, 2),
+		"p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+		"p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+		"p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+		"sql_statements_mean": round(sum(statements) / len(statements), 2),
+		"sql_statements_max": max(statements),
+	}
+
+
+def git_commit():
+	"""The commit being benchmarked, if known"""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	"""Seeds the dataset, runs every scenario and writes the JSON report"""
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--users", type=int, default=100, help="N users")
+	parser.add_argument("--orders", type=int, default=10, help="M orders per user")
+	parser.add_argument("--items", type=int, default=5, help="K items per order")
+	parser.add_argument("--rate", type=float, default=50.0, help="requests/sec sent to each endpoint")
+	parser.add_argument("--duration", type=float, default=5.0, help="seconds per endpoint")
+	parser.add_argument("--concurrency", type=int, default=16, help="maximum requests in flight")
+	parser.add_argument("--only", action="append", help="run only the scenarios with this name (repeatable)")
+	parser.add_argument("--reset", action="store_true", help="delete every order before seeding")
+	parser.add_argument("--seed", type=int, default=0, help="random seed of the request mix")
+	parser.add_argument("-o", "--output", help="report file, standard output when omitted")
+	args = parser.parse_args()
+	random.seed(args.seed)
+
+	app.logger.setLevel("WARNING")
+	logging.getLogger("werkzeug").setLevel("WARNING")
+	app.app_context().push()
+	Order.create_schema()
+	if args.reset:
+		reset_tables()
+	data = Dataset(args.users, args.orders, args.items)
+	seed_start = time.perf_counter()
+	data.seed()
+	seed_seconds = time.perf_counter() - seed_start
+
+	statement_counts.install()
+	server = make_server("127.0.0.1", 0, app, threaded=True)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	base_url = f"http://127.0.0.1:{server.server_port}"
+
+	report = {
+		"commit": git_commit(),
+		"database": db.engine.dialect.name,
+		"dataset": {"users": args.users, "orders_per_user": args.orders, "items_per_order": args.items},
+		"seed_seconds": round(seed_seconds, 3),
+		"load": {"rate": args.rate, "duration": args.duration, "concurrency": args.concurrency},
+		"endpoints": {},
+	}
+	for scenario in scenarios(data):
+		if args.only and scenario.name not in args.only:
+			continue
+		# destructive scenarios walk through distinct orders
+		targets = itertools.cycle(data.order_ids)
+		report["endpoints"][scenario.name] = run_scenario(
+			base_url, scenario, args.rate, args.duration, args.concurrency, targets)
+		print(f"{scenario.name}: {report['endpoints'][scenario.name]}", file=sys.stderr)
+	server.shutdown()
+	export = report["endpoints"].get("GET /orders/export")
+	if export is not None and export["requests"] and export["sql_statements_max"] < 1:
+		sys.exit("GET /orders/export reported no SQL statements, the streamed body was not counted")
+
+	output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+	with output:
+		json.dump(report, output, indent=2, sort_keys=True)
+		output.write("\n")
+
+
+if __name__ == "__main__":
+	main()
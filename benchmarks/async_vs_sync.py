@@ -0,0 +1,108 @@
+"""
+Async vs sync serving benchmark
+
+Starts the service once per SERVER_MODE with gunicorn, pinned to the same
+CPUs with taskset when it is available, and measures requests per second
+of the async read paths at a fixed concurrency. The order cache is
+disabled so every request reaches the database.
+
+Usage:
+	DATABASE_URI=postgresql://... python benchmarks/async_vs_sync.py --cpus 0 --workers 1
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(mode, port, cpus, workers):
+	"""Starts gunicorn in the given SERVER_MODE and waits until it answers"""
+	env = dict(os.environ, SERVER_MODE=mode, CACHE_BACKEND="none")
+	command = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--log-level=warning"]
+	if cpus and shutil.which("taskset"):
+		command = ["taskset", "-c", cpus] + command
+	process = subprocess.Popen(command, cwd=ROOT, env=env)
+	for _ in range(100):
+		try:
+			urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+			return process
+		except (urllib.error.URLError, ConnectionError):
+			time.sleep(0.1)
+	process.terminate()
+	raise RuntimeError(f"{mode} server did not start")
+
+
+def seed_order(base_url, items):
+	"""Creates the order every request reads and returns its id"""
+	body = json.dumps({"user_id": 1, "create_time": int(time.time()), "status": 1, "items": list(range(items))})
+	request = urllib.request.Request(
+		f"{base_url}/orders", data=body.encode(), headers={"Content-Type": "application/json"})
+	with urllib.request.urlopen(request) as response:
+		return json.loads(response.read())["id"]
+
+
+def measure(url, concurrency, duration):
+	"""Returns the requests per second and error count of GETs on url"""
+	counts = [0] * concurrency
+	errors = [0] * concurrency
+	deadline = time.perf_counter() + duration
+
+	def worker(index):
+		while time.perf_counter() < deadline:
+			try:
+				with urllib.request.urlopen(url) as response:
+					response.read()
+				counts[index] += 1
+			except (urllib.error.URLError, ConnectionError):
+				errors[index] += 1
+
+	threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.perf_counter() - start
+	return {"rps": round(sum(counts) / elapsed, 1), "requests": sum(counts), "errors": sum(errors)}
+
+
+def main():
+	"""Runs the benchmark for both modes and prints a JSON report"""
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--cpus", default="0", help="CPU list given to taskset for both servers")
+	parser.add_argument("--workers", type=int, default=1, help="gunicorn workers per server")
+	parser.add_argument("--concurrency", type=int, default=32, help="concurrent client threads")
+	parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+	parser.add_argument("--items", type=int, default=20, help="items in the order that is read")
+	parser.add_argument("--port", type=int, default=8090, help="port of the server under test")
+	args = parser.parse_args()
+
+	# the service creates no tables when it starts
+	subprocess.run(["flask", "db", "upgrade"], cwd=ROOT, env=dict(os.environ, FLASK_APP="service"), check=True)
+	report = {"cpus": args.cpus, "workers": args.workers, "concurrency": args.concurrency, "results": {}}
+	for mode in ("sync", "async"):
+		process = start_server(mode, args.port, args.cpus, args.workers)
+		try:
+			base_url = f"http://127.0.0.1:{args.port}"
+			order_id = seed_order(base_url, args.items)
+			report["results"][mode] = {
+				route: measure(base_url + route.replace("<id>", str(order_id)), args.concurrency, args.duration)
+				for route in ("/orders/<id>", "/orders/<id>/items")
+			}
+		finally:
+			process.terminate()
+			process.wait()
+	json.dump(report, sys.stdout, indent=2)
+	print()
+
+
+if __name__ == "__main__":
+	main()
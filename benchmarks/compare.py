@@ -0,0 +1,53 @@
+"""
+Benchmark report comparison
+
+Prints the per-endpoint change between two reports of api_benchmark.py,
+usually taken on two commits against the same dataset.
+
+Usage:
+	python benchmarks/compare.py base.json head.json
+"""
+import argparse
+import json
+import sys
+
+METRICS = ("rps", "p50_ms", "p95_ms", "p99_ms", "sql_statements_mean", "errors")
+
+
+def change(before, after):
+	"""Relative change from before to after in percent, None when undefined"""
+	if not before:
+		return None
+	return round((after - before) / before * 100, 1)
+
+
+def compare(base, head):
+	"""Returns the metrics of both reports with their change per endpoint"""
+	endpoints = {}
+	for name in sorted(set(base["endpoints"]) | set(head["endpoints"])):
+		before = base["endpoints"].get(name)
+		after = head["endpoints"].get(name)
+		if before is None or after is None:
+			endpoints[name] = {"base": before, "head": after}
+			continue
+		endpoints[name] = {
+			metric: {"base": before[metric], "head": after[metric], "change_pct": change(before[metric], after[metric])}
+			for metric in METRICS
+		}
+	return {"base": base.get("commit"), "head": head.get("commit"), "endpoints": endpoints}
+
+
+def main():
+	"""Prints the comparison of two reports as JSON"""
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("base", help="report of the baseline commit")
+	parser.add_argument("head", help="report of the commit under test")
+	args = parser.parse_args()
+	with open(args.base, encoding="utf-8") as base, open(args.head, encoding="utf-8") as head:
+		report = compare(json.load(base), json.load(head))
+	json.dump(report, sys.stdout, indent=2, sort_keys=True)
+	print()
+
+
+if __name__ == "__main__":
+	main()
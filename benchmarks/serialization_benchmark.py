@@ -0,0 +1,96 @@
+"""
+List serialization microbenchmark
+
+Measures the per-row cost of turning a page of orders into a JSON body,
+from the query to the encoded bytes, on the path list endpoints used
+before (ORM objects, Order.serialize(), flask-restx marshal and json) and
+on the current one (column rows, Order.serialize_rows() and
+service.common.json_codec).
+
+Usage:
+	DATABASE_URI=sqlite:////tmp/bench.db python benchmarks/serialization_benchmark.py --rows 1000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask_restx import marshal  # noqa: E402  pylint: disable=wrong-import-position
+from sqlalchemy.orm import selectinload  # noqa: E402  pylint: disable=wrong-import-position
+from service import app  # noqa: E402  pylint: disable=wrong-import-position
+from service.common import json_codec  # noqa: E402  pylint: disable=wrong-import-position
+from service.models import db, Order  # noqa: E402  pylint: disable=wrong-import-position
+from service.routes import order_model  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def before(query, expand):
+	"""ORM objects, serialize(), marshal_list_with and the json module"""
+	if expand:
+		# the items loaded through the relationship with one extra SELECT ... IN
+		orders = [order.serialize_with_items() for order in query.options(selectinload(Order.items)).all()]
+	else:
+		orders = [order.serialize() for order in query.all()]
+	return (json.dumps(marshal(orders, order_model, skip_none=True)) + "\n").encode()
+
+
+def after(query, expand):
+	"""Column rows, serialize_rows() and json_codec"""
+	orders = Order.serialize_rows(Order.rows(query).all())
+	if expand:
+		item_ids = Order.item_ids_by_order([order["id"] for order in orders])
+		for order in orders:
+			order["items"] = item_ids[order["id"]]
+	return json_codec.dumps(orders) + b"\n"
+
+
+def per_row_microseconds(path, query, expand, rows, repeat):
+	"""Returns the best per-row time of path over repeat runs"""
+	best = float("inf")
+	for _ in range(repeat):
+		db.session.remove()
+		start = time.perf_counter()
+		path(query(), expand)
+		best = min(best, time.perf_counter() - start)
+	return round(best / rows * 1e6, 3)
+
+
+def main():
+	"""Seeds the orders when needed and prints a JSON report"""
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--rows", type=int, default=1000, help="orders in the page")
+	parser.add_argument("--items", type=int, default=3, help="items per order")
+	parser.add_argument("--repeat", type=int, default=20, help="runs per path, the best one is kept")
+	args = parser.parse_args()
+	app.app_context().push()
+	Order.create_schema()
+
+	user_id = -1  # a user the service never creates
+	query = lambda: Order.query.filter(Order.user_id == user_id).order_by(Order.id).limit(args.rows)  # noqa: E731
+	missing = args.rows - query().count()
+	if missing > 0:
+		Order.create_bulk([
+			{"user_id": user_id, "create_time": int(time.time()), "status": 1, "items": list(range(args.items))}
+			for _ in range(missing)
+		])
+
+	report = {"rows": args.rows, "items_per_order": args.items, "database": db.engine.dialect.name,
+		"encoder": "orjson" if json_codec.orjson else "json", "per_row_us": {}}
+	for expand in (False, True):
+		name = "expand=items" if expand else "plain"
+		# marshal turned the status into a string, the current path keeps the int of GET /orders
+		old = [dict(order, status=int(order["status"])) for order in json.loads(before(query(), expand))]
+		assert old == json.loads(after(query(), expand))
+		report["per_row_us"][name] = {
+			"before": per_row_microseconds(before, query, expand, args.rows, args.repeat),
+			"after": per_row_microseconds(after, query, expand, args.rows, args.repeat),
+		}
+	json.dump(report, sys.stdout, indent=2)
+	print()
+
+
+if __name__ == "__main__":
+	main()
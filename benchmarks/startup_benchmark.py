@@ -0,0 +1,91 @@
+"""
+Startup benchmark
+
+Measures how long a fresh worker process takes from importing the service
+to answering its first request, split into the import of the service
+package, create_app() and the first request through the test client.
+Every run starts a new interpreter so nothing is cached between runs; the
+report holds the median and the slowest run of each phase.
+
+Runs against the database of DATABASE_URI, PostgreSQL or SQLite:
+	DATABASE_URI=sqlite:////tmp/bench.db python benchmarks/startup_benchmark.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in every child process and prints the duration of each phase in ms
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import service
+imported = time.perf_counter()
+app = service.create_app()
+created = time.perf_counter()
+response = app.test_client().get(sys.argv[1])
+answered = time.perf_counter()
+json.dump({
+	"import_ms": (imported - start) * 1000,
+	"create_app_ms": (created - imported) * 1000,
+	"first_request_ms": (answered - created) * 1000,
+	"status": response.status_code,
+	"modules": len(sys.modules),
+	"alembic_loaded": "alembic" in sys.modules,
+}, sys.stdout)
+"""
+
+PHASES = ("import_ms", "create_app_ms", "first_request_ms", "process_ms")
+
+
+def run_once(path):
+	"""Starts a fresh interpreter, returns the timings it measured"""
+	start = time.perf_counter()
+	output = subprocess.check_output([sys.executable, "-c", CHILD, path], cwd=ROOT, text=True)
+	timings = json.loads(output)
+	timings["process_ms"] = (time.perf_counter() - start) * 1000
+	return timings
+
+
+def git_commit():
+	"""The commit being benchmarked, if known"""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	"""Runs the child process several times and prints a JSON report"""
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--runs", type=int, default=10, help="fresh processes to start")
+	parser.add_argument("--path", default="/orders/0", help="the first request, a 404 still reaches the database")
+	parser.add_argument("-o", "--output", help="report file, standard output when omitted")
+	args = parser.parse_args()
+
+	runs = [run_once(args.path) for _ in range(args.runs)]
+	report = {
+		"commit": git_commit(),
+		"runs": args.runs,
+		"path": args.path,
+		"status_codes": sorted({run["status"] for run in runs}),
+		"modules": runs[-1]["modules"],
+		"alembic_loaded": runs[-1]["alembic_loaded"],
+	}
+	for phase in PHASES:
+		values = [run[phase] for run in runs]
+		report[phase] = {"median": round(statistics.median(values), 1), "max": round(max(values), 1)}
+
+	output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+	with output:
+		json.dump(report, output, indent=2, sort_keys=True)
+		output.write("\n")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,50 @@
+"""
+Gunicorn configuration
+
+Picked up automatically by gunicorn from the working directory.
+SERVER_MODE=async serves the ASGI entry point with uvicorn workers
+instead of the Flask app with sync workers. GUNICORN_PRELOAD=true (or
+--preload) creates the app once in the master before forking the workers.
+With PROMETHEUS_MULTIPROC_DIR set the workers share their metrics through
+files in that directory.
+"""
+import os
+import shutil
+import sys
+
+if os.getenv("SERVER_MODE", "sync") == "async":
+    wsgi_app = "service.asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "service:create_app()"
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+
+def post_fork(server, worker):
+    """Gives every worker its own database connections
+
+    When the app is loaded before forking (--preload) the workers would
+    share the pooled sockets of the master, so drop them without closing
+    them; each worker then opens fresh connections on first use.
+    """
+    if "service.models" in sys.modules:
+        from service.models import db  # pylint: disable=import-outside-toplevel
+        app = server.app.wsgi()
+        db.get_engine(getattr(app, "flask_app", app)).dispose(close=False)
+        server.log.info("Worker %s: database pool reset after fork", worker.pid)
+
+
+def on_starting(server):
+    """Removes the metrics files left over from a previous run"""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
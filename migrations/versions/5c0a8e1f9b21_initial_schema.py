@@ -0,0 +1,41 @@
+"""initial schema
+
+Revision ID: 5c0a8e1f9b21
+Revises:
+Create Date: 2022-12-01 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0a8e1f9b21'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'order',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('create_time', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Enum('CREATED', 'COMPLETED', 'CANCELLED', name='status'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('item_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['order.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('items')
+    op.drop_table('order')
+    sa.Enum(name='status').drop(op.get_bind(), checkfirst=True)
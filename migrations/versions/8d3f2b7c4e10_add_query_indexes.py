@@ -0,0 +1,29 @@
+"""add indexes for the order and item query paths
+
+Revision ID: 8d3f2b7c4e10
+Revises: 5c0a8e1f9b21
+Create Date: 2022-12-01 10:05:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f2b7c4e10'
+down_revision = '5c0a8e1f9b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_order_user_id_status', 'order', ['user_id', 'status'], unique=False)
+    op.create_index('ix_order_user_id_create_time', 'order', ['user_id', 'create_time'], unique=False)
+    op.create_index('ix_items_order_id', 'items', ['order_id'], unique=False)
+    op.create_index('ix_items_item_id_order_id', 'items', ['item_id', 'order_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_items_item_id_order_id', table_name='items')
+    op.drop_index('ix_items_order_id', table_name='items')
+    op.drop_index('ix_order_user_id_create_time', table_name='order')
+    op.drop_index('ix_order_user_id_status', table_name='order')
@@ -0,0 +1,26 @@
+"""index items by (order_id, item_id)
+
+Revision ID: a41c6d2e8f53
+Revises: 8d3f2b7c4e10
+Create Date: 2022-12-02 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c6d2e8f53'
+down_revision = '8d3f2b7c4e10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (order_id, item_id) also serves every lookup by order_id alone
+    op.create_index('ix_items_order_id_item_id', 'items', ['order_id', 'item_id'], unique=False)
+    op.drop_index('ix_items_order_id', table_name='items')
+
+
+def downgrade():
+    op.create_index('ix_items_order_id', 'items', ['order_id'], unique=False)
+    op.drop_index('ix_items_order_id_item_id', table_name='items')
@@ -0,0 +1,25 @@
+"""index orders by create_time
+
+Revision ID: b62e9d1c7a48
+Revises: f3c5a7e9b214
+Create Date: 2022-12-07 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b62e9d1c7a48'
+down_revision = 'f3c5a7e9b214'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # BRIN on PostgreSQL: create_time follows the insert order, so block ranges
+    # summarize it in a few pages; other databases get a B-tree
+    op.create_index('ix_order_create_time', 'order', ['create_time'], unique=False, postgresql_using='brin')
+
+
+def downgrade():
+    op.drop_index('ix_order_create_time', table_name='order')
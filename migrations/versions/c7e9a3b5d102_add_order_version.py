@@ -0,0 +1,24 @@
+"""add a version to orders for ETags and optimistic concurrency
+
+Revision ID: c7e9a3b5d102
+Revises: a41c6d2e8f53
+Create Date: 2022-12-03 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e9a3b5d102'
+down_revision = 'a41c6d2e8f53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('order', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('order', 'version')
@@ -0,0 +1,43 @@
+"""add the archive of old orders and their items
+
+Revision ID: d18f4a6b2c95
+Revises: b62e9d1c7a48
+Create Date: 2022-12-08 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd18f4a6b2c95'
+down_revision = 'b62e9d1c7a48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'order_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('create_time', sa.BigInteger(), nullable=False),
+        sa.Column('status', sa.SmallInteger(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('archived_at', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'items_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('item_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_items_archive_order_id', 'items_archive', ['order_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_items_archive_order_id', table_name='items_archive')
+    op.drop_table('items_archive')
+    op.drop_table('order_archive')
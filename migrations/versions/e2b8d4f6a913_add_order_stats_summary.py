@@ -0,0 +1,38 @@
+"""add the daily order statistics summary
+
+Revision ID: e2b8d4f6a913
+Revises: c7e9a3b5d102
+Create Date: 2022-12-05 10:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8d4f6a913'
+down_revision = 'c7e9a3b5d102'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'order_stats',
+        sa.Column('kind', sa.String(length=8), nullable=False),
+        sa.Column('day', sa.Integer(), nullable=False),
+        sa.Column('key', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'day', 'key')
+    )
+    op.create_table(
+        'order_stats_refresh',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('refreshed_at', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('order_stats_refresh')
+    op.drop_table('order_stats')
@@ -0,0 +1,66 @@
+"""store order status as SMALLINT and create_time as BIGINT
+
+Revision ID: f3c5a7e9b214
+Revises: e2b8d4f6a913
+Create Date: 2022-12-06 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c5a7e9b214'
+down_revision = 'e2b8d4f6a913'
+branch_labels = None
+depends_on = None
+
+STATUSES = (('CREATED', 1), ('COMPLETED', 2), ('CANCELLED', 3))
+STATUS_ENUM = sa.Enum(*(name for name, _ in STATUSES), name='status')
+STATUS_CHECK = 'status IN ({})'.format(', '.join(str(value) for _, value in STATUSES))
+
+
+def upgrade():
+    # a new column keeps the conversion portable, SQLite cannot change a type in place
+    op.add_column('order', sa.Column('status_code', sa.SmallInteger(), nullable=True))
+    op.execute(
+        'UPDATE "order" SET status_code = CASE status '
+        + ' '.join(f"WHEN '{name}' THEN {value}" for name, value in STATUSES)
+        + ' END'
+    )
+    op.drop_index('ix_order_user_id_status', table_name='order')
+    op.drop_index('ix_order_user_id_create_time', table_name='order')
+    with op.batch_alter_table('order') as batch_op:
+        batch_op.drop_column('status')
+        batch_op.alter_column('status_code', new_column_name='status', existing_type=sa.SmallInteger(), nullable=False)
+        batch_op.alter_column('create_time', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=False)
+        batch_op.create_check_constraint('ck_order_status', STATUS_CHECK)
+    op.create_index('ix_order_user_id_status', 'order', ['user_id', 'status'], unique=False)
+    op.create_index('ix_order_user_id_create_time', 'order', ['user_id', 'create_time'], unique=False)
+    STATUS_ENUM.drop(op.get_bind(), checkfirst=True)
+    # the days of the summary follow create_time
+    with op.batch_alter_table('order_stats') as batch_op:
+        batch_op.alter_column('day', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('order_stats') as batch_op:
+        batch_op.alter_column('day', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=False)
+    STATUS_ENUM.create(op.get_bind(), checkfirst=True)
+    op.add_column('order', sa.Column('status_name', STATUS_ENUM, nullable=True))
+    # PostgreSQL does not assign text to an enum column without a cast
+    cast = '::status' if op.get_context().dialect.name == 'postgresql' else ''
+    op.execute(
+        'UPDATE "order" SET status_name = CASE status '
+        + ' '.join(f"WHEN {value} THEN '{name}'{cast}" for name, value in STATUSES)
+        + ' END'
+    )
+    op.drop_index('ix_order_user_id_status', table_name='order')
+    op.drop_index('ix_order_user_id_create_time', table_name='order')
+    with op.batch_alter_table('order') as batch_op:
+        batch_op.drop_constraint('ck_order_status', type_='check')
+        batch_op.drop_column('status')
+        batch_op.alter_column('status_name', new_column_name='status', existing_type=STATUS_ENUM, nullable=False)
+        batch_op.alter_column('create_time', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=False)
+    op.create_index('ix_order_user_id_status', 'order', ['user_id', 'status'], unique=False)
+    op.create_index('ix_order_user_id_create_time', 'order', ['user_id', 'create_time'], unique=False)
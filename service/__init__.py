@@ -1,42 +1,61 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+create_app() creates and configures the Flask app and sets up the logging
+and SQL database. It creates no tables: run ```flask db upgrade``` (or
+```flask create-db``` in development) before serving. service.app is
+built by create_app() the first time it is used.
 """
-import sys
 import os
 from flask import Flask
 from service import config
-from .common import log_handlers
-
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object(config)
-app.config['API_KEY'] = os.getenv('API_KEY')
-
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order
-from service import routes         # noqa: E402, E261
-# pylint: disable=wrong-import-position
-from .common import error_handlers  # noqa: F401 E402
-
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
-
-app.logger.info(70 * "*")
-app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-	routes.init_db()  # make our SQLAlchemy tables
-except Exception as error:
-	app.logger.critical("%s: Cannot continue", error)
-	# gunicorn requires exit code 4 to stop spawning workers when they die
-	sys.exit(4)
-
-app.logger.info("Service initialized!")
-# If an API Key was not provided, autogenerate one
-if not app.config['API_KEY']:
-    app.config['API_KEY'] = routes.generate_apikey()
-    app.logger.info('Missing API Key! Autogenerated: {}'.format(app.config['API_KEY']))
+from .common import log_handlers, cache, metrics, profiler
+
+
+def create_app(settings=None):
+	"""
+	Creates the Flask app of the service
+
+	Args:
+		settings (dict): configuration applied over service.config
+	"""
+	app = Flask(__name__)
+	app.config.from_object(config)
+	app.config['API_KEY'] = os.getenv('API_KEY')
+	app.config.update(settings or {})
+
+	# The routes pull in flask-restx, so only import them once an app is needed
+	# pylint: disable=import-outside-toplevel
+	from service import routes
+	from service.models import Order, db
+	from .common import error_handlers
+
+	Order.init_db(app)
+	routes.init_app(app)
+	error_handlers.init_app(app)
+
+	# Set up logging for production
+	log_handlers.init_logging(app, "gunicorn.error")
+	cache.init_cache(app)
+	metrics.init_metrics(app, db)
+	profiler.init_profiler(app)
+
+	app.logger.info(70 * "*")
+	app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+	app.logger.info(70 * "*")
+
+	app.logger.info("Service initialized!")
+	# If an API Key was not provided, autogenerate one
+	if not app.config['API_KEY']:
+		app.config['API_KEY'] = routes.generate_apikey()
+		app.logger.info("Missing API Key! Autogenerated: %s", app.config['API_KEY'])
+	return app
+
+
+def __getattr__(name):
+	"""Creates service.app on first use, for service:app and the tests"""
+	if name == "app":
+		app = create_app()
+		globals()["app"] = app
+		return app
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,171 @@
+"""
+ASGI entry point
+
+Serves the same routes as the Flask app under an ASGI server, selected
+with SERVER_MODE=async (see gunicorn.conf.py). The hot read paths,
+GET /orders/<id> and GET /orders/<id>/items, run on an async SQLAlchemy
+engine using the models of service/models.py. Every other request is
+handed to the Flask app, which asgiref runs in a thread pool.
+"""
+import logging
+import re
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags, quote_etag
+from service import app as flask_app
+from service.common import json_codec, status
+from service.common.cache import order_cache
+from service.models import Order, OrderArchive, Items, order_etag
+
+logger = logging.getLogger("flask.app")
+
+# Async drivers used in place of the sync ones of DATABASE_URI
+ASYNC_DRIVERS = {
+	"postgres": "postgresql+asyncpg",
+	"postgresql": "postgresql+asyncpg",
+	"postgresql+psycopg2": "postgresql+asyncpg",
+	"sqlite": "sqlite+aiosqlite",
+}
+
+ORDER_PATH = re.compile(r"^/orders/(\d+)$")
+ORDER_ITEMS_PATH = re.compile(r"^/orders/(\d+)/items$")
+
+
+def async_database_uri(uri):
+	"""Returns the database URI with the scheme of its async driver"""
+	scheme, _, rest = uri.partition("://")
+	return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+class AsyncOrderApp:
+	"""ASGI application serving order reads on an async engine"""
+
+	def __init__(self, wsgi_app):
+		self.flask_app = wsgi_app
+		self.wsgi = WsgiToAsgi(wsgi_app)
+		self.engine = None
+		self.session_factory = None
+
+	def start(self):
+		"""Creates the async engine from the Flask app configuration"""
+		uri = async_database_uri(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+		options = {}
+		if uri.startswith("sqlite"):
+			# aiosqlite connections belong to the loop that opened them
+			options["poolclass"] = NullPool
+		else:
+			engine_options = flask_app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}
+			options.update({key: value for key, value in engine_options.items() if key != "poolclass"})
+		self.engine = create_async_engine(uri, **options)
+		self.session_factory = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+		logger.info("Async engine started for %s", self.engine.url.render_as_string(hide_password=True))
+
+	async def stop(self):
+		"""Closes every connection of the async engine"""
+		if self.engine is not None:
+			await self.engine.dispose()
+			self.engine = None
+
+	async def __call__(self, scope, receive, send):
+		if scope["type"] == "lifespan":
+			await self.lifespan(receive, send)
+			return
+		if scope["type"] == "http" and scope["method"] == "GET":
+			handler = self.route(scope["path"])
+			if handler is not None:
+				if self.engine is None:
+					self.start()
+				await handler(scope, send)
+				return
+		await self.wsgi(scope, receive, send)
+
+	async def lifespan(self, receive, send):
+		"""Starts and stops the engine with the server"""
+		while True:
+			message = await receive()
+			if message["type"] == "lifespan.startup":
+				self.start()
+				await send({"type": "lifespan.startup.complete"})
+			elif message["type"] == "lifespan.shutdown":
+				await self.stop()
+				await send({"type": "lifespan.shutdown.complete"})
+				return
+
+	def route(self, path):
+		"""Returns the async handler of a path, or None to use the Flask app"""
+		match = ORDER_PATH.match(path)
+		if match:
+			order_id = int(match.group(1))
+			return lambda scope, send: self.get_order(order_id, scope, send)
+		match = ORDER_ITEMS_PATH.match(path)
+		if match:
+			order_id = int(match.group(1))
+			return lambda scope, send: self.list_order_items(order_id, send)
+		return None
+
+	######################################################################
+	# Handlers
+	######################################################################
+
+	async def get_order(self, order_id, scope, send):
+		"""GET /orders/<id>, sharing the read-through cache of the Flask app"""
+		cached = order_cache.get(order_id)
+		if cached is not None and order_cache.check_version:
+			async with self.session_factory() as session:
+				version = (await session.execute(Order.version_statement(order_id))).scalar()
+			cached = order_cache.current(order_id, cached, version)
+		if cached is None:
+			async with self.session_factory() as session:
+				result = await session.execute(Order.with_item_ids_statement(order_id))
+				cached = Order.serialize_with_item_ids(result)
+				if cached is None:
+					result = await session.execute(OrderArchive.with_item_ids_statement(order_id))
+					cached = OrderArchive.serialize_with_item_ids(result)
+			if cached is None:
+				await send_error(
+					send, status.HTTP_404_NOT_FOUND, "Not Found",
+					f"Order with id '{order_id}' was not found.")
+				return
+			order_cache.set(order_id, cached)
+
+		etag = order_etag(order_id, cached["version"])
+		headers = [(b"etag", quote_etag(etag).encode())]
+		request_headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"]])
+		if etag in parse_etags(request_headers.get("If-None-Match")):
+			await send_response(send, status.HTTP_304_NOT_MODIFIED, None, headers)
+			return
+		await send_response(send, status.HTTP_200_OK, cached["order"], headers)
+
+	async def list_order_items(self, order_id, send):
+		"""GET /orders/<id>/items"""
+		async with self.session_factory() as session:
+			result = await session.execute(Items.order_items_statement(order_id))
+			items = Items.serialize_rows(result)
+		await send_response(send, status.HTTP_200_OK, items)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+
+async def send_response(send, code, data, headers=()):
+	"""Sends data as a JSON response, or no body when data is None"""
+	body = b"" if data is None else json_codec.dumps(data) + b"\n"
+	response_headers = list(headers)
+	if data is not None:
+		response_headers.append((b"content-type", b"application/json"))
+	response_headers.append((b"content-length", str(len(body)).encode()))
+	await send({"type": "http.response.start", "status": code, "headers": response_headers})
+	await send({"type": "http.response.body", "body": body})
+
+
+async def send_error(send, code, error, message):
+	"""Sends an error in the same shape as service.common.error_handlers"""
+	await send_response(send, code, {"status": code, "error": error, "message": message})
+
+
+app = AsyncOrderApp(flask_app)
@@ -0,0 +1,217 @@
+"""
+Cache
+
+This module contains the read-through cache of serialized orders. The
+in-process LRU backend is used by default; any object implementing
+CacheBackend can replace it, like the Redis backend every worker shares.
+
+Writes only invalidate the LRU of the worker that handled them, so with
+check_version every hit is compared with the version of the order read
+from the database, which drops the copies other workers made stale. A
+shared backend is invalidated for every worker at once and needs no check.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from . import json_codec
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class CacheBackend(ABC):
+    """Interface of the stores the order cache can keep its entries in"""
+
+    @abstractmethod
+    def get(self, key):
+        """Returns the value stored under key, or None"""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Stores value under key for ttl seconds"""
+
+    @abstractmethod
+    def delete(self, key):
+        """Removes key if it is stored"""
+
+    @abstractmethod
+    def clear(self):
+        """Removes every key"""
+
+
+class NullBackend(CacheBackend):
+    """A backend that stores nothing, which disables caching"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUBackend(CacheBackend):
+    """An in-process least recently used store with per entry expiry"""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend(CacheBackend):
+    """A store shared by every worker, on a Redis client or any stand-in with its methods
+
+    Only the get, set with ex, delete and scan_iter commands are used, so a
+    memcached-compatible proxy or a local stand-in can take its place.
+    """
+
+    def __init__(self, client, prefix="orders:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        """Connects lazily to the Redis server at url, like redis://localhost:6379/0"""
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package")
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class OrderCache:
+    """Read-through cache of orders serialized with their items, keyed on order id"""
+
+    def __init__(self, backend=None, ttl=60, check_version=True):
+        self.backend = backend if backend is not None else LRUBackend()
+        self.ttl = ttl
+        self.check_version = check_version
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def configure(self, backend, ttl, check_version=True):
+        """Switches to another backend, time to live and version check"""
+        self.backend = backend
+        self.ttl = ttl
+        self.check_version = check_version
+
+    @staticmethod
+    def _key(order_id):
+        return f"order:{order_id}"
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, order_id):
+        """Returns the cached order as a dictionary, or None"""
+        value = self.backend.get(self._key(order_id))
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json_codec.loads(value)
+
+    def set(self, order_id, order_data):
+        """Caches an order serialized as a dictionary"""
+        self.backend.set(self._key(order_id), json_codec.dumps(order_data), self.ttl)
+
+    def current(self, order_id, cached, version):
+        """Returns the cached order if it still has the version of the database
+
+        version is None once the order left the order table, which only the
+        copies of archived orders outlive. Stale copies are invalidated.
+        """
+        if version == cached["version"] or (version is None and cached["order"].get("archived")):
+            return cached
+        self.invalidate(order_id)
+        return None
+
+    def invalidate(self, *order_ids):
+        """Drops the cached copies of orders that changed"""
+        for order_id in order_ids:
+            if order_id is not None:
+                self.backend.delete(self._key(order_id))
+                self._count("invalidations")
+
+    def clear(self):
+        """Drops every cached order"""
+        self.backend.clear()
+
+    def stats(self):
+        """Returns the hit, miss and invalidation counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+order_cache = OrderCache()
+
+
+def init_cache(app):
+    """Configures the order cache from the app configuration"""
+    if app.config["CACHE_BACKEND"] == "none":
+        backend = NullBackend()
+    elif app.config["CACHE_BACKEND"] == "redis":
+        backend = RedisBackend.from_url(app.config["CACHE_URL"])
+    else:
+        backend = LRUBackend(app.config["CACHE_MAX_SIZE"])
+    # only the LRU of each worker misses the invalidations of the others
+    check_version = app.config["CACHE_CHECK_VERSION"] and isinstance(backend, LRUBackend)
+    order_cache.configure(backend, app.config["CACHE_TTL"], check_version)
@@ -0,0 +1,44 @@
+"""
+JSON Codec
+
+This module contains the JSON encoding of the service. orjson is used
+when it is installed, which encodes lists of orders several times faster
+than the standard library, otherwise it falls back to the json module.
+output_json replaces the flask-restx representation of application/json,
+so every Resource response goes through it.
+"""
+import json
+from flask import current_app, make_response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Encodes data as JSON"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data).encode()
+
+
+def loads(value):
+    """Decodes JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+        if current_app.debug:
+            option |= orjson.OPT_INDENT_2
+        dumped = orjson.dumps(data, option=option)
+    else:
+        dumped = json.dumps(data, indent=4 if current_app.debug else None) + "\n"
+    response = make_response(dumped, code)
+    response.headers.extend(headers or {})
+    return response
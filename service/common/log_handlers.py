@@ -18,19 +18,179 @@
 Log Handlers
 
 This module contains utility functions to set up logging
-consistently
+consistently. Records are written as text or, with LOG_FORMAT=json, as
+one JSON object per line, tagged with the id of the request that logged
+them. With LOG_QUEUE set the request threads only put records on a queue
+and a background listener formats and writes them. LOG_SAMPLING keeps
+only a share of the DEBUG and INFO records of the named loggers.
 """
+import atexit
+import json
 import logging
+import os
+import queue
+import random
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, has_request_context, request
+
+REQUEST_ID_HEADER = "X-Request-ID"
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] [%(request_id)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# Loggers sharing the handlers of the app logger
+SERVICE_LOGGERS = ("flask.app",)
+
+_listener = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Tags records with the id of the request that logged them"""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = g.get("request_id", "-") if has_request_context() else "-"
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the records below WARNING of each logger
+
+    rates maps logger names to the share of records to keep, a logger
+    without a rate uses the rate of its closest named parent.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def rate(self, name):
+        """Returns the sampling rate of the named logger"""
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate(record.name)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            record.exc_text = record.exc_text or self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class LazyQueueHandler(QueueHandler):
+    """A QueueHandler that leaves the formatting to the listener thread"""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # tracebacks cannot wait: the frames change once the caller returns
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sampling(value):
+    """Parses "logger=rate,logger=rate" into a dict of rates"""
+    rates = {}
+    for entry in filter(None, (part.strip() for part in (value or "").split(","))):
+        name, _, rate = entry.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def _start_listener(log_queue, handlers):
+    """Starts the thread writing the queued records to handlers"""
+    global _listener  # pylint: disable=global-statement
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener_after_fork():
+    """Gives a forked worker its own listener thread, which fork does not copy"""
+    if _listener is not None and _listener._thread is not None:  # pylint: disable=protected-access
+        _start_listener(_listener.queue, _listener.handlers)
+
+
+def _stop_listener():
+    """Writes the records still queued"""
+    if _listener is not None and _listener._thread is not None:  # pylint: disable=protected-access
+        _listener.stop()
+
+
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+atexit.register(_stop_listener)
+
+
+def _assign_request_id():
+    g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+
+def _return_request_id(response):
+    if "request_id" in g:
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+def _set_filter(handler, log_filter):
+    """Adds log_filter to handler in place of any filter of its type
+
+    The gunicorn handlers live as long as the process, so every create_app()
+    would otherwise stack one more filter on them.
+    """
+    for existing in [f for f in handler.filters if type(f) is type(log_filter)]:
+        handler.removeFilter(existing)
+    handler.addFilter(log_filter)
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
-    app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = list(gunicorn_logger.handlers)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter(datefmt=DATE_FORMAT)
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+        # gunicorn keeps writing its own records straight to these handlers
+        _set_filter(handler, RequestIdFilter())
+    if handlers and app.config.get("LOG_QUEUE"):
+        log_queue = queue.SimpleQueue()
+        _stop_listener()
+        _start_listener(log_queue, handlers)
+        handlers = [LazyQueueHandler(log_queue)]
+    rates = parse_sampling(app.config.get("LOG_SAMPLING"))
+    for handler in handlers:
+        _set_filter(handler, RequestIdFilter())
+        if rates:
+            _set_filter(handler, SamplingFilter(rates))
+    for logger in [app.logger] + [logging.getLogger(name) for name in SERVICE_LOGGERS]:
+        logger.propagate = False
+        logger.handlers = handlers
+        logger.setLevel(gunicorn_logger.level)
+    app.before_request(_assign_request_id)
+    app.after_request(_return_request_id)
     app.logger.info("Logging handler established")
+
+
+def sql_logger(app):
+    """Returns the logger of the SQL profiler, which shares the app handlers"""
+    return app.logger.getChild("sql")
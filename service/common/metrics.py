@@ -0,0 +1,169 @@
+"""
+Metrics
+
+This module contains the Prometheus metrics of the service: request
+latency and counts per flask-restx resource and status code, the SQL
+statements run by each request, and the state of the database pool and
+order cache. When PROMETHEUS_MULTIPROC_DIR is set the metrics of every
+gunicorn worker are aggregated when /metrics is scraped.
+"""
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .cache import order_cache
+from .pool_metrics import pool_status
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Seconds between two refreshes of the pool and cache gauges of a worker
+GAUGE_REFRESH_INTERVAL = 1.0
+
+REQUEST_LABELS = ["method", "resource", "status"]
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency", REQUEST_LABELS
+)
+REQUESTS = Counter(
+    "http_requests", "Requests served", REQUEST_LABELS
+)
+SQL_STATEMENTS = Histogram(
+    "db_statements_per_request", "SQL statements run by a request", ["resource"],
+    buckets=(0, 1, 2, 3, 4, 5, 10, 20, 50, 100, float("inf")),
+)
+SQL_DURATION = Histogram(
+    "db_statement_seconds_per_request", "Time a request spent running SQL statements", ["resource"]
+)
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Connections of the database pool", ["state"], multiprocess_mode="livesum"
+)
+POOL_EVENTS = Gauge(
+    "db_pool_events", "Database pool events since the worker started", ["event"], multiprocess_mode="livesum"
+)
+POOL_WAIT = Gauge(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled connection", multiprocess_mode="livesum"
+)
+CACHE_LOOKUPS = Gauge(
+    "order_cache_lookups", "Order cache lookups since the worker started", ["result"], multiprocess_mode="livesum"
+)
+CACHE_HIT_RATIO = Gauge(
+    "order_cache_hit_ratio", "Order cache hit ratio of each worker", multiprocess_mode="liveall"
+)
+
+
+class ServiceMetrics:
+    """Records the metrics of every request of a Flask app"""
+
+    def __init__(self):
+        self.db = None
+        self._lock = threading.Lock()
+        self._refreshed = 0.0
+
+    def init_app(self, app, db):
+        """Hooks the metrics into the request cycle of app"""
+        self.db = db
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    @staticmethod
+    def start_request():
+        """Starts the clocks of the request"""
+        g.metrics_start = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    def finish_request(self, response):
+        """Observes the latency and SQL statements of the request"""
+        if "metrics_start" not in g:
+            return response
+        resource = resource_name()
+        labels = (request.method, resource, str(response.status_code))
+        REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - g.metrics_start)
+        REQUESTS.labels(*labels).inc()
+        when_complete(response, lambda counters: self.observe_sql(resource, counters))
+        self.refresh_gauges()
+        return response
+
+    @staticmethod
+    def observe_sql(resource, counters):
+        """Observes the SQL statements and time counted for a finished request"""
+        SQL_STATEMENTS.labels(resource).observe(counters.sql_statements)
+        SQL_DURATION.labels(resource).observe(counters.sql_seconds)
+
+    def refresh_gauges(self, force=False):
+        """Copies the pool and cache statistics of this worker into the gauges"""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._refreshed < GAUGE_REFRESH_INTERVAL:
+                return
+            self._refreshed = now
+        if self.db is not None:
+            pool = pool_status(self.db.engine)
+            for state in ("size", "checked_in", "checked_out", "overflow"):
+                if state in pool:
+                    POOL_CONNECTIONS.labels(state).set(pool[state])
+            for name in ("connects", "checkouts", "checkins", "invalidations", "timeouts"):
+                POOL_EVENTS.labels(name).set(pool[name])
+            POOL_WAIT.set(pool["wait_seconds_total"])
+        cache = order_cache.stats()
+        for result in ("hits", "misses", "invalidations"):
+            CACHE_LOOKUPS.labels(result).set(cache[result])
+        CACHE_HIT_RATIO.set(cache["hit_ratio"])
+
+    def render(self):
+        """Returns the metrics of every worker in the Prometheus text format"""
+        self.refresh_gauges(force=True)
+        if MULTIPROCESS:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+service_metrics = ServiceMetrics()
+
+
+def when_complete(response, callback):
+    """Calls callback with the request globals once every SQL statement of response ran
+
+    A streamed body, like the one of GET /orders/export, runs its queries after
+    the after_request hooks, so its statements are only counted once the
+    response closes; the globals object outlives the app context until then.
+    """
+    counters = g._get_current_object()
+    if response.is_streamed:
+        response.call_on_close(lambda: callback(counters))
+    else:
+        callback(counters)
+
+
+def resource_name():
+    """Returns the flask-restx resource or view function serving the request"""
+    view = current_app.view_functions.get(request.endpoint)
+    if view is None:
+        return "unmatched"
+    return getattr(view, "view_class", view).__name__
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_seconds += time.perf_counter() - context.metrics_start
+
+
+def init_metrics(app, db):
+    """Records the metrics of app, reading the pool of db"""
+    service_metrics.init_app(app, db)
+    app.logger.info("Prometheus metrics enabled (multiprocess: %s)", MULTIPROCESS)
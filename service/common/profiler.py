@@ -0,0 +1,131 @@
+"""
+SQL Profiler
+
+This module contains an opt-in profiler that records every SQL statement
+of a request with its duration and row count. It profiles every request
+when SQL_PROFILE is set, or a single request that sends the API key in
+an X-SQL-Profile header. Slow requests are logged with their statements,
+statements repeated more than SQL_N_PLUS_ONE_THRESHOLD times are flagged
+as a likely N+1 pattern, and the timings can be returned in a
+Server-Timing header.
+"""
+import re
+import secrets
+import time
+from collections import Counter
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .log_handlers import sql_logger
+
+PROFILE_HEADER = "X-SQL-Profile"
+
+# Lists of bound parameters, so IN (?, ?) and IN (?) have the same shape
+PARAMETER_LIST = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*,?)+\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """Returns the statement with whitespace and parameter lists collapsed"""
+    return PARAMETER_LIST.sub("(?)", WHITESPACE.sub(" ", statement).strip())
+
+
+class SQLProfile:
+    """The SQL statements run by one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = []
+
+    def record(self, statement, seconds, rowcount):
+        """Adds a statement that took seconds and touched rowcount rows"""
+        self.statements.append((statement, seconds, rowcount))
+
+    @property
+    def sql_seconds(self):
+        """Time spent running statements"""
+        return sum(seconds for _, seconds, _ in self.statements)
+
+    def elapsed(self):
+        """Time since the request started"""
+        return time.perf_counter() - self.start
+
+    def repeated_statements(self, threshold):
+        """Returns {shape: count} of the statements run more than threshold times"""
+        shapes = Counter(statement_shape(statement) for statement, _, _ in self.statements)
+        return {shape: count for shape, count in shapes.items() if count > threshold}
+
+    def server_timing(self):
+        """Returns the profile as a Server-Timing header value"""
+        return (
+            f'db;dur={self.sql_seconds * 1000:.2f};desc="{len(self.statements)} statements", '
+            f"total;dur={self.elapsed() * 1000:.2f}"
+        )
+
+
+class SQLProfiler:
+    """Profiles the SQL statements of the requests of a Flask app"""
+
+    def init_app(self, app):
+        """Hooks the profiler into the request cycle of app"""
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def enabled(self):
+        """Tells if the current request should be profiled"""
+        if current_app.config["SQL_PROFILE"]:
+            return True
+        key = request.headers.get(PROFILE_HEADER)
+        api_key = current_app.config.get("API_KEY")
+        return bool(key and api_key and secrets.compare_digest(key, api_key))
+
+    def start_request(self):
+        """Starts a profile when the request asks for one"""
+        if self.enabled():
+            g.sql_profile = SQLProfile()
+
+    def finish_request(self, response):
+        """Logs the profile of the request and adds its Server-Timing header"""
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return response
+        config = current_app.config
+        logger = sql_logger(current_app)
+        elapsed_ms = profile.elapsed() * 1000
+        summary = (
+            f"{request.method} {request.full_path.rstrip('?')} {response.status_code} "
+            f"{elapsed_ms:.1f}ms, {len(profile.statements)} statements in {profile.sql_seconds * 1000:.1f}ms"
+        )
+        if elapsed_ms >= config["SQL_SLOW_REQUEST_MS"]:
+            logger.warning("Slow request %s%s", summary, "".join(
+                f"\n  {seconds * 1000:8.2f}ms {rowcount:6d} rows  {WHITESPACE.sub(' ', statement)}"
+                for statement, seconds, rowcount in profile.statements
+            ))
+        else:
+            logger.debug("Request %s", summary)
+        for shape, count in profile.repeated_statements(config["SQL_N_PLUS_ONE_THRESHOLD"]).items():
+            logger.warning("Possible N+1 in %s %s: %d x %s", request.method, request.path, count, shape)
+        if config["SQL_SERVER_TIMING"]:
+            response.headers["Server-Timing"] = profile.server_timing()
+        return response
+
+
+sql_profiler = SQLProfiler()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.profile_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and "sql_profile" in g:
+        g.sql_profile.record(statement, time.perf_counter() - context.profile_start, cursor.rowcount)
+
+
+def init_profiler(app):
+    """Enables the SQL profiler on app"""
+    sql_profiler.init_app(app)
+    if app.config["SQL_PROFILE"]:
+        app.logger.info("SQL profiling enabled for every request")
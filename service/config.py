@@ -14,3 +14,58 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Keyset pagination of the order listings
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Database connection pool, tuned per gunicorn worker
+# (the queue pool settings are dropped for SQLite, which does not use one)
+SQLALCHEMY_ENGINE_OPTIONS = {
+	"pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+	"max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+	"pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+	"pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+	"pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes"),
+}
+
+# Set once `flask partitions enable` split the order and items tables by month
+ORDER_PARTITIONING = os.getenv("ORDER_PARTITIONING", "false").lower() in ("true", "1", "yes")
+
+# Read-through cache of GET /orders/<id>: "memory" (per worker LRU), "redis"
+# (shared by every worker, at CACHE_URL) or "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "1024"))
+# Compare every hit of the "memory" cache with the version of the order in the
+# database, so writes handled by other workers are seen; only turn it off with
+# a single worker. The "redis" cache is invalidated for every worker and skips it
+CACHE_CHECK_VERSION = os.getenv("CACHE_CHECK_VERSION", "true").lower() in ("true", "1", "yes")
+
+# GET /orders/stats from the daily summary table once `flask refresh-stats`
+# (run by deploy/stats-cronjob.yaml) built it; requests never refresh it and
+# flag it "stale" when it is older than STATS_REFRESH_SECONDS
+STATS_SUMMARY = os.getenv("STATS_SUMMARY", "false").lower() in ("true", "1", "yes")
+STATS_REFRESH_SECONDS = int(os.getenv("STATS_REFRESH_SECONDS", "300"))
+
+# `flask archive-orders` moves the COMPLETED and CANCELLED orders older than
+# ARCHIVE_AFTER_DAYS into the archive tables, ARCHIVE_BATCH_SIZE orders per
+# transaction with a pause of ARCHIVE_PAUSE_SECONDS between transactions
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_PAUSE_SECONDS", "0.1"))
+
+# Logging: "text" or "json" lines, written by a background thread when
+# LOG_QUEUE is set, keeping a share of the DEBUG/INFO records of the loggers
+# named in LOG_SAMPLING ("flask.app=0.1,service=0.5")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() in ("true", "1", "yes")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# SQL profiling of every request, or of the requests sending the API_KEY
+# in an X-SQL-Profile header
+SQL_PROFILE = os.getenv("SQL_PROFILE", "false").lower() in ("true", "1", "yes")
+SQL_SLOW_REQUEST_MS = float(os.getenv("SQL_SLOW_REQUEST_MS", "500"))
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "5"))
+SQL_SERVER_TIMING = os.getenv("SQL_SERVER_TIMING", "true").lower() in ("true", "1", "yes")
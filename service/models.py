@@ -3,18 +3,28 @@ Models for YourResourceModel
 
 All of the models are stored in this module
 """
+import base64
+import binascii
+import json
 import logging
+import os
+import time
+from collections import Counter
+from itertools import groupby
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
-from flask_migrate import Migrate
-from sqlalchemy import ForeignKey
-from service import app
+from sqlalchemy import ForeignKey, inspect, tuple_
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.cache import order_cache
+from service.common.pool_metrics import configure_pool
 from enum import Enum
 logger = logging.getLogger("flask.app")
 
+# Width of the buckets of the order statistics summary
+DAY_SECONDS = 86400
+
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
-migrate = Migrate(app, db)
 
 
 class Status(int, Enum):
@@ -24,10 +34,78 @@ class Status(int, Enum):
 	CANCELLED = 3
 
 
+# The statuses an order can move to from each status
+STATUS_TRANSITIONS = {
+	Status.CREATED: (Status.COMPLETED, Status.CANCELLED),
+}
+
+
+class StatusType(db.TypeDecorator):
+	"""Stores a Status as its SMALLINT value instead of a named enum"""
+	impl = db.SmallInteger
+	cache_ok = True
+
+	def process_bind_param(self, value, dialect):
+		return None if value is None else Status(value).value
+
+	def process_result_value(self, value, dialect):
+		return None if value is None else Status(value)
+
+
 class DataValidationError(Exception):
 	""" Used for an data validation errors when deserializing """
 
 
+class StaleVersionError(Exception):
+	""" Used when an order changed since the version the client last read """
+
+
+def encode_cursor(values):
+	"""Encodes the sort key of the last row of a page into an opaque cursor"""
+	return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+	"""Decodes an opaque cursor back into a sort key of the given size"""
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+	except (binascii.Error, UnicodeError, ValueError) as error:
+		raise DataValidationError("Invalid cursor: " + cursor) from error
+	if not isinstance(values, list) or len(values) != size or \
+		not all(isinstance(value, int) for value in values):
+		raise DataValidationError("Invalid cursor: " + cursor)
+	return values
+
+
+def order_etag(order_id, version):
+	"""Returns the (unquoted) strong ETag of an order at a version, for every serving mode"""
+	return f"{order_id}-{version}"
+
+
+def time_filters(column, create_time_from, create_time_to):
+	"""Filters keeping column within [create_time_from, create_time_to)"""
+	if create_time_from is not None and create_time_to is not None and create_time_from > create_time_to:
+		raise DataValidationError(f"create_time_from {create_time_from} is after create_time_to {create_time_to}")
+	filters = []
+	if create_time_from is not None:
+		filters.append(column >= create_time_from)
+	if create_time_to is not None:
+		filters.append(column < create_time_to)
+	return filters
+
+
+def transition_sources(new_status, status=None):
+	"""Returns the statuses orders may move to new_status from, limited to status if given"""
+	sources = [source for source, targets in STATUS_TRANSITIONS.items() if new_status in targets]
+	if status is not None:
+		if status not in sources:
+			raise DataValidationError(f"Orders cannot go from {status.name} to {new_status.name}")
+		sources = [status]
+	if not sources:
+		raise DataValidationError(f"Orders cannot go to {new_status.name}")
+	return sources
+
+
 class Order(db.Model):
 	"""
 	Class that represents a Order Model
@@ -35,13 +113,30 @@ class Order(db.Model):
 	items: list[int]
 	"""
 	__tablename__ = "order"
+	__table_args__ = (
+		db.Index("ix_order_user_id_status", "user_id", "status"),
+		db.Index("ix_order_user_id_create_time", "user_id", "create_time"),
+		# time range scans without a user_id; create_time grows with the inserts, so a
+		# BRIN index of a few pages does on PostgreSQL what a B-tree does elsewhere
+		db.Index("ix_order_create_time", "create_time", postgresql_using="brin"),
+		db.CheckConstraint(
+			"status IN ({})".format(", ".join(str(status.value) for status in Status)), name="ck_order_status"),
+	)
 	app = None
 
 	# Table Schema
 	id = db.Column(db.Integer, primary_key=True)
 	user_id = db.Column(db.Integer, nullable=False)
-	create_time = db.Column(db.Integer, nullable=False)
-	status = db.Column(db.Enum(Status), nullable=False, default=Status.CREATED)
+	# seconds since the epoch, BIGINT so it outlives 2038
+	create_time = db.Column(db.BigInteger, nullable=False)
+	status = db.Column(StatusType, nullable=False, default=Status.CREATED)
+	# bumped on every change of the order or its items, see touch()
+	version = db.Column(db.Integer, nullable=False, server_default="1")
+	# "all" leaves the items to ON DELETE CASCADE even once loaded, instead of
+	# setting their NOT NULL order_id to NULL before deleting the order
+	items = db.relationship("Items", order_by="Items.id", passive_deletes="all")
+
+	__mapper_args__ = {"version_id_col": version}
 
 	def __repr__(self):
 		return f"<User {self.user_id} Create Time={self.create_time} Status={self.status}>"
@@ -50,7 +145,7 @@ class Order(db.Model):
 		"""
 		Creates a YourResourceModel to the database
 		"""
-		logger.info("Creating %s %s %s", self.id, self.create_time, self.status)
+		logger.debug("Creating %s %s %s", self.id, self.create_time, self.status)
 		self.id = None  # id must be none to generate next primary key
 		db.session.add(self)
 		db.session.commit()
@@ -58,20 +153,37 @@ class Order(db.Model):
 	def update(self):
 		"""
 		Updates a YourResourceModel to the database
+
+		The UPDATE only applies while the stored version is still the one
+		this order was read at, otherwise StaleVersionError is raised.
 		"""
-		logger.info("Saving %s", self.id)
-		db.session.commit()
+		logger.debug("Saving %s", self.id)
+		order_id = self.id
+		try:
+			db.session.commit()
+		except StaleDataError as error:
+			db.session.rollback()
+			raise StaleVersionError(f"Order {order_id} was changed by another request") from error
+		order_cache.invalidate(order_id)
 
 	def delete(self):
 		""" Removes a YourResourceModel from the data store """
-		logger.info("Deleting %s", self.id)
+		logger.debug("Deleting %s", self.id)
+		order_id = self.id
 		db.session.delete(self)
 		db.session.commit()
+		order_cache.invalidate(order_id)
 
 	def serialize(self):
 		""" Serializes a YourResourceModel into a dictionary """
 		return {"id": self.id, "user_id": self.user_id, "create_time": self.create_time, "status": int(self.status)}
 
+	def serialize_with_items(self):
+		""" Serializes a YourResourceModel and the ids of its items into a dictionary """
+		data = self.serialize()
+		data["items"] = [item.item_id for item in self.items]
+		return data
+
 	def deserialize(self, data):
 		"""
 		Deserializes a YourResourceModel from a dictionary
@@ -108,28 +220,312 @@ class Order(db.Model):
 			) from error
 		return self
 
+	@classmethod
+	def create_bulk(cls, orders_data):
+		"""
+		Creates many orders and their items in a single transaction
+
+		Every order is validated before anything is written, the orders are
+		inserted in one batched flush and all of their items in one
+		executemany statement, so nothing is stored if any order is invalid.
+
+		Args:
+			orders_data (list): dictionaries accepted by deserialize, each with
+				an optional "items" list of item ids
+		Returns:
+			list: (Order, list of item ids) pairs in the order given
+		"""
+		if not isinstance(orders_data, list):
+			raise DataValidationError(
+				"Invalid type for list [orders]: " + str(type(orders_data))
+			)
+		created = []
+		for data in orders_data:
+			if not isinstance(data, dict):
+				raise DataValidationError(
+					"Invalid type for dict [order]: " + str(type(data))
+				)
+			order = cls().deserialize(data)
+			created.append((order, Items.deserialize_item_ids(data.get("items"))))
+
+		logger.debug("Creating %s orders in bulk", len(created))
+		try:
+			db.session.add_all([order for order, _ in created])
+			db.session.flush()  # assigns the generated ids
+			rows = [
+				{"order_id": order.id, "item_id": item_id}
+				for order, item_ids in created
+				for item_id in item_ids
+			]
+			if rows:
+				db.session.execute(Items.__table__.insert(), rows)
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+		return created
+
 	@classmethod
 	def init_db(cls, app: Flask):
-		""" Initializes the database session """
+		"""
+		Initializes the database session
+
+		No connection is opened and no table is created here, so every
+		worker (or the gunicorn master with --preload) starts without
+		touching the database. The tables come from flask db upgrade.
+		"""
 		logger.info("Initializing database")
 		cls.app = app
+		configure_pool(app)
+		if app.config.get("ORDER_PARTITIONING"):
+			# a trigger reroutes the items inserted into the partitioned table, so their
+			# INSERT returns no row: the ids come from the sequence beforehand instead
+			app.config["SQLALCHEMY_ENGINE_OPTIONS"]["implicit_returning"] = False
 		# This is where we initialize SQLAlchemy from the Flask app
 		db.init_app(app)
-		app.app_context().push()
-		db.create_all()  # make our sqlalchemy tables
+		if os.getenv("FLASK_RUN_FROM_CLI"):
+			# alembic is only needed by the flask db commands
+			from flask_migrate import Migrate  # pylint: disable=import-outside-toplevel
+			Migrate(app, db)
+
+	@classmethod
+	def create_schema(cls):
+		""" Creates the missing tables, for development and tests """
+		logger.info("Creating database tables")
+		db.create_all()
 
 	@classmethod
 	def all(cls):
 		""" Returns all of the YourResourceModels in the database """
-		logger.info("Processing all YourResourceModels")
+		logger.debug("Processing all YourResourceModels")
 		return cls.query.all()
 
 	@classmethod
 	def find(cls, by_id):
 		""" Finds a YourResourceModel by it's ID """
-		logger.info("Processing lookup for id %s ...", by_id)
+		logger.debug("Processing lookup for id %s ...", by_id)
 		return cls.query.get(by_id)
 
+	@classmethod
+	def touch(cls, *order_ids):
+		"""Bumps the version of orders whose items changed, in the current transaction"""
+		cls.query.filter(cls.id.in_(order_ids)) \
+			.update({cls.version: cls.version + 1}, synchronize_session=False)
+
+	@staticmethod
+	def deserialize_selection(data):
+		"""
+		Deserializes the selection of orders of a bulk status change
+
+		Args:
+			data (dict): "ids" (list of ints) and/or the int filters
+				"user_id", "status", "create_time_from" and "create_time_to"
+		"""
+		if not isinstance(data, dict):
+			raise DataValidationError("Invalid selection of orders: " + str(type(data)))
+		selection = {}
+		ids = data.get("ids")
+		if ids is not None:
+			if not isinstance(ids, list) or not all(isinstance(order_id, int) for order_id in ids):
+				raise DataValidationError("Invalid type for list of int [ids]: " + str(ids))
+			selection["ids"] = ids
+		for name in ("user_id", "status", "create_time_from", "create_time_to"):
+			value = data.get(name)
+			if value is not None:
+				if not isinstance(value, int):
+					raise DataValidationError(f"Invalid type for int [{name}]: " + str(type(value)))
+				selection[name] = value
+		return selection
+
+	@classmethod
+	def transition_bulk(cls, new_status, ids=None, user_id=None, status=None, create_time_from=None, create_time_to=None):
+		"""Moves every matching order that may go to new_status with one UPDATE
+
+		The orders are selected by ids and/or the filters, and only those in a
+		status of STATUS_TRANSITIONS that leads to new_status are changed. The
+		UPDATE reports the changed ids with RETURNING where the database
+		supports it, otherwise they are selected with FOR UPDATE first.
+
+		Returns:
+			list: the sorted ids of the orders that changed
+		"""
+		try:
+			new_status = Status(new_status)
+			status = None if status is None else Status(status)
+		except ValueError as error:
+			raise DataValidationError(str(error)) from error
+		filters = [cls.status.in_(transition_sources(new_status, status))]
+		if ids is not None:
+			filters.append(cls.id.in_(ids))
+		if user_id is not None:
+			filters.append(cls.user_id == user_id)
+		filters.extend(time_filters(cls.create_time, create_time_from, create_time_to))
+		if len(filters) == 1:
+			raise DataValidationError("Select the orders by ids, user_id or create_time")
+		logger.debug("Moving orders to %s in bulk", new_status.name)
+
+		update = db.update(cls).values(status=new_status, version=cls.version + 1) \
+			.execution_options(synchronize_session=False)
+		try:
+			changed = cls._update_returning_ids(update, filters)
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+		order_cache.invalidate(*changed)
+		return sorted(changed)
+
+	@classmethod
+	def _update_returning_ids(cls, update, filters):
+		"""Runs an UPDATE of the orders matching filters and returns the changed ids
+
+		The ids come from RETURNING where the database supports it, otherwise
+		they are selected with FOR UPDATE and the UPDATE only keeps the first
+		filter, the status the orders come from, in case they moved since.
+		"""
+		if db.engine.dialect.full_returning:
+			return db.session.execute(update.where(*filters).returning(cls.id)).scalars().all()
+		changed = db.session.execute(db.select(cls.id).where(*filters).with_for_update()).scalars().all()
+		if changed:
+			db.session.execute(update.where(cls.id.in_(changed), *filters[:1]))
+		return changed
+
+	@classmethod
+	def rows(cls, query):
+		"""Selects only the columns of the orders of a query, as plain rows
+
+		Rows skip building ORM objects and the identity map, and keep the
+		id, create_time and version attributes paginate and ETags read.
+		"""
+		return query.with_entities(cls.id, cls.user_id, cls.create_time, cls.status, cls.version)
+
+	@staticmethod
+	def serialize_rows(rows):
+		""" Serializes the rows of Order.rows() like serialize() """
+		return [
+			{"id": order_id, "user_id": user_id, "create_time": create_time, "status": status.value}
+			for order_id, user_id, create_time, status, _ in rows
+		]
+
+	@classmethod
+	def with_item_ids_statement(cls, order_id):
+		"""SELECT of the columns of an order joined with the ids of its items, for any session"""
+		return db.select(cls.id, cls.user_id, cls.create_time, cls.status, cls.version, Items.item_id) \
+			.outerjoin(Items, Items.order_id == cls.id) \
+			.where(cls.id == order_id).order_by(Items.id)
+
+	@staticmethod
+	def serialize_with_item_ids(rows):
+		"""
+		Serializes the rows of with_item_ids_statement() like serialize_with_items()
+
+		Returns:
+			dict: the "version" of the order and the serialized "order", or
+				None when there are no rows
+		"""
+		rows = list(rows)
+		if not rows:
+			return None
+		first = rows[0]
+		return {
+			"version": first.version,
+			"order": {
+				"id": first.id,
+				"user_id": first.user_id,
+				"create_time": first.create_time,
+				"status": first.status.value,
+				"items": [row.item_id for row in rows if row.item_id is not None],
+			},
+		}
+
+	@classmethod
+	def version_statement(cls, order_id):
+		"""SELECT of the version of an order, for any session"""
+		return db.select(cls.version).where(cls.id == order_id)
+
+	@classmethod
+	def find_version(cls, order_id):
+		"""Returns the version of an order, or None when it is not in the order table"""
+		return db.session.execute(cls.version_statement(order_id)).scalar()
+
+	@classmethod
+	def find_with_item_ids(cls, order_id):
+		"""Reads an order with the ids of its items in one query, without ORM objects"""
+		logger.debug("Processing lookup for id %s with items ...", order_id)
+		return cls.serialize_with_item_ids(db.session.execute(cls.with_item_ids_statement(order_id)))
+
+	@staticmethod
+	def item_ids_by_order(order_ids):
+		"""Returns {order_id: [item_id, ...]} for the orders, with one SELECT ... IN"""
+		item_ids = {order_id: [] for order_id in order_ids}
+		if item_ids:
+			rows = db.session.query(Items.order_id, Items.item_id) \
+				.filter(Items.order_id.in_(order_ids)).order_by(Items.id)
+			for order_id, item_id in rows:
+				item_ids[order_id].append(item_id)
+		return item_ids
+
+	@classmethod
+	def paginate(cls, query, limit, cursor=None, by_create_time=False, descending=False):
+		"""Returns one page of an order query using keyset pagination
+
+		Args:
+			query (Query): the order query to page through
+			limit (int): the maximum number of orders to return
+			cursor (str): the next_cursor returned with the previous page
+			by_create_time (bool): sort by (create_time, id) instead of id
+			descending (bool): return the newest orders first
+		Returns:
+			tuple: the orders of the page and the cursor of the next page,
+				which is None on the last page
+		"""
+		keys = (cls.create_time, cls.id) if by_create_time else (cls.id,)
+		if cursor is not None:
+			values = decode_cursor(cursor, len(keys))
+			if descending:
+				query = query.filter(tuple_(*keys) < tuple_(*values))
+			else:
+				query = query.filter(tuple_(*keys) > tuple_(*values))
+		order_by = [key.desc() for key in keys] if descending else keys
+		orders = query.order_by(None).order_by(*order_by).limit(limit + 1).all()
+		if len(orders) <= limit:
+			return orders, None
+		orders = orders[:limit]
+		last = orders[-1]
+		values = [last.create_time, last.id] if by_create_time else [last.id]
+		return orders, encode_cursor(values)
+
+	@classmethod
+	def export(cls, batch_size=1000):
+		"""Streams every order with the ids of its items
+
+		The orders are joined with their items in a single query read through
+		a server-side cursor, batch_size rows at a time, and plain rows are
+		selected so no ORM objects pile up in the session.
+
+		Yields:
+			dict: a serialized order with an "items" list of item ids
+		"""
+		logger.debug("Processing export of all orders")
+		rows = (
+			db.session.query(cls.id, cls.user_id, cls.create_time, cls.status, Items.item_id)
+			.outerjoin(Items, Items.order_id == cls.id)
+			.order_by(cls.id, Items.id)
+			.execution_options(stream_results=True)
+			.yield_per(batch_size)
+		)
+		for order_id, group in groupby(rows, key=lambda row: row.id):
+			first = next(group)
+			item_ids = [] if first.item_id is None else [first.item_id]
+			item_ids.extend(row.item_id for row in group)
+			yield {
+				"id": order_id,
+				"user_id": first.user_id,
+				"create_time": first.create_time,
+				"status": int(first.status),
+				"items": item_ids,
+			}
+
 	@classmethod
 	def find_by_user_id(cls, user_id):
 		"""Returns all YourResourceModels with the given name
@@ -137,7 +533,7 @@ class Order(db.Model):
 		Args:
 			name (string): the name of the YourResourceModels you want to match
 		"""
-		logger.info("Processing name query for %s ...", user_id)
+		logger.debug("Processing name query for %s ...", user_id)
 		return cls.query.filter(cls.user_id == user_id)
 
 	@classmethod
@@ -147,13 +543,59 @@ class Order(db.Model):
 		Args:
 			name (string): the name of the YourResourceModels you want to match
 		"""
-		logger.info("Processing lookup for orders with create time %s ...", create_time)
+		logger.debug("Processing lookup for orders with create time %s ...", create_time)
 		return cls.query.filter(cls.create_time == create_time)
 
+	@classmethod
+	def created_between(cls, query, create_time_from=None, create_time_to=None):
+		"""Keeps the orders of query created in [create_time_from, create_time_to)
+
+		Either bound may be None for an open range; a range ending before it
+		starts raises a DataValidationError.
+		"""
+		return query.filter(*time_filters(cls.create_time, create_time_from, create_time_to))
+
+	@classmethod
+	def search(
+		cls, user_id=None, statuses=None, item_ids=None, all_items=False,
+		create_time=None, create_time_from=None, create_time_to=None,
+	):
+		"""Composes any combination of filters into a single query of orders
+
+		Args:
+			user_id (int): only the orders of this user
+			statuses (list): only the orders in one of these statuses
+			item_ids (list): only the orders containing any of these items, or
+				all of them when all_items is set
+			create_time (int): only the orders created at exactly this time
+			create_time_from, create_time_to (int): only the orders created in
+				[create_time_from, create_time_to)
+		"""
+		filters = []
+		if user_id is not None:
+			filters.append(cls.user_id == user_id)
+		if statuses:
+			try:
+				statuses = sorted({Status(status) for status in statuses})
+			except ValueError as error:
+				raise DataValidationError(str(error)) from error
+			filters.append(cls.status.in_(statuses))
+		if create_time is not None:
+			filters.append(cls.create_time == create_time)
+		if item_ids:
+			item_ids = sorted(set(item_ids))
+			logger.debug("Processing search for orders containing items %s ...", item_ids)
+			order_ids = db.session.query(Items.order_id).filter(Items.item_id.in_(item_ids))
+			if all_items and len(item_ids) > 1:
+				order_ids = order_ids.group_by(Items.order_id) \
+					.having(db.func.count(db.distinct(Items.item_id)) == len(item_ids))
+			filters.append(cls.id.in_(order_ids))
+		return cls.created_between(cls.query.filter(*filters), create_time_from, create_time_to)
+
 	@classmethod
 	def find_by_status(cls, user_id, status):
 		"""Find all orders with the given status"""
-		logger.info("Processing find all orders with the given status: %s", status)
+		logger.debug("Processing find all orders with the given status: %s", status)
 		return cls.query.filter(cls.user_id == user_id, cls.status == Status(status))
 
 
@@ -165,11 +607,18 @@ class Items(db.Model):
 	item_id:int
 	"""
 	__tablename__ = "items"
+	__table_args__ = (
+		db.Index("ix_items_order_id_item_id", "order_id", "item_id"),
+		db.Index("ix_items_item_id_order_id", "item_id", "order_id"),
+	)
 	app = None
 
 	# Table Schema
 	id = db.Column(db.Integer, primary_key=True)
-	order_id = db.Column(db.Integer, ForeignKey("order.id", ondelete="CASCADE"), nullable=False)
+	# active_history keeps the previous order_id so update() can drop both cached orders
+	order_id = db.column_property(
+		db.Column(db.Integer, ForeignKey("order.id", ondelete="CASCADE"), nullable=False),
+		active_history=True)
 	item_id = db.Column(db.Integer, nullable=False)
 
 	def __repr__(self):
@@ -179,23 +628,33 @@ class Items(db.Model):
 		"""
 		Creates a YourResourceModel to the database
 		"""
-		logger.info("Creating %s", self.id)
+		logger.debug("Creating %s", self.id)
 		self.id = None  # id must be none to generate next primary key
+		order_id = self.order_id
 		db.session.add(self)
+		Order.touch(order_id)
 		db.session.commit()
+		order_cache.invalidate(order_id)
 
 	def update(self):
 		"""
 		Updates a YourResourceModel to the database
 		"""
-		logger.info("Saving %s %s %s", self.id, self.order_id, self.item_id)
+		logger.debug("Saving %s %s %s", self.id, self.order_id, self.item_id)
+		history = inspect(self).attrs.order_id.history
+		order_ids = set(history.deleted) | {self.order_id}
+		Order.touch(*order_ids)
 		db.session.commit()
+		order_cache.invalidate(*order_ids)
 
 	def delete(self):
 		""" Removes a YourResourceModel from the data store """
-		logger.info("Deleting %s", self.id)
+		logger.debug("Deleting %s", self.id)
+		order_id = self.order_id
 		db.session.delete(self)
+		Order.touch(order_id)
 		db.session.commit()
+		order_cache.invalidate(order_id)
 
 	def serialize(self):
 		""" Serializes a YourResourceModel into a dictionary """
@@ -229,26 +688,43 @@ class Items(db.Model):
 			) from error
 		return self
 
+	@staticmethod
+	def deserialize_item_ids(data):
+		"""
+		Deserializes the list of item ids sent along with an order
+
+		Args:
+			data (list): item ids, either ints or numeric strings
+		"""
+		if data is None:
+			return []
+		if not isinstance(data, list):
+			raise DataValidationError(
+				"Invalid type for list [items]: " + str(type(data))
+			)
+		try:
+			return [int(item_id) for item_id in data]
+		except (TypeError, ValueError) as error:
+			raise DataValidationError(
+				"Invalid type for int [items]: " + str(data)
+			) from error
+
 	@classmethod
 	def init_db(cls, app: Flask):
-		""" Initializes the database session """
-		logger.info("Initializing database")
+		""" Initializes the database session, see Order.init_db() """
+		Order.init_db(app)
 		cls.app = app
-		# This is where we initialize SQLAlchemy from the Flask app
-		db.init_app(app)
-		app.app_context().push()
-		db.create_all()  # make our sqlalchemy tables
 
 	@classmethod
 	def all(cls):
 		""" Returns all of the YourResourceModels in the database """
-		logger.info("Processing all YourResourceModels")
+		logger.debug("Processing all YourResourceModels")
 		return cls.query.all()
 
 	@classmethod
 	def find(cls, by_id):
 		""" Finds a YourResourceModel by it's ID """
-		logger.info("Processing lookup for id %s ...", by_id)
+		logger.debug("Processing lookup for id %s ...", by_id)
 		return cls.query.get(by_id)
 
 	@classmethod
@@ -256,7 +732,7 @@ class Items(db.Model):
 		"""
 		Find all items with order_id
 		"""
-		logger.info("Processing order_id of item query for %s ...", order_id)
+		logger.debug("Processing order_id of item query for %s ...", order_id)
 		return cls.query.filter(cls.order_id == order_id)
 
 	@classmethod
@@ -264,5 +740,372 @@ class Items(db.Model):
 		"""
 		Find all order contains item
 		"""
-		logger.info("Processing order query by item for %s ...", item_id)
+		logger.debug("Processing order query by item for %s ...", item_id)
 		return cls.query.filter(cls.item_id == item_id)
+
+	@classmethod
+	def rows(cls, query):
+		"""Selects only the columns of the items of a query, as plain rows"""
+		return query.with_entities(cls.id, cls.order_id, cls.item_id)
+
+	@staticmethod
+	def serialize_rows(rows):
+		""" Serializes the rows of Items.rows() like serialize() """
+		return [{"id": row_id, "order_id": order_id, "item_id": item_id} for row_id, order_id, item_id in rows]
+
+	@classmethod
+	def order_items_statement(cls, order_id):
+		"""SELECT of the columns of the items of an order, for any session"""
+		return db.select(cls.id, cls.order_id, cls.item_id).where(cls.order_id == order_id).order_by(cls.id)
+
+	@classmethod
+	def find_rows_by_order_id(cls, order_id):
+		"""Reads the items of an order as plain rows"""
+		logger.debug("Processing order_id of item rows query for %s ...", order_id)
+		return db.session.execute(cls.order_items_statement(order_id))
+
+	@classmethod
+	def find_by_order_and_item(cls, order_id, item_id):
+		"""
+		Find the rows of an item in an order
+		"""
+		logger.debug("Processing lookup for item %s in order %s ...", item_id, order_id)
+		return cls.query.filter(cls.order_id == order_id, cls.item_id == item_id).order_by(cls.id)
+
+	@staticmethod
+	def _diff_item_ids(rows, item_ids):
+		"""
+		Diffs the (row id, item id) rows of an order against item_ids as multisets
+
+		Returns:
+			tuple: the kept item ids, the ids of the rows to delete, their item
+				ids and the item ids to add
+		"""
+		wanted = Counter(item_ids)
+		kept, removed_rows, removed = [], [], []
+		for row_id, item_id in rows:
+			if wanted[item_id]:
+				wanted[item_id] -= 1
+				kept.append(item_id)
+			else:
+				removed_rows.append(row_id)
+				removed.append(item_id)
+		added = []
+		for item_id in item_ids:
+			if wanted[item_id]:
+				wanted[item_id] -= 1
+				added.append(item_id)
+		return kept, removed_rows, removed, added
+
+	@classmethod
+	def replace_for_order(cls, order_id, item_ids):
+		"""
+		Makes the items of an order match item_ids in one transaction
+
+		The order and its current rows are read with one SELECT, which locks
+		the order so concurrent replacements apply one after the other. The
+		rows are diffed against item_ids as multisets, so unchanged rows are
+		kept, and the difference is applied with at most one DELETE and one
+		executemany INSERT, followed by the bump of the order version.
+
+		Returns:
+			dict: the "items" of the order afterwards with the "added" item ids
+				and the "removed" item ids, or None when the order does not exist
+		"""
+		logger.debug("Replacing the items of order %s", order_id)
+		try:
+			rows = db.session.query(Order.id, cls.id, cls.item_id) \
+				.outerjoin(cls, cls.order_id == Order.id) \
+				.filter(Order.id == order_id).order_by(cls.id) \
+				.with_for_update(of=Order).all()
+			if not rows:
+				db.session.rollback()
+				return None
+			kept, removed_rows, removed, added = cls._diff_item_ids(
+				[(row_id, item_id) for _, row_id, item_id in rows if row_id is not None], item_ids)
+			if removed_rows:
+				cls.query.filter(cls.id.in_(removed_rows)).delete(synchronize_session=False)
+			if added:
+				db.session.execute(
+					cls.__table__.insert(), [{"order_id": order_id, "item_id": item_id} for item_id in added])
+			if removed_rows or added:
+				Order.touch(order_id)
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+		order_cache.invalidate(order_id)
+		return {"items": kept + added, "added": added, "removed": removed}
+
+	@classmethod
+	def delete_by_order_and_item(cls, order_id, item_id):
+		"""
+		Removes every row of an item in an order with a single DELETE
+
+		Returns:
+			int: the number of rows deleted
+		"""
+		logger.debug("Deleting item %s from order %s", item_id, order_id)
+		count = cls.query.filter(cls.order_id == order_id, cls.item_id == item_id) \
+			.delete(synchronize_session=False)
+		if count:
+			Order.touch(order_id)
+		db.session.commit()
+		order_cache.invalidate(order_id)
+		return count
+
+
+class OrderStats(db.Model):
+	"""
+	Class that represents the materialized daily summary of the orders
+	kind: str    "status", "user" or "item"
+	day: int     start of the UTC day of the orders
+	key: int     the status value, user id or item id
+	count: int   the number of orders, or of item rows for "item"
+	"""
+	__tablename__ = "order_stats"
+
+	# Table Schema
+	kind = db.Column(db.String(8), primary_key=True)
+	# BIGINT like Order.create_time
+	day = db.Column(db.BigInteger, primary_key=True)
+	key = db.Column(db.Integer, primary_key=True)
+	count = db.Column(db.Integer, nullable=False)
+
+	@staticmethod
+	def _bucket_start(bucket):
+		"""The start of the create_time bucket of an order, rendered inline so GROUP BY matches it"""
+		return Order.create_time - Order.create_time % db.literal_column(str(int(bucket)))
+
+	@classmethod
+	def compute(cls, create_time_from=None, create_time_to=None, bucket=DAY_SECONDS, top=10):
+		"""Aggregates the orders created in [create_time_from, create_time_to) with GROUP BY
+
+		Args:
+			bucket (int): width in seconds of the create_time buckets
+			top (int): how many users and items to return
+		"""
+		logger.debug("Processing order statistics from %s to %s", create_time_from, create_time_to)
+		filters = time_filters(Order.create_time, create_time_from, create_time_to)
+		count = db.func.count(Order.id)
+		start = cls._bucket_start(bucket)
+		by_status = db.session.query(Order.status, count).filter(*filters).group_by(Order.status)
+		by_time = db.session.query(start, count).filter(*filters).group_by(start).order_by(start)
+		by_user = db.session.query(Order.user_id, count).filter(*filters) \
+			.group_by(Order.user_id).order_by(count.desc(), Order.user_id).limit(top)
+		item_count = db.func.count(Items.id)
+		top_items = db.session.query(Items.item_id, item_count).join(Order, Order.id == Items.order_id) \
+			.filter(*filters).group_by(Items.item_id).order_by(item_count.desc(), Items.item_id).limit(top)
+		return cls._result(
+			((status.value, orders) for status, orders in by_status), by_time, by_user, top_items, "live")
+
+	@classmethod
+	def summary(cls, create_time_from=None, create_time_to=None, top=10, max_age=None):
+		"""Aggregates the daily summary, so the cost depends on the days and not the orders
+
+		create_time_from and create_time_to should fall on day boundaries. The
+		summary is served as it is; "stale" tells whether it is older than
+		max_age seconds, since only `flask refresh-stats` refreshes it.
+		"""
+		logger.debug("Processing order statistics summary from %s to %s", create_time_from, create_time_to)
+		filters = time_filters(cls.day, create_time_from, create_time_to)
+		total = db.func.sum(cls.count)
+
+		def grouped(kind, column):
+			return db.session.query(column, total).filter(cls.kind == kind, *filters).group_by(column)
+
+		result = cls._result(
+			grouped("status", cls.key),
+			grouped("status", cls.day).order_by(cls.day),
+			grouped("user", cls.key).order_by(total.desc(), cls.key).limit(top),
+			grouped("item", cls.key).order_by(total.desc(), cls.key).limit(top),
+			"summary",
+		)
+		refreshed_at = cls.refreshed_at()
+		result["refreshed_at"] = refreshed_at
+		result["stale"] = max_age is not None and (refreshed_at is None or time.time() - refreshed_at > max_age)
+		return result
+
+	@staticmethod
+	def _result(by_status, by_time, by_user, top_items, source):
+		"""Shapes the rows of the grouped queries into the statistics document"""
+		statuses = {Status(int(status)).name: int(orders) for status, orders in by_status}
+		return {
+			"source": source,
+			"total": sum(statuses.values()),
+			"by_status": statuses,
+			"by_time": [{"start": int(start), "orders": int(orders)} for start, orders in by_time],
+			"by_user": [{"user_id": user_id, "orders": int(orders)} for user_id, orders in by_user],
+			"top_items": [{"item_id": item_id, "count": int(count)} for item_id, count in top_items],
+		}
+
+	@staticmethod
+	def refreshed_at():
+		"""Returns when the summary was last refreshed, or None"""
+		return db.session.query(OrderStatsRefresh.refreshed_at).scalar()
+
+	@classmethod
+	def refresh(cls, now=None):
+		"""Recomputes the whole summary with INSERT ... SELECT in one transaction
+
+		The row of OrderStatsRefresh is locked first, so refreshes started at
+		the same time by cron and by hand run one after the other.
+		"""
+		logger.info("Refreshing the order statistics summary")
+		now = int(time.time()) if now is None else now
+		day = cls._bucket_start(DAY_SECONDS)
+		status = Order.status
+		columns = ["kind", "day", "key", "count"]
+		selects = [
+			db.select(db.literal("status"), day, status, db.func.count(Order.id)).group_by(day, status),
+			db.select(db.literal("user"), day, Order.user_id, db.func.count(Order.id))
+			.group_by(day, Order.user_id),
+			db.select(db.literal("item"), day, Items.item_id, db.func.count(Items.id))
+			.join_from(Items, Order, Order.id == Items.order_id).group_by(day, Items.item_id),
+		]
+		try:
+			marker = OrderStatsRefresh.query.filter_by(id=1).with_for_update().one_or_none()
+			if marker is None:
+				marker = OrderStatsRefresh(id=1, refreshed_at=now)
+				db.session.add(marker)
+			cls.query.delete()
+			for select in selects:
+				db.session.execute(cls.__table__.insert().from_select(columns, select))
+			marker.refreshed_at = now
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+
+
+class OrderStatsRefresh(db.Model):
+	"""
+	Class that represents the single row telling when the summary was refreshed
+	id: int            always 1
+	refreshed_at: int  seconds since the epoch
+	"""
+	__tablename__ = "order_stats_refresh"
+
+	# Table Schema
+	id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	refreshed_at = db.Column(db.BigInteger, nullable=False)
+
+
+class OrderArchive(db.Model):
+	"""
+	Class that represents an archived order, moved out of the order table by archive()
+	archived_at: int   when the order was archived
+	"""
+	__tablename__ = "order_archive"
+
+	# Table Schema, the columns of Order keeping their ids
+	id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	user_id = db.Column(db.Integer, nullable=False)
+	create_time = db.Column(db.BigInteger, nullable=False)
+	status = db.Column(StatusType, nullable=False)
+	version = db.Column(db.Integer, nullable=False)
+	archived_at = db.Column(db.BigInteger, nullable=False)
+
+	@classmethod
+	def with_item_ids_statement(cls, order_id):
+		"""Order.with_item_ids_statement() on the archive tables"""
+		return db.select(cls.id, cls.user_id, cls.create_time, cls.status, cls.version, ItemsArchive.item_id) \
+			.outerjoin(ItemsArchive, ItemsArchive.order_id == cls.id) \
+			.where(cls.id == order_id).order_by(ItemsArchive.id)
+
+	@staticmethod
+	def serialize_with_item_ids(rows):
+		"""Order.serialize_with_item_ids() of an archived order, flagged as "archived" """
+		message = Order.serialize_with_item_ids(rows)
+		if message is not None:
+			message["order"]["archived"] = True
+		return message
+
+	@classmethod
+	def find_with_item_ids(cls, order_id):
+		"""Reads an archived order with the ids of its items in one query"""
+		logger.debug("Processing archive lookup for id %s ...", order_id)
+		return cls.serialize_with_item_ids(db.session.execute(cls.with_item_ids_statement(order_id)))
+
+	@staticmethod
+	def archivable(older_than):
+		"""Filters of the orders in a final status created before older_than"""
+		final = [status for status in Status if not STATUS_TRANSITIONS.get(status)]
+		return [Order.status.in_(final), Order.create_time < older_than]
+
+	@classmethod
+	def archive_batch(cls, older_than, after_id=0, batch_size=1000, now=None):
+		"""
+		Moves one batch of archivable orders and their items into the archive
+
+		The batch is the batch_size lowest ids above after_id, locked with
+		FOR UPDATE SKIP LOCKED where the database supports it so orders
+		being changed are left for a later run. Copying and deleting the
+		batch is one short transaction.
+
+		Returns:
+			list: the sorted ids of the archived orders, empty when done
+		"""
+		now = int(time.time()) if now is None else now
+		try:
+			order_ids = db.session.execute(
+				db.select(Order.id).where(Order.id > after_id, *cls.archivable(older_than))
+				.order_by(Order.id).limit(batch_size).with_for_update(skip_locked=True)
+			).scalars().all()
+			if order_ids:
+				db.session.execute(cls.__table__.insert().from_select(
+					["id", "user_id", "create_time", "status", "version", "archived_at"],
+					db.select(Order.id, Order.user_id, Order.create_time, Order.status, Order.version, db.literal(now))
+					.where(Order.id.in_(order_ids))))
+				db.session.execute(ItemsArchive.__table__.insert().from_select(
+					["id", "order_id", "item_id"],
+					db.select(Items.id, Items.order_id, Items.item_id).where(Items.order_id.in_(order_ids))))
+				Items.query.filter(Items.order_id.in_(order_ids)).delete(synchronize_session=False)
+				Order.query.filter(Order.id.in_(order_ids)).delete(synchronize_session=False)
+			db.session.commit()
+		except Exception:
+			db.session.rollback()
+			raise
+		order_cache.invalidate(*order_ids)
+		return order_ids
+
+	@classmethod
+	def archive(cls, max_age, batch_size=1000, pause=0.0, max_batches=None, now=None):
+		"""
+		Moves the orders in a final status older than max_age seconds into the archive
+
+		The orders are walked in keyset batches of archive_batch(), sleeping
+		pause seconds between batches so other transactions get the tables.
+
+		Returns:
+			dict: the number of "orders" archived and of "batches" run
+		"""
+		now = int(time.time()) if now is None else now
+		logger.info("Archiving the orders older than %s seconds", max_age)
+		archived, batches, after_id = 0, 0, 0
+		while max_batches is None or batches < max_batches:
+			order_ids = cls.archive_batch(now - max_age, after_id, batch_size, now)
+			if not order_ids:
+				break
+			archived += len(order_ids)
+			batches += 1
+			after_id = order_ids[-1]
+			if pause:
+				time.sleep(pause)
+		logger.info("Archived %s orders in %s batches", archived, batches)
+		return {"orders": archived, "batches": batches}
+
+
+class ItemsArchive(db.Model):
+	"""
+	Class that represents the items of an archived order
+	"""
+	__tablename__ = "items_archive"
+	__table_args__ = (
+		db.Index("ix_items_archive_order_id", "order_id"),
+	)
+
+	# Table Schema, the columns of Items keeping their ids
+	id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	order_id = db.Column(db.Integer, nullable=False)
+	item_id = db.Column(db.Integer, nullable=False)
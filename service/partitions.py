@@ -0,0 +1,284 @@
+"""
+Monthly range partitioning of the order and items tables on PostgreSQL
+
+Optional: `flask partitions enable` converts the two tables in one
+transaction, after which "order" is partitioned by RANGE (create_time) and
+items by RANGE (order_create_time), a copy of the create_time of its order,
+with the same monthly bounds. Each month is then a pair of tables,
+order_pYYYY_MM and items_pYYYY_MM, so a time range scan only reads the
+months it covers and an old month leaves both tables with
+`flask partitions detach YYYY-MM` without deleting any row. Rows outside
+every month land in order_default and items_default.
+
+The service keeps inserting items without order_create_time: a trigger on
+items_default looks it up from the order and reinserts the row into the
+right month. Because the original INSERT then returns no row, the app runs
+with ORDER_PARTITIONING set, which turns off INSERT ... RETURNING.
+
+Needs PostgreSQL 13 or later; `flask partitions disable` converts back.
+"""
+import logging
+from datetime import datetime, timezone
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+# how long a command waits for its table locks before giving up; while it
+# waits for an exclusive lock every query of the tables queues behind it
+LOCK_TIMEOUT = "10s"
+
+# the keys of the tables once partitioned: the partition key must be part of them
+ORDER_KEY = "id, create_time"
+ITEMS_KEY = "id, order_create_time"
+
+ROUTE_ITEMS_FUNCTION = """
+CREATE OR REPLACE FUNCTION items_route_by_order() RETURNS trigger AS $$
+BEGIN
+	IF NEW.order_create_time IS NULL THEN
+		SELECT create_time INTO NEW.order_create_time FROM "order" WHERE id = NEW.order_id;
+		IF NOT FOUND THEN
+			RAISE foreign_key_violation USING MESSAGE = format('order %s does not exist', NEW.order_id);
+		END IF;
+		INSERT INTO items VALUES (NEW.*);
+		RETURN NULL;
+	END IF;
+	RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+FOLLOW_ORDER_FUNCTION = """
+CREATE OR REPLACE FUNCTION items_follow_order() RETURNS trigger AS $$
+BEGIN
+	SELECT create_time INTO NEW.order_create_time FROM "order" WHERE id = NEW.order_id;
+	RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+class PartitioningError(Exception):
+	"""Used for a partitioning command that cannot run on this database"""
+
+
+def month_bounds(year, month):
+	"""The [start, end) create_time range of a UTC calendar month"""
+	start = datetime(year, month, 1, tzinfo=timezone.utc)
+	end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+	return int(start.timestamp()), int(end.timestamp())
+
+
+def month_of(create_time):
+	"""The (year, month) of a create_time, in UTC"""
+	moment = datetime.fromtimestamp(create_time, tz=timezone.utc)
+	return moment.year, moment.month
+
+
+def parse_month(month):
+	"""Parses "YYYY-MM" into (year, month)"""
+	try:
+		moment = datetime.strptime(month, "%Y-%m")
+	except ValueError as error:
+		raise PartitioningError(f"Invalid month {month}, expected YYYY-MM") from error
+	return moment.year, moment.month
+
+
+def upcoming_months(months_ahead, now=None):
+	"""The current month and the months_ahead following it"""
+	year, month = month_of(now if now is not None else datetime.now(timezone.utc).timestamp())
+	months = []
+	for _ in range(months_ahead + 1):
+		months.append((year, month))
+		year, month = year + month // 12, month % 12 + 1
+	return months
+
+
+def partition_name(table, year, month):
+	"""The partition of table holding a month, such as order_p2022_12"""
+	return f"{table}_p{year:04d}_{month:02d}"
+
+
+def is_partitioned(connection):
+	"""Tells whether the order table is partitioned"""
+	return connection.execute(text(
+		"SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('\"order\"'))"
+	)).scalar()
+
+
+def _check(connection, partitioned):
+	"""Raises a PartitioningError unless the tables are (or are not) partitioned"""
+	if connection.dialect.name != "postgresql":
+		raise PartitioningError("Partitioning needs PostgreSQL, not " + connection.dialect.name)
+	if is_partitioned(connection) != partitioned:
+		raise PartitioningError("The order table is " + ("not " if partitioned else "already ") + "partitioned")
+	connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+
+
+def _create_month(connection, year, month, parent="{}"):
+	"""Creates the order and items partitions of a month, parent formats the parent table names"""
+	start, end = month_bounds(year, month)
+	for table in ("order", "items"):
+		connection.execute(text(
+			f'CREATE TABLE "{partition_name(table, year, month)}" PARTITION OF "{parent.format(table)}" '
+			f"FOR VALUES FROM ({start}) TO ({end})"
+		))
+
+
+def _existing_months(connection):
+	"""The months with an order partition"""
+	names = connection.execute(text(
+		"SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = '\"order\"'::regclass"
+	)).scalars()
+	months = set()
+	for name in names:
+		name = name.strip('"')
+		if name.startswith("order_p"):
+			year, month = name[len("order_p"):].split("_")
+			months.add((int(year), int(month)))
+	return months
+
+
+def create_months(connection, months_ahead=3, now=None):
+	"""Creates the partitions of the current month and the next months_ahead ones
+
+	Run it at least monthly (from cron), so new orders never fall in the
+	default partitions. Returns the months created.
+	"""
+	_check(connection, True)
+	created = []
+	existing = _existing_months(connection)
+	for year, month in upcoming_months(months_ahead, now):
+		if (year, month) not in existing:
+			_create_month(connection, year, month)
+			created.append((year, month))
+	logger.info("Created the partitions of %s months", len(created))
+	return created
+
+
+def _index_and_key(connection, partitioned):
+	"""Adds the keys and indexes of the model to the new order and items tables"""
+	# pylint: disable=import-outside-toplevel
+	from service.models import Order, Items
+	order_key, items_key = (ORDER_KEY, ITEMS_KEY) if partitioned else ("id", "id")
+	connection.execute(text(f'ALTER TABLE "order" ADD CONSTRAINT order_pkey PRIMARY KEY ({order_key})'))
+	connection.execute(text(f"ALTER TABLE items ADD CONSTRAINT items_pkey PRIMARY KEY ({items_key})"))
+	if partitioned:
+		foreign_key = "(order_id, order_create_time) REFERENCES \"order\" (id, create_time) " \
+			"ON DELETE CASCADE ON UPDATE CASCADE"
+	else:
+		foreign_key = '(order_id) REFERENCES "order" (id) ON DELETE CASCADE'
+	connection.execute(text(f"ALTER TABLE items ADD CONSTRAINT items_order_id_fkey FOREIGN KEY {foreign_key}"))
+	for index in list(Order.__table__.indexes) + list(Items.__table__.indexes):
+		index.create(connection)
+	for table in ("order", "items"):
+		connection.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY \"{table}\".id"))
+
+
+def _replace_tables(connection):
+	"""Swaps order_new and items_new in for the order and items tables"""
+	for table in ("order", "items"):
+		connection.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE"))
+	connection.execute(text("DROP TABLE items"))
+	connection.execute(text('DROP TABLE "order"'))
+	for table in ("order", "items"):
+		connection.execute(text(f'ALTER TABLE {table}_new RENAME TO "{table}"'))
+
+
+def enable(connection, months_ahead=3, now=None):
+	"""Converts order and items into monthly partitioned tables, keeping every row
+
+	One partition is created per month holding orders, plus the upcoming
+	months; the tables are locked until the transaction of connection ends.
+	"""
+	_check(connection, False)
+	connection.execute(text('LOCK TABLE "order", items IN ACCESS EXCLUSIVE MODE'))
+	months = {
+		(int(year), int(month)) for year, month in connection.execute(text(
+			"SELECT DISTINCT EXTRACT(YEAR FROM moment), EXTRACT(MONTH FROM moment) "
+			"FROM (SELECT to_timestamp(create_time) AT TIME ZONE 'UTC' AS moment FROM \"order\") AS orders"
+		))
+	}
+	months.update(upcoming_months(months_ahead, now))
+	logger.info("Partitioning the order and items tables into %s months", len(months))
+	connection.execute(text(
+		'CREATE TABLE order_new (LIKE "order" INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+		"PARTITION BY RANGE (create_time)"
+	))
+	connection.execute(text(
+		"CREATE TABLE items_new (LIKE items INCLUDING DEFAULTS INCLUDING CONSTRAINTS, "
+		"order_create_time BIGINT) PARTITION BY RANGE (order_create_time)"
+	))
+	for table in ("order", "items"):
+		connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table}_new DEFAULT"))
+	for year, month in sorted(months):
+		_create_month(connection, year, month, "{}_new")
+	connection.execute(text("INSERT INTO order_new SELECT * FROM \"order\""))
+	connection.execute(text(
+		"INSERT INTO items_new SELECT items.*, \"order\".create_time FROM items "
+		"JOIN \"order\" ON \"order\".id = items.order_id"
+	))
+	_replace_tables(connection)
+	_index_and_key(connection, True)
+	connection.execute(text(ROUTE_ITEMS_FUNCTION))
+	connection.execute(text(
+		"CREATE TRIGGER items_route_by_order BEFORE INSERT ON items_default "
+		"FOR EACH ROW EXECUTE FUNCTION items_route_by_order()"
+	))
+	connection.execute(text(FOLLOW_ORDER_FUNCTION))
+	connection.execute(text(
+		"CREATE TRIGGER items_follow_order BEFORE UPDATE OF order_id ON items "
+		"FOR EACH ROW WHEN (OLD.order_id IS DISTINCT FROM NEW.order_id) EXECUTE FUNCTION items_follow_order()"
+	))
+	# autovacuum never analyzes partitioned tables, only their partitions
+	connection.execute(text('ANALYZE "order", items'))
+	return sorted(months)
+
+
+def disable(connection):
+	"""Converts order and items back into plain tables, keeping every attached row"""
+	_check(connection, True)
+	logger.info("Merging the partitions of the order and items tables")
+	connection.execute(text('LOCK TABLE "order", items IN ACCESS EXCLUSIVE MODE'))
+	connection.execute(text('CREATE TABLE order_new (LIKE "order" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+	connection.execute(text("CREATE TABLE items_new (LIKE items INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+	connection.execute(text("ALTER TABLE items_new DROP COLUMN order_create_time"))
+	connection.execute(text("INSERT INTO order_new SELECT * FROM \"order\""))
+	connection.execute(text("INSERT INTO items_new SELECT id, order_id, item_id FROM items"))
+	_replace_tables(connection)
+	_index_and_key(connection, False)
+	connection.execute(text("DROP FUNCTION items_route_by_order(), items_follow_order()"))
+
+
+def detach(connection, year, month):
+	"""Detaches the order and items partitions of a month into plain tables
+
+	The rows leave the service but stay in order_pYYYY_MM and items_pYYYY_MM,
+	to be archived and dropped. The items partition goes first, as the
+	foreign key still checks the orders it references.
+
+	Returns:
+		list: the names of the detached tables
+	"""
+	_check(connection, True)
+	if (year, month) not in _existing_months(connection):
+		raise PartitioningError(f"There is no partition for {year:04d}-{month:02d}")
+	items, order = partition_name("items", year, month), partition_name("order", year, month)
+	connection.execute(text(f'ALTER TABLE items DETACH PARTITION "{items}"'))
+	connection.execute(text(f'ALTER TABLE "{items}" DROP CONSTRAINT items_order_id_fkey'))
+	connection.execute(text(f'ALTER TABLE "order" DETACH PARTITION "{order}"'))
+	logger.info("Detached %s and %s", order, items)
+	return [order, items]
+
+
+def describe(connection):
+	"""Lists the partitions of the order table with their bounds and row counts"""
+	_check(connection, True)
+	rows = connection.execute(text(
+		"SELECT child.relname, pg_get_expr(child.relpartbound, child.oid), child.reltuples "
+		"FROM pg_inherits JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+		"WHERE pg_inherits.inhparent = CAST(:parent AS regclass) ORDER BY child.relname"
+	), {"parent": '"order"'})
+	return [
+		{"partition": name, "bounds": bounds, "estimated_rows": max(int(tuples), 0)}
+		for name, bounds, tuples in rows
+	]
@@ -3,37 +3,73 @@ My Service
 
 Describe what your service does here
 """
+import hashlib
 import logging
 import secrets
-from flask import jsonify, request, make_response, abort
+import time
+from urllib.parse import urlencode
+import click
+from flask import Blueprint, Response, current_app, jsonify, request, make_response, abort, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse
+from werkzeug.http import quote_etag
 from .common import status  # HTTP Status Codes
-from service.models import Order, Items, Status
-# Import Flask application
-from . import app
+from .common import json_codec
+from .common.cache import order_cache
+from .common.metrics import service_metrics
+from .common.pool_metrics import pool_status
+from service.models import db, Order, OrderArchive, Items, OrderStats, Status, DAY_SECONDS, order_etag
+from service import partitions
+
+# Routes and commands outside of the REST API, registered by init_app()
+blueprint = Blueprint("service", __name__, cli_group=None)
 
 logger = logging.getLogger("flask.app")
 
+# Largest number of users and items GET /orders/stats returns
+STATS_TOP_MAX = 100
+
+# Sort orders of GET /orders, a leading - puts the newest orders first
+ORDER_SORTS = ("create_time", "-create_time", "id", "-id")
+
 ############################################################
 # Health Endpoint
 ############################################################
 
 
-@app.route("/health")
+@blueprint.route("/health")
 def health():
 	"""Health Status"""
 	return jsonify(dict(status="OK")), status.HTTP_200_OK
 
 
+@blueprint.route("/health/pool")
+def pool_health():
+	"""Database connection pool usage and checkout wait statistics"""
+	return jsonify(pool_status(db.engine)), status.HTTP_200_OK
+
+
+@blueprint.route("/health/cache")
+def cache_health():
+	"""Order cache hit and miss counters"""
+	return jsonify(order_cache.stats()), status.HTTP_200_OK
+
+
+@blueprint.route("/metrics")
+def metrics():
+	"""Prometheus metrics of every worker"""
+	body, content_type = service_metrics.render()
+	return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
 
 
-@app.route("/", methods=["GET"])
+@blueprint.route("/", methods=["GET"])
 def index():
 	""" Root URL response """
-	return app.send_static_file("index.html")
+	return current_app.send_static_file("index.html")
 
 
 ######################################################################
@@ -42,7 +78,6 @@ def index():
 
 
 api = Api(
-	app,
 	version='1.0.0',
 	title='orders REST API Service',
 	description='This is a server for orders.',
@@ -50,6 +85,7 @@ api = Api(
 	default_label='orders operations',
 	doc='/apidocs',  # default also could use doc='/apidocs/'
 )
+api.representation('application/json')(json_codec.output_json)
 
 
 ######################################################################
@@ -72,27 +108,80 @@ order_model = api.inherit(
 	{
 		'id': fields.Integer(
 			readOnly=True,
-			description='The unique id assigned internally by service')
+			description='The unique id assigned internally by service'),
+		# read the key explicitly, a plain lookup would find dict.items
+		'items': fields.List(
+			fields.Integer, readOnly=True, attribute=lambda order: order.get('items'),
+			description='The ids of the items in the order, only with expand=items'),
 	}
 )
 
-order_args = reqparse.RequestParser()
+selection_model = api.model('OrderSelection', {
+	'ids': fields.List(fields.Integer, required=False, description='The ids of the orders'),
+	'user_id': fields.Integer(required=False, description='Only orders of this user'),
+	'status': fields.Integer(required=False, description='Only orders in this status'),
+	'create_time_from': fields.Integer(required=False, description='Only orders created at or after this time'),
+	'create_time_to': fields.Integer(required=False, description='Only orders created before this time'),
+})
+
+transition_model = api.inherit('OrderTransition', selection_model, {
+	'new_status': fields.Integer(required=True, description='The status the orders move to'),
+})
+
+page_args = reqparse.RequestParser()
+page_args.add_argument(
+	'limit', type=int, location='args',
+	required=False, help='Maximum number of orders in the page')
+page_args.add_argument(
+	'cursor', type=str, location='args',
+	required=False, help='The next_cursor returned with the previous page')
+page_args.add_argument(
+	'expand', type=str, choices=('items',), location='args',
+	required=False, help='Embed the item ids of every order with expand=items')
+
+order_args = page_args.copy()
 order_args.add_argument(
 	'user_id', type=int, location='args',
 	required=False, help='List Orders by user_id')
 order_args.add_argument(
-	'status', type=int, location='args',
-	required=False, help='List Orders by status')
+	'status', type=int, action='append', location='args',
+	required=False, help='List Orders in any of these statuses, repeat it for several')
 order_args.add_argument(
 	'create_time', type=int,
-	location='args', required=False, help='List Orders by create_time')
+	location='args', required=False, help='List Orders created at exactly this time')
+order_args.add_argument(
+	'create_time_from', type=int, location='args',
+	required=False, help='Only list orders created at or after this time')
+order_args.add_argument(
+	'create_time_to', type=int, location='args',
+	required=False, help='Only list orders created before this time')
 order_args.add_argument(
-	'item_id', type=int,
-	location='args', required=False, help='List Orders by item_id')
+	'item_id', type=int, action='append',
+	location='args', required=False, help='List Orders containing these items, repeat it for several')
+order_args.add_argument(
+	'item_match', type=str, choices=('any', 'all'), default='any', location='args',
+	required=False, help='Whether orders must contain any or all of the item_id values')
+order_args.add_argument(
+	'sort', type=str, choices=ORDER_SORTS, default='create_time', location='args',
+	required=False, help='Sort by create_time or id, prefixed with - for the newest first')
 order_args.add_argument(
 	'items', type=list,
 	location='args', required=False, help='Create Order with items')
 
+stats_args = reqparse.RequestParser()
+stats_args.add_argument(
+	'create_time_from', type=int, location='args',
+	required=False, help='Only count orders created at or after this time')
+stats_args.add_argument(
+	'create_time_to', type=int, location='args',
+	required=False, help='Only count orders created before this time')
+stats_args.add_argument(
+	'bucket', type=int, location='args', default=DAY_SECONDS,
+	required=False, help='Width in seconds of the create_time buckets')
+stats_args.add_argument(
+	'top', type=int, location='args', default=10,
+	required=False, help='How many users and items to return')
+
 
 @api.route("/orders")
 class OrderResource(Resource):
@@ -108,11 +197,15 @@ class OrderResource(Resource):
 
 		Keyword arguments:
 		user_id -- the unique id representing a user (required)
-		status -- the status to filter the orders (optional)
-		item_id -- item id to filter the orders (optional)
+		status -- the statuses to filter the orders, repeated (optional)
+		item_id -- the item ids to filter the orders, repeated (optional)
+		item_match -- "any" or "all" of the item ids (optional)
+		create_time -- only the orders created at this time (optional)
+		create_time_from, create_time_to -- only the orders created in [from, to) (optional)
+		sort -- create_time, -create_time, id or -id (optional)
 		Return: all related orders owned by user with user_id
 		"""
-		app.logger.info("Request listing orders")
+		current_app.logger.debug("Request listing orders")
 		args = order_args.parse_args()
 		user_id = args["user_id"]
 		if user_id is None:
@@ -121,34 +214,22 @@ class OrderResource(Resource):
 				description="Unauthorized user for unknown user_id.",
 			)
 
-		st = args["status"]
-		if st is not None:
-			if st != Status.CREATED.value and \
-				st != Status.COMPLETED.value and \
-				st != Status.CANCELLED.value:
+		statuses = args["status"]
+		for st in statuses or ():
+			if st not in Status.__members__.values():
 				return f"Invalid Status {st}", status.HTTP_400_BAD_REQUEST
-
-			orders = Order.find_by_status(user_id, st)
-			if orders.count():
-				order_list = [order.serialize() for order in orders]
-				return order_list, status.HTTP_200_OK
-			else:
-				return "", status.HTTP_204_NO_CONTENT
-
-		item_id = args["item_id"]
-		if item_id is not None:
-			items = Items.find_by_item_id(item_id)
-			if items.count():
-				orders = []
-				for item in items:
-					order = Order.find(by_id=item.order_id)
-					orders.append(order.serialize())
-				return orders, status.HTTP_200_OK
-			else:
-				return "", status.HTTP_204_NO_CONTENT
-
-		orders = Order.find_by_user_id(user_id)
-		return [order.serialize() for order in orders], status.HTTP_200_OK
+		item_ids = args["item_id"]
+		query = Order.search(
+			user_id, statuses, item_ids, all_items=args["item_match"] == "all",
+			create_time=args["create_time"],
+			create_time_from=args["create_time_from"], create_time_to=args["create_time_to"])
+
+		sort = args["sort"]
+		orders, headers = paginate(
+			query, args, by_create_time=sort.lstrip("-") == "create_time", descending=sort.startswith("-"))
+		if not orders and (statuses or item_ids):
+			return "", status.HTTP_204_NO_CONTENT
+		return list_response(orders, args, headers)
 
 	@api.doc('create_order')
 	@api.expect(create_model)
@@ -160,30 +241,44 @@ class OrderResource(Resource):
 		}
 		"""
 		json_data = api.payload
-		app.logger.info("Request create an order")
+		current_app.logger.debug("Request create an order")
 		# check_content_type("application/json")
-		order = Order()
-		order.deserialize(json_data)
-		order.create()
+		order, item_ids = Order.create_bulk([json_data])[0]
 		# return a message
 		message = order.serialize()
-		message["items"] = []
-
-		if json_data is not None:
-			if json_data.get("items") is not None and isinstance(json_data["items"], list):
-				for item_id in json_data.get("items"):
-					items = Items()
-					items.order_id = order.id
-					items.item_id = item_id
-					items.create()
-					message["items"].append(item_id)
+		message["items"] = item_ids
 
 		location_url = api.url_for(
 			OrderSingleResource, order_id=order.id, _external=True)
 		return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
-# @app.route("/orders", methods=["GET"])
+@api.route("/orders/bulk")
+class BulkOrderResource(Resource):
+	"""BulkOrderResource class
+	"""
+	@api.doc('create_orders_in_bulk')
+	@api.expect([create_model])
+	@api.response(400, 'Invalid data, nothing was created')
+	@api.response(201, 'Orders created')
+	def post(self):
+		"""Create many orders in a single transaction
+		request body: [
+				{"user_id": 1, "create_time": 0, "status": 1, "items": [id1, id2, ...]},
+				...
+		]
+		"""
+		current_app.logger.debug("Request create orders in bulk")
+		created = Order.create_bulk(api.payload)
+		messages = []
+		for order, item_ids in created:
+			message = order.serialize()
+			message["items"] = item_ids
+			messages.append(message)
+		return messages, status.HTTP_201_CREATED
+
+
+# @blueprint.route("/orders", methods=["GET"])
 # def list_orders():
 #     """List all orders
 
@@ -194,7 +289,7 @@ class OrderResource(Resource):
 #     Return: all related orders owned by user with user_id
 #     """
 
-#     app.logger.info("Request listing orders")
+#     current_app.logger.info("Request listing orders")
 #     args = request.args
 #     user_id = args.get("user_id", type=int)
 #     if user_id is None:
@@ -236,7 +331,7 @@ class OrderResource(Resource):
 #     )
 
 
-# @app.route("/orders", methods=["POST"])
+# @blueprint.route("/orders", methods=["POST"])
 # def create_order():
 #     """Create an order
 #     request body: {
@@ -244,7 +339,7 @@ class OrderResource(Resource):
 #     }
 #     """
 #     json_data = request.get_json()
-#     app.logger.info("Request create an order")
+#     current_app.logger.info("Request create an order")
 #     check_content_type("application/json")
 #     order = Order()
 #     order.deserialize(json_data)
@@ -272,18 +367,61 @@ class AllOrderResource(Resource):
 	"""AllOrderResource class
 	"""
 	@api.doc('get_all_orders')
-	@api.marshal_list_with(order_model)
+	@api.expect(page_args)
+	@api.response(200, 'Success', [order_model])
 	def get(self):
 		"""List all orders
 		"""
-		app.logger.info("List all order in the database")
-		orders = Order.all()
-		return [order.serialize() for order in orders], status.HTTP_200_OK
+		current_app.logger.debug("List all order in the database")
+		args = page_args.parse_args()
+		orders, headers = paginate(Order.query, args)
+		return serialize_orders(orders, args), status.HTTP_200_OK, headers
+
+
+@api.route("/orders/export")
+class ExportOrderResource(Resource):
+	"""ExportOrderResource class
+	"""
+	@api.doc('export_orders', produces=['application/x-ndjson'])
+	def get(self):
+		"""Export all orders with their items as newline delimited JSON
+		"""
+		current_app.logger.debug("Export all orders in the database")
+
+		def generate():
+			for order in Order.export():
+				yield json_codec.dumps(order) + b"\n"
+
+		return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
-# @app.route("/orders/all", methods=["GET"])
+@api.route("/orders/stats")
+class StatsOrderResource(Resource):
+	"""StatsOrderResource class
+	"""
+	@api.doc('order_stats')
+	@api.expect(stats_args)
+	def get(self):
+		"""Count orders by status, create_time bucket and user, and find the top items
+		"""
+		current_app.logger.debug("Request order statistics")
+		args = stats_args.parse_args()
+		if args["bucket"] < 1 or not 1 <= args["top"] <= STATS_TOP_MAX:
+			abort(status.HTTP_400_BAD_REQUEST, f"bucket must be positive and top between 1 and {STATS_TOP_MAX}")
+		time_range = (args["create_time_from"], args["create_time_to"])
+		# the summary is only refreshed by flask refresh-stats, never by a request
+		if current_app.config["STATS_SUMMARY"] and args["bucket"] == DAY_SECONDS and \
+			all(value is None or value % DAY_SECONDS == 0 for value in time_range) and \
+			OrderStats.refreshed_at() is not None:
+			summary = OrderStats.summary(
+				*time_range, top=args["top"], max_age=current_app.config["STATS_REFRESH_SECONDS"])
+			return summary, status.HTTP_200_OK
+		return OrderStats.compute(*time_range, bucket=args["bucket"], top=args["top"]), status.HTTP_200_OK
+
+
+# @blueprint.route("/orders/all", methods=["GET"])
 # def get_all_order():
-#     app.logger.info("List all order in the database")
+#     current_app.logger.info("List all order in the database")
 #     orders = Order.all()
 #     return make_response(
 #         jsonify([order.serialize() for order in orders]),
@@ -298,31 +436,37 @@ class OrderSingleResource(Resource):
 	"""
 	@api.doc('get_order_by_id')
 	@api.response(404, 'Order not found')
+	@api.response(304, 'Order not modified since the If-None-Match ETag')
 	def get(self, order_id):
 		"""Get order by order id
 		Args:
 				order_id (int): the id of the order
 		"""
-		app.logger.info("Request for pet with id: %s", order_id)
-		order = Order.find(order_id)
-		if not order:
-			abort(
-				status.HTTP_404_NOT_FOUND,
-				f"Order with id '{order_id}' was not found.")
-
-		order_data = order.serialize()
-		order_data["items"] = []
-		items = Items.find_by_order_id(order_id)
-		for item in items:
-			order_data["items"].append(item.item_id)
-
-		app.logger.info("Returning pet: %s", order.id)
+		current_app.logger.debug("Request for pet with id: %s", order_id)
+		cached = order_cache.get(order_id)
+		if cached is not None and order_cache.check_version:
+			cached = order_cache.current(order_id, cached, Order.find_version(order_id))
+		if cached is None:
+			cached = Order.find_with_item_ids(order_id) or OrderArchive.find_with_item_ids(order_id)
+			if cached is None:
+				abort(
+					status.HTTP_404_NOT_FOUND,
+					f"Order with id '{order_id}' was not found.")
+			order_cache.set(order_id, cached)
+
+		etag = order_etag(order_id, cached["version"])
+		headers = {"ETag": quote_etag(etag)}
+		if etag in request.if_none_match:
+			return "", status.HTTP_304_NOT_MODIFIED, headers
+
+		current_app.logger.debug("Returning pet: %s", order_id)
 		# return jsonify(order_data), status.HTTP_200_OK
-		return order_data, status.HTTP_200_OK
+		return cached["order"], status.HTTP_200_OK, headers
 
 	@api.doc('put_order_by_id')
 	@api.response(200, 'Success')
 	@api.response(404, 'Order not found')
+	@api.response(412, 'Order changed since the If-Match ETag')
 	@api.expect(create_model)
 	def put(self, order_id):
 		"""Update order by order id
@@ -332,9 +476,10 @@ class OrderSingleResource(Resource):
 		"""
 		order: Order = Order.find(order_id)
 		if order:
+			check_if_match(order_etag(order.id, order.version))
 			order.deserialize(api.payload)
 			order.update()
-			return "", status.HTTP_200_OK
+			return "", status.HTTP_200_OK, {"ETag": quote_etag(order_etag(order.id, order.version))}
 		else:
 			return "", status.HTTP_404_NOT_FOUND
 
@@ -352,14 +497,14 @@ class OrderSingleResource(Resource):
 		return "", status.HTTP_204_NO_CONTENT
 
 
-# @app.route("/orders/<int:order_id>", methods=["GET"])
+# @blueprint.route("/orders/<int:order_id>", methods=["GET"])
 # def get_order_by_id(order_id):
 #     """Get order by order id
 
 #     Args:
 #             order_id (int): the id of the order
 #     """
-#     app.logger.info("Request for pet with id: %s", order_id)
+#     current_app.logger.info("Request for pet with id: %s", order_id)
 #     order = Order.find(order_id)
 #     if not order:
 #         abort(status.HTTP_404_NOT_FOUND,
@@ -371,12 +516,12 @@ class OrderSingleResource(Resource):
 #     for item in items:
 #         order_data["items"].append(item.item_id)
 
-#     app.logger.info("Returning pet: %s", order.id)
+#     current_app.logger.info("Returning pet: %s", order.id)
 #     # return jsonify(order_data), status.HTTP_200_OK
 #     return make_response(jsonify(order_data), status.HTTP_200_OK)
 
 
-# @app.route("/orders/<int:order_id>", methods=["PUT"])
+# @blueprint.route("/orders/<int:order_id>", methods=["PUT"])
 # def update_order(order_id):
 #     """Update order by order id
 #     TODO: check if target id == json id
@@ -392,7 +537,7 @@ class OrderSingleResource(Resource):
 #         return make_response("", status.HTTP_404_NOT_FOUND)
 
 
-# @app.route("/orders/<int:order_id>", methods=["DELETE"])
+# @blueprint.route("/orders/<int:order_id>", methods=["DELETE"])
 # def delete_order(order_id):
 #     """
 #     Delete order by order id
@@ -411,6 +556,7 @@ class CancelOrderResource(Resource):
 	"""
 	@api.doc('cancel_order_by_id')
 	@api.response(404, 'Order not found')
+	@api.response(412, 'Order changed since the If-Match ETag')
 	def post(self, order_id):
 		"""Cancel an order
 		Args:
@@ -418,13 +564,49 @@ class CancelOrderResource(Resource):
 		"""
 		order = Order.find(order_id)
 		if order:
+			check_if_match(order_etag(order.id, order.version))
 			order.status = Status.CANCELLED
-			order.update()
-			return "", status.HTTP_200_OK
+			order.update()  # also drops the cached order
+			return "", status.HTTP_200_OK, {"ETag": quote_etag(order_etag(order.id, order.version))}
 		else:
 			return "", status.HTTP_404_NOT_FOUND
 
-# @app.route("/orders/<int:order_id>/cancel", methods=["POST"])
+
+@api.route("/orders/cancel")
+class BatchCancelResource(Resource):
+	"""BatchCancelResource class
+	"""
+	@api.doc('cancel_orders')
+	@api.expect(selection_model)
+	@api.response(400, 'Invalid selection or status transition')
+	def post(self):
+		"""Cancel every selected order that is still CREATED with one UPDATE
+		request body: {"ids": [id1, id2, ...]} and/or {"user_id": 1, "create_time_from": 0, ...}
+		"""
+		current_app.logger.debug("Request cancel orders in bulk")
+		check_content_type("application/json")
+		return transition_orders(Status.CANCELLED, api.payload)
+
+
+@api.route("/orders/status")
+class BatchStatusResource(Resource):
+	"""BatchStatusResource class
+	"""
+	@api.doc('change_orders_status')
+	@api.expect(transition_model)
+	@api.response(400, 'Invalid selection or status transition')
+	def post(self):
+		"""Move every selected order to new_status with one UPDATE, where the transition is allowed
+		request body: {"new_status": 2, "ids": [id1, id2, ...]} and/or the filters of /orders/cancel
+		"""
+		current_app.logger.debug("Request change the status of orders in bulk")
+		check_content_type("application/json")
+		if not isinstance(api.payload, dict) or not isinstance(api.payload.get("new_status"), int):
+			abort(status.HTTP_400_BAD_REQUEST, "Invalid type for int [new_status]")
+		return transition_orders(api.payload["new_status"], api.payload)
+
+
+# @blueprint.route("/orders/<int:order_id>/cancel", methods=["POST"])
 # def cancel_order(order_id):
 #     """Cancel an order
 #     Args:
@@ -452,8 +634,7 @@ class ItemResource(Resource):
 		Returns:
 				list[items]: a list of items in that order
 		"""
-		items = Items.find_by_order_id(order_id)
-		return [item.serialize() for item in items], status.HTTP_200_OK
+		return Items.serialize_rows(Items.find_rows_by_order_id(order_id)), status.HTTP_200_OK
 
 	@api.doc('add_item_to_order')
 	@api.response(404, 'Order not found')
@@ -464,7 +645,7 @@ class ItemResource(Resource):
 		Keyword arguments:
 				order_id -- the id of the order
 		"""
-		app.logger.info("Request add an item to order: %s", order_id)
+		current_app.logger.debug("Request add an item to order: %s", order_id)
 		check_content_type("application/json")
 		order = Order.find(order_id)
 		if order:
@@ -478,8 +659,28 @@ class ItemResource(Resource):
 			message = "order not found"
 			return message, status.HTTP_404_NOT_FOUND
 
+	@api.doc('replace_items_of_order')
+	@api.response(404, 'Order not found')
+	@api.response(400, 'Invalid item ids')
+	def put(self, order_id):
+		"""Replace the items of an order with the given list of item ids
+		request body: [id1, id2, ...]
+		Returns:
+				the items of the order with the added and removed item ids
+		"""
+		current_app.logger.debug("Request replace the items of order: %s", order_id)
+		check_content_type("application/json")
+		if not isinstance(api.payload, list):
+			abort(status.HTTP_400_BAD_REQUEST, "The body must be the list of item ids")
+		item_ids = Items.deserialize_item_ids(api.payload)
+		result = Items.replace_for_order(order_id, item_ids)
+		if result is None:
+			abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+		result["order_id"] = order_id
+		return result, status.HTTP_200_OK
+
 
-# @app.route("/orders/<int:order_id>/items", methods=["GET"])
+# @blueprint.route("/orders/<int:order_id>/items", methods=["GET"])
 # def list_order_items(order_id):
 #     """List order items by order id
 #     Args:
@@ -492,14 +693,14 @@ class ItemResource(Resource):
 #     return make_response(jsonify([item.serialize() for item in items]), status.HTTP_200_OK)
 
 
-# @app.route("/orders/<int:order_id>/items", methods=["POST"])
+# @blueprint.route("/orders/<int:order_id>/items", methods=["POST"])
 # def add_order_item(order_id):
 #     """Add item to order by id
 
 #     Keyword arguments:
 #             order_id -- the id of the order
 #     """
-#     app.logger.info("Request add an item to order: %s", order_id)
+#     current_app.logger.info("Request add an item to order: %s", order_id)
 #     check_content_type("application/json")
 #     order = Order.find(order_id)
 #     if order:
@@ -528,15 +729,11 @@ class SingleItemResource(Resource):
 				order_id (int): the id of the order
 				item_id (int): the id of the order
 		"""
-		order = Order.find(order_id)
-		if order:
-			items = Items.find_by_order_id(order_id)
-			for item in items:
-				if item.item_id == item_id:
-					return "item exist in order", status.HTTP_200_OK
-			return "item not exist in order", status.HTTP_204_NO_CONTENT
+		item = Items.rows(Items.find_by_order_and_item(order_id, item_id)).first()
+		if item:
+			return "item exist in order", status.HTTP_200_OK
 		else:
-			return "", status.HTTP_204_NO_CONTENT
+			return "item not exist in order", status.HTTP_204_NO_CONTENT
 
 	@api.doc('update_item_in_order')
 	@api.response(200, "Success")
@@ -548,15 +745,11 @@ class SingleItemResource(Resource):
 				order_id (int): the id of the order
 				item_id (int): the id of the order
 		"""
-		order: Order = Order.find(order_id)
-		if order:
-			items = Items.find_by_order_id(order_id)
-			for item in items:
-				if item.item_id == item_id:
-					item.deserialize(api.payload)
-					item.update()
-					return make_response("", status.HTTP_200_OK)
-			return "", status.HTTP_204_NO_CONTENT
+		item = Items.find_by_order_and_item(order_id, item_id).first()
+		if item:
+			item.deserialize(api.payload)
+			item.update()
+			return make_response("", status.HTTP_200_OK)
 		else:
 			return "", status.HTTP_204_NO_CONTENT
 
@@ -569,20 +762,12 @@ class SingleItemResource(Resource):
 				order_id (int): the id of the order
 				item_id (int): the id of the order
 		"""
-		order = Order.find(order_id)
-		if order:
-			app.logger.info("Calling delete item on order %s", order.id)
-			found = Items.find_by_order_id(order_id)
-			for item in found:
-				app.logger.info("try match with item = %s target = %s", item.id, item_id)
-				if item.item_id == item_id:
-					item.delete()
-					app.logger.info("Target Found, deleted item %s", item.id)
-		app.logger.info("Calling delete item finished")
+		count = Items.delete_by_order_and_item(order_id, item_id)
+		current_app.logger.debug("Deleted %s rows of item %s from order %s", count, item_id, order_id)
 		return "", status.HTTP_204_NO_CONTENT
 
 
-# @app.route("/orders/<int:order_id>/items/<int:item_id>", methods=["GET"])
+# @blueprint.route("/orders/<int:order_id>/items/<int:item_id>", methods=["GET"])
 # def get_order_item(order_id, item_id):
 #     """Get items in order
 
@@ -601,7 +786,7 @@ class SingleItemResource(Resource):
 #         return make_response("", status.HTTP_204_NO_CONTENT)
 
 
-# @app.route("/orders/<int:order_id>/items/<int:item_id>", methods=["PUT"])
+# @blueprint.route("/orders/<int:order_id>/items/<int:item_id>", methods=["PUT"])
 # def update_order_item(order_id, item_id):
 #     """Update items in order
 
@@ -622,7 +807,7 @@ class SingleItemResource(Resource):
 #         return make_response("", status.HTTP_204_NO_CONTENT)
 
 
-# @app.route("/orders/<int:order_id>/items/<int:item_id>", methods=["DELETE"])
+# @blueprint.route("/orders/<int:order_id>/items/<int:item_id>", methods=["DELETE"])
 # def delete_order_item(order_id, item_id):
 #     order = Order.find(order_id)
 #     if order:
@@ -638,10 +823,172 @@ class SingleItemResource(Resource):
 ######################################################################
 
 
-def init_db():
-	""" Initializes the SQLAlchemy app """
-	global app
-	Order.init_db(app)
+def init_app(app):
+	""" Registers the routes, the REST API and the commands on the Flask app """
+	app.register_blueprint(blueprint)
+	api.init_app(app)
+
+
+@blueprint.cli.command("create-db")
+def create_db():
+	"""Creates the missing tables, for development; deployments run flask db upgrade"""
+	Order.create_schema()
+
+
+@blueprint.cli.command("refresh-stats")
+@click.option("--every", type=float, default=0, help="Run again every this many seconds, for a long running job")
+def refresh_stats(every):
+	"""Recomputes the order statistics summary, for cron jobs"""
+	while True:
+		OrderStats.refresh()
+		click.echo("Refreshed the order statistics summary")
+		if not every:
+			break
+		time.sleep(every)
+
+
+@blueprint.cli.command("archive-orders")
+@click.option("--older-than-days", type=int, help="Age of the orders to archive [ARCHIVE_AFTER_DAYS]")
+@click.option("--batch-size", type=int, help="Orders per transaction [ARCHIVE_BATCH_SIZE]")
+@click.option("--pause", type=float, help="Seconds between transactions [ARCHIVE_PAUSE_SECONDS]")
+@click.option("--max-batches", type=int, help="Stop after this many transactions")
+@click.option("--every", type=float, default=0, help="Run again every this many seconds, for a long running job")
+def archive_orders(older_than_days, batch_size, pause, max_batches, every):
+	"""Moves the COMPLETED and CANCELLED orders past their age into the archive tables"""
+	config = current_app.config
+	while True:
+		result = OrderArchive.archive(
+			DAY_SECONDS * (config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days),
+			batch_size=config["ARCHIVE_BATCH_SIZE"] if batch_size is None else batch_size,
+			pause=config["ARCHIVE_PAUSE_SECONDS"] if pause is None else pause,
+			max_batches=max_batches)
+		click.echo(f"Archived {result['orders']} orders in {result['batches']} batches")
+		if not every:
+			break
+		time.sleep(every)
+
+
+@blueprint.cli.group("partitions")
+def partitions_cli():
+	"""Monthly partitions of the order and items tables, on PostgreSQL"""
+
+
+def run_partitioning(command, *args):
+	"""Runs a partitioning command in one transaction, failing the CLI on a PartitioningError"""
+	try:
+		with db.engine.begin() as connection:
+			return command(connection, *args)
+	except partitions.PartitioningError as error:
+		raise click.ClickException(str(error)) from error
+
+
+@partitions_cli.command("enable")
+@click.option("--months-ahead", default=3, show_default=True, help="Months to create after the current one")
+def enable_partitions(months_ahead):
+	"""Converts the order and items tables into monthly partitions; set ORDER_PARTITIONING afterwards"""
+	months = run_partitioning(partitions.enable, months_ahead)
+	click.echo(f"Partitioned the order and items tables into {len(months)} months")
+
+
+@partitions_cli.command("create")
+@click.option("--months-ahead", default=3, show_default=True, help="Months to create after the current one")
+def create_partitions(months_ahead):
+	"""Creates the partitions of the upcoming months, for cron jobs"""
+	for year, month in run_partitioning(partitions.create_months, months_ahead):
+		click.echo(f"Created {year:04d}-{month:02d}")
+
+
+@partitions_cli.command("detach")
+@click.argument("month")
+def detach_partition(month):
+	"""Detaches the order and items of a month (YYYY-MM) into standalone tables"""
+	for table in run_partitioning(lambda connection: partitions.detach(connection, *partitions.parse_month(month))):
+		click.echo(f"Detached {table}")
+
+
+@partitions_cli.command("list")
+def list_partitions():
+	"""Lists the partitions of the order table"""
+	for partition in run_partitioning(partitions.describe):
+		click.echo(f"{partition['partition']}\t{partition['bounds']}\t~{partition['estimated_rows']} rows")
+
+
+@partitions_cli.command("disable")
+def disable_partitions():
+	"""Merges the attached partitions back into plain tables; unset ORDER_PARTITIONING afterwards"""
+	run_partitioning(partitions.disable)
+	click.echo("Merged the order and items partitions")
+
+
+def paginate(query, args, by_create_time=False, descending=False):
+	"""Returns one page of an order query and the headers pointing to the next one
+
+	Args:
+		query (Query): the order query to page through
+		args (dict): the parsed request arguments holding limit, cursor and expand
+		by_create_time (bool): sort by (create_time, id) instead of id
+		descending (bool): return the newest orders first
+	"""
+	query = Order.rows(query)
+	limit = args["limit"]
+	if limit is None:
+		limit = current_app.config["PAGE_SIZE_DEFAULT"]
+	if limit < 1:
+		abort(status.HTTP_400_BAD_REQUEST, f"Invalid limit {limit}")
+	limit = min(limit, current_app.config["PAGE_SIZE_MAX"])
+
+	orders, next_cursor = Order.paginate(query, limit, args["cursor"], by_create_time, descending)
+	headers = {}
+	if next_cursor is not None:
+		# keep every value of the repeated filters, like status and item_id
+		params = request.args.to_dict(flat=False)
+		params["cursor"] = [next_cursor]
+		headers["X-Next-Cursor"] = next_cursor
+		headers["Link"] = f'<{request.base_url}?{urlencode(params, doseq=True)}>; rel="next"'
+	return orders, headers
+
+
+def serialize_orders(orders, args):
+	"""Serializes a page of order rows, with their item ids when expand=items"""
+	messages = Order.serialize_rows(orders)
+	if args["expand"] == "items":
+		item_ids = Order.item_ids_by_order([message["id"] for message in messages])
+		for message in messages:
+			message["items"] = item_ids[message["id"]]
+	return messages
+
+
+def list_response(orders, args, headers):
+	"""Returns a page of orders, or 304 when it matches the If-None-Match ETag
+
+	The ETag of a page is derived from the id and version of every order in it.
+	"""
+	versions = ",".join(f"{order.id}:{order.version}" for order in orders)
+	etag = hashlib.sha1(f"{args['expand']}|{versions}".encode()).hexdigest()
+	headers["ETag"] = quote_etag(etag)
+	if etag in request.if_none_match:
+		return "", status.HTTP_304_NOT_MODIFIED, headers
+	return serialize_orders(orders, args), status.HTTP_200_OK, headers
+
+
+def transition_orders(new_status, data):
+	"""Applies a bulk status change and reports which of the selected orders changed"""
+	selection = Order.deserialize_selection(data)
+	changed = Order.transition_bulk(new_status, **selection)
+	result = {"status": int(new_status), "changed": changed}
+	if "ids" in selection:
+		changed_ids = set(changed)
+		result["unchanged"] = sorted(set(selection["ids"]) - changed_ids)
+	return result, status.HTTP_200_OK
+
+
+def check_if_match(etag):
+	"""Aborts with 412 when an If-Match header does not match the current ETag"""
+	if request.if_match and etag not in request.if_match:
+		abort(
+			status.HTTP_412_PRECONDITION_FAILED,
+			"The order was changed since it was read, fetch it again",
+		)
 
 
 def check_content_type(media_type):
@@ -650,7 +997,7 @@ def check_content_type(media_type):
 	content_type = request.headers.get("Content-Type")
 	if content_type and content_type == media_type:
 		return
-	app.logger.error("Invalid Content-Type: %s", content_type)
+	current_app.logger.error("Invalid Content-Type: %s", content_type)
 	abort(
 		status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
 		f"Content-Type must be {media_type}",
@@ -211,7 +211,7 @@ $(function () {
 
         let ajax = $.ajax({
             type: "GET",
-            url: "/orders?user_id=" + user_id,
+            url: "/orders?user_id=" + user_id + "&expand=items",
             contentType: "application/json",
             // data: JSON.stringify(data),
         });
@@ -263,7 +263,7 @@ $(function () {
         
         let ajax = $.ajax({
             type: "GET",
-            url: "/orders?" + "user_id="+user_id + "&status=" + order_status,
+            url: "/orders?" + "user_id="+user_id + "&status=" + order_status + "&expand=items",
             contentType: "application/json",
             data: ''
         });
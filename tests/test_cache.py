@@ -0,0 +1,102 @@
+"""
+Test cases for the order cache
+"""
+import time
+import unittest
+from fnmatch import fnmatch
+from service.common.cache import CacheBackend, LRUBackend, NullBackend, OrderCache, RedisBackend
+
+
+class StandInRedis:
+	"""The part of a Redis client RedisBackend uses, kept in a dictionary"""
+
+	def __init__(self):
+		self.values = {}
+		self.expiries = {}
+
+	def get(self, name):
+		return self.values.get(name)
+
+	def set(self, name, value, ex=None):
+		self.values[name] = value
+		self.expiries[name] = ex
+
+	def delete(self, *names):
+		for name in names:
+			self.values.pop(name, None)
+
+	def scan_iter(self, match):
+		return [name for name in self.values if fnmatch(name, match)]
+
+
+class TestOrderCache(unittest.TestCase):
+	""" Test Cases for the Order Cache """
+
+	def test_lru_backend_evicts_least_recently_used(self):
+		"""test the LRU backend keeps at most max_size entries"""
+		backend = LRUBackend(max_size=2)
+		backend.set("a", "1", 60)
+		backend.set("b", "2", 60)
+		self.assertEqual(backend.get("a"), "1")
+		backend.set("c", "3", 60)
+		self.assertEqual(backend.get("b"), None)
+		self.assertEqual(backend.get("a"), "1")
+		self.assertEqual(backend.get("c"), "3")
+		backend.delete("a")
+		self.assertEqual(backend.get("a"), None)
+		backend.clear()
+		self.assertEqual(backend.get("c"), None)
+
+	def test_lru_backend_expires_entries(self):
+		"""test entries expire after their time to live"""
+		backend = LRUBackend()
+		backend.set("a", "1", 0.01)
+		time.sleep(0.02)
+		self.assertEqual(backend.get("a"), None)
+
+	def test_order_cache_counters(self):
+		"""test the order cache counts hits, misses and invalidations"""
+		cache = OrderCache(LRUBackend(), ttl=60)
+		self.assertEqual(cache.get(1), None)
+		cache.set(1, {"id": 1, "items": [2]})
+		self.assertEqual(cache.get(1), {"id": 1, "items": [2]})
+		cache.invalidate(1, None)
+		self.assertEqual(cache.get(1), None)
+		self.assertEqual(cache.stats(), {
+			"backend": "LRUBackend", "hits": 1, "misses": 2, "invalidations": 1, "hit_ratio": 1 / 3})
+
+	def test_order_cache_current(self):
+		"""test cached orders are dropped once the database has another version"""
+		cache = OrderCache(LRUBackend(), ttl=60)
+		cached = {"version": 2, "order": {"id": 1}}
+		self.assertEqual(cache.current(1, cached, 2), cached)
+		cache.set(1, cached)
+		self.assertEqual(cache.current(1, cached, 3), None)
+		self.assertEqual(cache.get(1), None)
+		self.assertEqual(cache.current(1, cached, None), None)
+		archived = {"version": 2, "order": {"id": 1, "archived": True}}
+		self.assertEqual(cache.current(1, archived, None), archived)
+
+	def test_redis_backend(self):
+		"""test the shared backend keeps prefixed keys every worker sees"""
+		client = StandInRedis()
+		client.set("other", b"1")
+		worker1 = OrderCache(RedisBackend(client), ttl=30)
+		worker2 = OrderCache(RedisBackend(client), ttl=30)
+		worker1.set(1, {"id": 1, "items": [2]})
+		self.assertEqual(client.expiries["orders:order:1"], 30)
+		self.assertEqual(worker2.get(1), {"id": 1, "items": [2]})
+		worker1.invalidate(1)
+		self.assertEqual(worker2.get(1), None)
+		worker2.set(2, {"id": 2})
+		worker1.clear()
+		self.assertEqual(worker2.get(2), None)
+		self.assertEqual(client.get("other"), b"1")
+		self.assertRaises(TypeError, CacheBackend)
+
+	def test_null_backend(self):
+		"""test the null backend disables caching"""
+		cache = OrderCache(NullBackend())
+		cache.set(1, {"id": 1})
+		self.assertEqual(cache.get(1), None)
+		cache.clear()
@@ -0,0 +1,68 @@
+"""
+Test cases for the log handlers
+"""
+import json
+import logging
+import queue
+import unittest
+from flask import Flask
+from service.common.log_handlers import (
+	JsonFormatter, LazyQueueHandler, RequestIdFilter, SamplingFilter, SERVICE_LOGGERS, init_logging, parse_sampling
+)
+
+
+def make_record(name="flask.app", level=logging.INFO, msg="Processing lookup for id %s ...", args=(7,)):
+	"""Returns a log record as a logger would create it"""
+	return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+class TestLogHandlers(unittest.TestCase):
+	""" Test Cases for the Log Handlers """
+
+	def test_json_formatter(self):
+		"""test records are formatted as one JSON object"""
+		record = make_record()
+		record.request_id = "abc"
+		entry = json.loads(JsonFormatter().format(record))
+		self.assertEqual(entry["level"], "INFO")
+		self.assertEqual(entry["logger"], "flask.app")
+		self.assertEqual(entry["request_id"], "abc")
+		self.assertEqual(entry["message"], "Processing lookup for id 7 ...")
+
+	def test_sampling_filter(self):
+		"""test only a share of the records below WARNING are kept"""
+		sampling = SamplingFilter(parse_sampling("flask.app=0, service=1"))
+		self.assertEqual(sampling.rates, {"flask.app": 0.0, "service": 1.0})
+		self.assertFalse(sampling.filter(make_record()))
+		self.assertFalse(sampling.filter(make_record(name="flask.app.sql")))
+		self.assertTrue(sampling.filter(make_record(level=logging.WARNING)))
+		self.assertTrue(sampling.filter(make_record(name="service")))
+		self.assertTrue(sampling.filter(make_record(name="gunicorn.error")))
+
+	def test_queue_handler_defers_formatting(self):
+		"""test queued records keep their arguments for the listener to format"""
+		log_queue = queue.SimpleQueue()
+		LazyQueueHandler(log_queue).handle(make_record())
+		record = log_queue.get_nowait()
+		self.assertEqual(record.msg, "Processing lookup for id %s ...")
+		self.assertEqual(record.args, (7,))
+
+	def test_init_logging_adds_filters_once(self):
+		"""test the long lived gunicorn handlers get one filter of each kind however many apps are created"""
+		handler = logging.StreamHandler()
+		server_logger = logging.getLogger("test.gunicorn")
+		server_logger.addHandler(handler)
+		loggers = [logging.getLogger(name) for name in SERVICE_LOGGERS]
+		saved = [(logger.handlers, logger.level, logger.propagate) for logger in loggers]
+		try:
+			for _ in range(3):
+				app = Flask(__name__)
+				app.config.update(LOG_QUEUE=False, LOG_SAMPLING="flask.app=0.5")
+				init_logging(app, "test.gunicorn")
+			kinds = [type(log_filter) for log_filter in handler.filters]
+			self.assertEqual(sorted(kind.__name__ for kind in kinds), ["RequestIdFilter", "SamplingFilter"])
+			self.assertIn(RequestIdFilter, kinds)
+		finally:
+			server_logger.removeHandler(handler)
+			for logger, (handlers, level, propagate) in zip(loggers, saved):
+				logger.handlers, logger.level, logger.propagate = handlers, level, propagate
@@ -2,11 +2,18 @@
 Test cases for YourResourceModel Model
 """
 import logging
+import sqlite3
 import unittest
 from flask import jsonify
+from sqlalchemy import exc, text
 from service import app
-from service.models import Order, DataValidationError, db, Items, Status
+from service.models import (
+	Order, OrderArchive, ItemsArchive, OrderStats, OrderStatsRefresh, DataValidationError, StaleVersionError, db, Items,
+	Status
+)
 from service.config import DATABASE_URI
+from service.common.cache import order_cache
+from service.common.pool_metrics import InstrumentedQueuePool, configure_pool, pool_stats
 from time import time
 
 ######################################################################
@@ -24,7 +31,8 @@ class TestOrderModel(unittest.TestCase):
 		app.config["DEBUG"] = False
 		app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
 		app.logger.setLevel(logging.CRITICAL)
-		Order.init_db(app)
+		app.app_context().push()
+		Order.create_schema()
 
 	@classmethod
 	def tearDownClass(cls):
@@ -35,16 +43,46 @@ class TestOrderModel(unittest.TestCase):
 		""" This runs before each test """
 		db.session.query(Order).delete()  # clean up the last tests
 		db.session.query(Items).delete()
+		db.session.query(OrderArchive).delete()
+		db.session.query(ItemsArchive).delete()
 		db.session.commit()
 
 	def tearDown(self):
 		""" This runs after each test """
 		db.session.remove()
 
+	def _explain(self, query):
+		"""Returns the query plan the database picks for a query"""
+		statement = str(query.statement.compile(
+			dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+		if db.engine.dialect.name == "postgresql":
+			# tiny test tables are always cheaper to scan, so rule that out
+			db.session.execute(text("SET LOCAL enable_seqscan = off"))
+			rows = db.session.execute(text("EXPLAIN " + statement))
+		else:
+			rows = db.session.execute(text("EXPLAIN QUERY PLAN " + statement))
+		plan = "\n".join(str(row) for row in rows)
+		db.session.rollback()
+		return plan
+
 	######################################################################
 	#  T E S T   C A S E S
 	######################################################################
 
+	def test_query_paths_use_indexes(self):
+		"""test every order and item query path is served by an index"""
+		query_paths = [
+			(Order.find_by_user_id(1), ["ix_order_user_id_status", "ix_order_user_id_create_time"]),
+			(Order.find_by_status(1, 1), ["ix_order_user_id_status"]),
+			(Order.query.filter(Order.user_id == 1, Order.create_time > 1), ["ix_order_user_id_create_time"]),
+			(Items.find_by_order_id(1), ["ix_items_order_id_item_id"]),
+			(Items.find_by_item_id(1), ["ix_items_item_id_order_id"]),
+			(Items.find_by_order_and_item(1, 1), ["ix_items_order_id_item_id", "ix_items_item_id_order_id"]),
+		]
+		for query, indexes in query_paths:
+			plan = self._explain(query)
+			self.assertTrue(any(index in plan for index in indexes), plan)
+
 	def test_create_order(self):
 		""" It should always be true """
 		# Test constructor
@@ -94,6 +132,17 @@ class TestOrderModel(unittest.TestCase):
 		db_order = Order.find(order_id)
 		self.assertEqual(db_order, None)
 
+	def test_delete_order_with_loaded_items(self):
+		"""test deleting an order whose items were loaded leaves them to the database"""
+		order = Order(user_id=123, create_time=100, status=Status.CREATED)
+		order.create()
+		Items(order_id=order.id, item_id=7).create()
+		order_id = order.id
+		order = Order.find(order_id)
+		self.assertEqual(order.serialize_with_items()["items"], [7])
+		order.delete()
+		self.assertIsNone(Order.find(order_id))
+
 	def test_update_order(self):
 		"""test update function in Order"""
 		ts = (int)(time())
@@ -110,6 +159,32 @@ class TestOrderModel(unittest.TestCase):
 		self.assertEqual(db_order.create_time, ts1)
 		self.assertEqual(db_order.status, Status.CANCELLED)
 
+	def test_order_version(self):
+		"""test the version of an order follows every change to it and its items"""
+		order = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order.create()
+		self.assertEqual(order.version, 1)
+		order.status = Status.COMPLETED
+		order.update()
+		self.assertEqual(order.version, 2)
+		item = Items(order_id=order.id, item_id=1)
+		item.create()
+		self.assertEqual(Order.find(order.id).version, 3)
+		item.delete()
+		self.assertEqual(Order.find(order.id).version, 4)
+
+	def test_update_stale_order(self):
+		"""test updating an order changed by someone else raises StaleVersionError"""
+		order = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order.create()
+		self.assertEqual(order.version, 1)
+		with db.engine.begin() as connection:
+			connection.execute(text('UPDATE "order" SET version = version + 1 WHERE id = :id'), {"id": order.id})
+		order.status = Status.CANCELLED
+		with self.assertRaises(StaleVersionError):
+			order.update()
+		self.assertEqual(Order.find(order.id).status, Status.CREATED)
+
 	def test_serialize_order(self):
 		"""test serialize"""
 		order = Order(user_id=123, create_time="2022-10-16", status=Status.CREATED)
@@ -183,6 +258,77 @@ class TestOrderModel(unittest.TestCase):
 		for order in found:
 			self.assertEqual(order.user_id, 1)
 
+	def test_created_between(self):
+		"""test keeping the orders created within a time range"""
+		for user_id, create_time in ((1, 100), (2, 200), (3, 300)):
+			Order(user_id=user_id, create_time=create_time, status=1).create()
+		found = Order.created_between(Order.query, 100, 300)
+		self.assertEqual(sorted(order.user_id for order in found), [1, 2])
+		found = Order.created_between(Order.query, create_time_from=200)
+		self.assertEqual(sorted(order.user_id for order in found), [2, 3])
+		self.assertEqual(Order.created_between(Order.query).count(), 3)
+		self.assertRaises(DataValidationError, Order.created_between, Order.query, 300, 100)
+
+	def test_search(self):
+		"""test composing the filters of an order search"""
+		order1 = Order(user_id=1, create_time=100, status=Status.CREATED)
+		order2 = Order(user_id=1, create_time=200, status=Status.COMPLETED)
+		order3 = Order(user_id=2, create_time=300, status=Status.CREATED)
+		for order in (order1, order2, order3):
+			order.create()
+		Items(order_id=order1.id, item_id=7).create()
+		Items(order_id=order1.id, item_id=7).create()
+		Items(order_id=order1.id, item_id=8).create()
+		Items(order_id=order2.id, item_id=7).create()
+		Items(order_id=order3.id, item_id=8).create()
+
+		def ids(**filters):
+			return sorted(order.id for order in Order.search(**filters))
+
+		self.assertEqual(ids(), sorted([order1.id, order2.id, order3.id]))
+		self.assertEqual(ids(user_id=1, statuses=[1, 2]), sorted([order1.id, order2.id]))
+		self.assertEqual(ids(statuses=[Status.CREATED]), sorted([order1.id, order3.id]))
+		self.assertEqual(ids(item_ids=[7, 8]), sorted([order1.id, order2.id, order3.id]))
+		self.assertEqual(ids(item_ids=[7, 8], all_items=True), [order1.id])
+		self.assertEqual(ids(item_ids=[7, 7], all_items=True), sorted([order1.id, order2.id]))
+		self.assertEqual(ids(item_ids=[8], statuses=[1], create_time_from=200), [order3.id])
+		self.assertEqual(ids(user_id=1, create_time=200), [order2.id])
+		self.assertRaises(DataValidationError, Order.search, statuses=[4])
+		self.assertRaises(DataValidationError, Order.search, create_time_from=300, create_time_to=100)
+
+		page, cursor = Order.paginate(Order.search(user_id=1), 1, by_create_time=True, descending=True)
+		self.assertEqual(page, [order2])
+		page, cursor = Order.paginate(Order.search(user_id=1), 1, cursor, by_create_time=True, descending=True)
+		self.assertEqual(page, [order1])
+		self.assertIsNone(cursor)
+
+	def test_archive_orders(self):
+		"""test moving the old orders in a final status into the archive"""
+		old_completed = Order(user_id=1, create_time=100, status=Status.COMPLETED)
+		old_cancelled = Order(user_id=1, create_time=200, status=Status.CANCELLED)
+		old_created = Order(user_id=1, create_time=100, status=Status.CREATED)
+		recent = Order(user_id=1, create_time=900, status=Status.COMPLETED)
+		for order in (old_completed, old_cancelled, old_created, recent):
+			order.create()
+		Items(order_id=old_completed.id, item_id=7).create()
+		Items(order_id=old_completed.id, item_id=8).create()
+		Items(order_id=recent.id, item_id=7).create()
+		archived_ids = sorted([old_completed.id, old_cancelled.id])
+		kept_ids = sorted([old_created.id, recent.id])
+		old_completed_id, recent_id = old_completed.id, recent.id
+
+		self.assertEqual(OrderArchive.archive(500, batch_size=1, now=1000), {"orders": 2, "batches": 2})
+		self.assertEqual(sorted(order.id for order in Order.all()), kept_ids)
+		self.assertEqual([item.item_id for item in Items.all()], [7])
+		self.assertEqual(sorted(order.id for order in OrderArchive.query.all()), archived_ids)
+		self.assertEqual({order.archived_at for order in OrderArchive.query.all()}, {1000})
+		message = OrderArchive.find_with_item_ids(old_completed_id)
+		self.assertEqual(message["order"]["items"], [7, 8])
+		self.assertEqual(message["order"]["status"], Status.COMPLETED.value)
+		self.assertTrue(message["order"]["archived"])
+		self.assertIsNone(OrderArchive.find_with_item_ids(recent_id))
+		self.assertEqual(OrderArchive.archive(500, now=1000), {"orders": 0, "batches": 0})
+
 	def test_find_by_status(self):
 		"""test find by status"""
 		ts = int(time())
@@ -203,6 +349,130 @@ class TestOrderModel(unittest.TestCase):
 		found4 = Order.find_by_status(2, 3)
 		self.assertEqual(found4.count(), 0)
 
+	def test_paginate(self):
+		"""test keyset pagination of orders"""
+		for create_time in [300, 100, 200, 100]:
+			Order(user_id=1, create_time=create_time, status=1).create()
+		by_time = sorted(Order.all(), key=lambda order: (order.create_time, order.id))
+		page, cursor = Order.paginate(Order.find_by_user_id(1), 3, by_create_time=True)
+		self.assertEqual(page, by_time[:3])
+		self.assertIsNotNone(cursor)
+		page, cursor = Order.paginate(Order.find_by_user_id(1), 3, cursor, by_create_time=True)
+		self.assertEqual(page, by_time[3:])
+		self.assertIsNone(cursor)
+
+		by_id = sorted(Order.all(), key=lambda order: order.id)
+		page, cursor = Order.paginate(Order.query, 2)
+		self.assertEqual(page, by_id[:2])
+		page, cursor = Order.paginate(Order.query, 2, cursor)
+		self.assertEqual(page, by_id[2:])
+		self.assertIsNone(cursor)
+
+		for cursor in ["not a cursor", "WzFd", "WyJhIiwgMV0="]:
+			with self.assertRaises(DataValidationError):
+				Order.paginate(Order.query, 2, cursor, by_create_time=True)
+
+	def test_export(self):
+		"""test exporting every order with its items"""
+		self.assertEqual(list(Order.export()), [])
+		order1 = Order(user_id=1, create_time=100, status=Status.CREATED)
+		order2 = Order(user_id=2, create_time=200, status=Status.CANCELLED)
+		order1.create()
+		order2.create()
+		Items(order_id=order1.id, item_id=5).create()
+		Items(order_id=order1.id, item_id=6).create()
+		exported = list(Order.export(batch_size=1))
+		self.assertEqual(exported, [
+			{"id": order1.id, "user_id": 1, "create_time": 100, "status": 1, "items": [5, 6]},
+			{"id": order2.id, "user_id": 2, "create_time": 200, "status": 3, "items": []},
+		])
+
+	def test_status_storage(self):
+		"""test the status is stored as its SMALLINT value within the CHECK"""
+		order = Order(user_id=1, create_time=2 ** 40, status=Status.CANCELLED)
+		order.create()
+		row = db.session.execute(text('SELECT status, create_time FROM "order"')).one()
+		self.assertEqual(tuple(row), (3, 2 ** 40))
+		self.assertEqual(Order.find(order.id).status, Status.CANCELLED)
+		with self.assertRaises(exc.IntegrityError):
+			db.session.execute(text('UPDATE "order" SET status = 9'))
+		db.session.rollback()
+
+	def test_read_rows(self):
+		"""test the column-only reads match the ORM serializers"""
+		self.assertIsNone(Order.find_with_item_ids(0))
+		order = Order(user_id=1, create_time=100, status=Status.CREATED)
+		order.create()
+		self.assertEqual(Order.find_with_item_ids(order.id), {"version": order.version, "order": order.serialize_with_items()})
+		Items(order_id=order.id, item_id=5).create()
+		Items(order_id=order.id, item_id=6).create()
+		found = Order.find_with_item_ids(order.id)
+		self.assertEqual(found["order"], order.serialize_with_items())
+		self.assertEqual(found["order"]["items"], [5, 6])
+		rows = Items.find_rows_by_order_id(order.id).all()
+		self.assertEqual(Items.serialize_rows(rows), [item.serialize() for item in order.items])
+		self.assertEqual(Items.rows(Items.find_by_order_and_item(order.id, 6)).all(), [(order.items[1].id, order.id, 6)])
+
+	def test_stats_summary_refresh(self):
+		"""test the summary is recomputed from scratch on every refresh"""
+		Order(user_id=1, create_time=86400 + 5, status=Status.CANCELLED).create()
+		OrderStats.refresh(now=1000)
+		OrderStats.refresh(now=2000)
+		self.assertEqual(OrderStats.refreshed_at(), 2000)
+		self.assertEqual(OrderStats.summary()["by_status"], {"CANCELLED": 1})
+		Order(user_id=2, create_time=5, status=Status.CREATED).create()
+		# reads serve the summary as it is and only flag it as stale
+		summary = OrderStats.summary(max_age=60)
+		self.assertEqual((summary["total"], summary["stale"]), (1, True))
+		OrderStats.refresh()
+		summary = OrderStats.summary(max_age=60)
+		live = OrderStats.compute()
+		self.assertEqual(summary.pop("source"), "summary")
+		self.assertEqual(live.pop("source"), "live")
+		self.assertFalse(summary.pop("stale"))
+		summary.pop("refreshed_at")
+		self.assertEqual(summary, live)
+		self.assertEqual(summary["total"], 2)
+		self.assertEqual(OrderStatsRefresh.query.count(), 1)
+
+	def test_stats_summary_after_2038(self):
+		"""test the summary days and refresh time hold times past 2 ** 31"""
+		Order(user_id=1, create_time=2 ** 40, status=Status.CREATED).create()
+		OrderStats.refresh(now=2 ** 40 + 5)
+		self.assertEqual(OrderStats.refreshed_at(), 2 ** 40 + 5)
+		self.assertEqual(OrderStats.summary()["by_status"], {"CREATED": 1})
+
+	def test_create_bulk(self):
+		"""test creating orders with their items in one transaction"""
+		ts = int(time())
+		created = Order.create_bulk([
+			{"user_id": 1, "create_time": ts, "status": 1, "items": [1, 2]},
+			{"user_id": 2, "create_time": ts, "status": 1, "items": ["3"]},
+			{"user_id": 3, "create_time": ts, "status": 1},
+		])
+		self.assertEqual(len(created), 3)
+		self.assertEqual([item_ids for _, item_ids in created], [[1, 2], [3], []])
+		self.assertEqual(len(Order.all()), 3)
+		order, _ = created[0]
+		self.assertEqual([item.item_id for item in Items.find_by_order_id(order.id)], [1, 2])
+		self.assertEqual(len(Items.all()), 3)
+
+	def test_create_bulk_is_atomic(self):
+		"""test a bad order in a bulk create stores nothing"""
+		ts = int(time())
+		bad_orders = [
+			[{"user_id": 1, "create_time": ts, "status": 1, "items": [1]}, {"user_id": "bad"}],
+			[{"user_id": 1, "create_time": ts, "status": 1, "items": ["bad"]}],
+			[{"user_id": 1, "create_time": ts, "status": 1, "items": 1}],
+			["bad order"],
+			{"user_id": 1},
+		]
+		for orders in bad_orders:
+			with self.assertRaises(DataValidationError):
+				Order.create_bulk(orders)
+		self.assertEqual(Order.all(), [])
+		self.assertEqual(Items.all(), [])
+
 
 class TestItemsModel(unittest.TestCase):
 	""" Test Cases for Items Model """
@@ -214,8 +484,8 @@ class TestItemsModel(unittest.TestCase):
 		app.config["DEBUG"] = False
 		app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
 		app.logger.setLevel(logging.CRITICAL)
-		Order.init_db(app)
-		Items.init_db(app)
+		app.app_context().push()
+		Order.create_schema()
 
 	@classmethod
 	def tearDownClass(cls):
@@ -280,6 +550,50 @@ class TestItemsModel(unittest.TestCase):
 		item.update()
 		self.assertEqual(Items.find(item.id).item_id, 10)
 
+	def test_find_and_delete_by_order_and_item(self):
+		"""test looking up and deleting an item of an order"""
+		order1 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order2 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order1.create()
+		order2.create()
+		Items(order_id=order1.id, item_id=1).create()
+		Items(order_id=order1.id, item_id=2).create()
+		Items(order_id=order1.id, item_id=2).create()
+		Items(order_id=order2.id, item_id=2).create()
+		self.assertEqual(Items.find_by_order_and_item(order1.id, 2).count(), 2)
+		self.assertEqual(Items.find_by_order_and_item(order1.id, 3).first(), None)
+		self.assertEqual(Items.delete_by_order_and_item(order1.id, 2), 2)
+		self.assertEqual([item.item_id for item in Items.find_by_order_id(order1.id)], [1])
+		self.assertEqual(Items.find_by_order_and_item(order2.id, 2).count(), 1)
+		self.assertEqual(Items.delete_by_order_and_item(order1.id, 2), 0)
+
+	def test_order_items_relationship(self):
+		"""test the items of an order are loaded through the relationship"""
+		order = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order.create()
+		Items(order_id=order.id, item_id=2).create()
+		Items(order_id=order.id, item_id=1).create()
+		order_id = order.id
+		db.session.remove()
+		order = Order.find(order_id)
+		self.assertEqual([item.item_id for item in order.items], [2, 1])
+		self.assertEqual(order.serialize_with_items()["items"], [2, 1])
+
+	def test_item_update_invalidates_cache(self):
+		"""test moving an item drops both orders from the cache"""
+		order1 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order2 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
+		order1.create()
+		order2.create()
+		item = Items(order_id=order1.id, item_id=1)
+		item.create()
+		order_cache.set(order1.id, {"id": order1.id})
+		order_cache.set(order2.id, {"id": order2.id})
+		item.order_id = order2.id
+		item.update()
+		self.assertIsNone(order_cache.get(order1.id))
+		self.assertIsNone(order_cache.get(order2.id))
+
 	def test_deserialize_item(self):
 		"""test deserialize order"""
 		item = Items()
@@ -317,3 +631,42 @@ class TestItemsModel(unittest.TestCase):
 		item3.create()
 		found = Items.all()
 		self.assertEqual(len([item for item in found]), 3)
+
+
+class TestPoolMetrics(unittest.TestCase):
+	""" Test Cases for the connection pool configuration and statistics """
+
+	def setUp(self):
+		""" This runs before each test """
+		pool_stats.reset()
+
+	def test_configure_pool(self):
+		"""test the queue pool options only apply outside SQLite"""
+		options = {"pool_size": 3, "max_overflow": 1, "pool_timeout": 2, "pool_recycle": 60, "pool_pre_ping": True}
+		config = {"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ENGINE_OPTIONS": options}
+		fake_app = type("FakeApp", (), {"config": config})
+		configure_pool(fake_app)
+		self.assertEqual(config["SQLALCHEMY_ENGINE_OPTIONS"], {"pool_recycle": 60, "pool_pre_ping": True})
+
+		config = {"SQLALCHEMY_DATABASE_URI": "postgresql://localhost/postgres", "SQLALCHEMY_ENGINE_OPTIONS": options}
+		fake_app.config = config
+		configure_pool(fake_app)
+		self.assertEqual(config["SQLALCHEMY_ENGINE_OPTIONS"]["poolclass"], InstrumentedQueuePool)
+		self.assertEqual(config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"], 3)
+		self.assertNotIn("poolclass", options)
+
+	def test_instrumented_pool(self):
+		"""test checkouts, waits and timeouts are counted"""
+		pool = InstrumentedQueuePool(lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=0, timeout=0.05)
+		connection = pool.connect()
+		with self.assertRaises(exc.TimeoutError):
+			pool.connect()
+		connection.close()
+		pool.connect().close()
+		stats = pool_stats.as_dict()
+		self.assertEqual(stats["connects"], 1)
+		self.assertEqual(stats["checkouts"], 2)
+		self.assertEqual(stats["checkins"], 2)
+		self.assertEqual(stats["timeouts"], 1)
+		self.assertGreaterEqual(stats["wait_seconds_max"], 0.05)
+		pool.dispose()
@@ -0,0 +1,89 @@
+"""
+Test cases for the monthly partitioning of the order and items tables
+"""
+import logging
+import unittest
+from sqlalchemy import text
+from service import app, partitions
+from service.models import Order, Items, db
+from service.config import DATABASE_URI
+
+JANUARY_2022 = 1640995200
+FEBRUARY_2022 = 1643673600
+
+
+class TestMonths(unittest.TestCase):
+	""" Test Cases for the monthly bounds """
+
+	def test_month_bounds(self):
+		"""test months map to the create_time range of their UTC calendar month"""
+		self.assertEqual(partitions.month_bounds(2022, 1), (JANUARY_2022, FEBRUARY_2022))
+		self.assertEqual(partitions.month_bounds(2022, 12)[1], 1672531200)
+		self.assertEqual(partitions.month_of(FEBRUARY_2022 - 1), (2022, 1))
+		self.assertEqual(partitions.month_of(FEBRUARY_2022), (2022, 2))
+		self.assertEqual(partitions.partition_name("order", 2022, 1), "order_p2022_01")
+
+	def test_upcoming_months(self):
+		"""test the upcoming months run across the end of the year"""
+		self.assertEqual(
+			partitions.upcoming_months(2, now=1669852800),
+			[(2022, 12), (2023, 1), (2023, 2)])
+		self.assertEqual(partitions.parse_month("2022-03"), (2022, 3))
+		self.assertRaises(partitions.PartitioningError, partitions.parse_month, "2022-13")
+
+
+@unittest.skipUnless(DATABASE_URI.startswith("postgresql"), "partitioning needs PostgreSQL")
+class TestPartitioning(unittest.TestCase):
+	""" Test Cases for partitioning the tables on PostgreSQL """
+
+	@classmethod
+	def setUpClass(cls):
+		""" This runs once before the entire test suite """
+		app.config["TESTING"] = True
+		app.logger.setLevel(logging.CRITICAL)
+		app.app_context().push()
+		Order.create_schema()
+
+	def setUp(self):
+		""" This runs before each test """
+		db.session.query(Order).delete()
+		db.session.query(Items).delete()
+		db.session.commit()
+
+	def tearDown(self):
+		""" This runs after each test """
+		db.session.remove()
+		with db.engine.begin() as connection:
+			if partitions.is_partitioned(connection):
+				partitions.disable(connection)
+			connection.execute(text("DROP TABLE IF EXISTS order_p2022_01, items_p2022_01"))
+
+	def test_enable_detach_disable(self):
+		"""test orders and items move to their month and leave with it"""
+		Order.create_bulk([
+			{"user_id": 1, "create_time": JANUARY_2022 + 10, "status": 1, "items": [1, 2]},
+			{"user_id": 1, "create_time": FEBRUARY_2022 + 10, "status": 1, "items": [3]},
+		])
+		db.session.remove()
+		with db.engine.begin() as connection:
+			months = partitions.enable(connection, months_ahead=0, now=FEBRUARY_2022)
+			self.assertEqual(months, [(2022, 1), (2022, 2)])
+			self.assertRaises(partitions.PartitioningError, partitions.enable, connection)
+			# items inserted without order_create_time are routed to the month of their order
+			order_id = connection.execute(text(
+				'SELECT id FROM "order" WHERE create_time < :february'), {"february": FEBRUARY_2022}).scalar()
+			connection.execute(text("INSERT INTO items (order_id, item_id) VALUES (:order_id, 4)"), {"order_id": order_id})
+			self.assertEqual(connection.execute(text("SELECT count(*) FROM items_p2022_01")).scalar(), 3)
+			self.assertEqual(connection.execute(text("SELECT count(*) FROM items_default")).scalar(), 0)
+			self.assertEqual(partitions.create_months(connection, months_ahead=1, now=FEBRUARY_2022), [(2022, 3)])
+			self.assertEqual(len(partitions.describe(connection)), 4)
+			self.assertEqual(partitions.detach(connection, 2022, 1), ["order_p2022_01", "items_p2022_01"])
+			self.assertRaises(partitions.PartitioningError, partitions.detach, connection, 2022, 1)
+			self.assertEqual(connection.execute(text("SELECT count(*) FROM items_p2022_01")).scalar(), 3)
+		self.assertEqual([order.create_time for order in Order.all()], [FEBRUARY_2022 + 10])
+		self.assertEqual([item.item_id for item in Items.all()], [3])
+		db.session.remove()
+		with db.engine.begin() as connection:
+			partitions.disable(connection)
+			self.assertFalse(partitions.is_partitioned(connection))
+		self.assertEqual(Items.find_by_order_id(Order.all()[0].id).count(), 1)
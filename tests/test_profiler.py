@@ -0,0 +1,28 @@
+"""
+Test cases for the SQL profiler
+"""
+import unittest
+from service.common.profiler import SQLProfile, statement_shape
+
+
+class TestSQLProfile(unittest.TestCase):
+	""" Test Cases for SQL Profiles """
+
+	def test_statement_shape(self):
+		"""test statements differing only in whitespace and parameter lists have the same shape"""
+		self.assertEqual(
+			statement_shape("SELECT items.id\n  FROM items WHERE items.order_id IN (?, ?, ?)"),
+			"SELECT items.id FROM items WHERE items.order_id IN (?)")
+		self.assertEqual(
+			statement_shape("SELECT 1 FROM items WHERE order_id IN (%(id_1_1)s, %(id_1_2)s)"),
+			statement_shape("SELECT 1 FROM items WHERE order_id IN (%(id_1_1)s)"))
+
+	def test_repeated_statements(self):
+		"""test statements repeated more than the threshold are reported"""
+		profile = SQLProfile()
+		for order_id in range(6):
+			profile.record("SELECT * FROM items WHERE order_id = ?", 0.001, order_id)
+		profile.record("SELECT * FROM \"order\"", 0.002, 6)
+		self.assertEqual(profile.repeated_statements(5), {"SELECT * FROM items WHERE order_id = ?": 6})
+		self.assertEqual(profile.repeated_statements(6), {})
+		self.assertAlmostEqual(profile.sql_seconds, 0.008)
@@ -6,13 +6,18 @@ nosetests -v --with-spec --spec-color
 coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
 
 from flask import jsonify
-from service import app, error_handlers
-from service.models import db, Order, Items, Status
+from sqlalchemy import event
+from service import app, create_app
+from service.common import error_handlers
+from service.models import db, Order, OrderArchive, Items, ItemsArchive, OrderStats, OrderStatsRefresh, Status
 from service.common import status  # HTTP Status Codes
+from service.common.cache import order_cache
+from service.common.log_handlers import sql_logger
 from time import time
 
 DATABASE_URI = os.getenv(
@@ -35,7 +40,8 @@ class TestYourResourceServer(TestCase):
 		# Set up the test database
 		app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
 		app.logger.setLevel(logging.CRITICAL)
-		Order.init_db(app)
+		app.app_context().push()
+		Order.create_schema()
 
 	@classmethod
 	def tearDownClass(cls):
@@ -47,7 +53,10 @@ class TestYourResourceServer(TestCase):
 		self.client = app.test_client()
 		db.session.query(Order).delete()  # clean up the last tests
 		db.session.query(Items).delete()
+		db.session.query(OrderArchive).delete()
+		db.session.query(ItemsArchive).delete()
 		db.session.commit()
+		order_cache.clear()
 
 	def tearDown(self):
 		""" This runs after each test """
@@ -71,6 +80,20 @@ class TestYourResourceServer(TestCase):
 			user_id += user_id_incr
 		return orders
 
+	def _count_statements(self, func):
+		"""Returns how many SQL statements are executed while calling func"""
+		statements = []
+
+		def before_cursor_execute(conn, cursor, statement, *args):
+			statements.append(statement)
+
+		event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+		try:
+			result = func()
+		finally:
+			event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+		return result, len(statements)
+
 	######################################################################
 	#  P L A C E   T E S T   C A S E S   H E R E
 	######################################################################
@@ -168,6 +191,27 @@ class TestYourResourceServer(TestCase):
 		self.assertEqual(db_order, None)
 		# Todo: get this item and check if it's none
 
+	def test_single_item_uses_indexed_statements(self):
+		""" It should look up an item with one statement and delete it without loading rows"""
+		order = self._create_order(count=1)[0]
+		order.create()
+		for item_id in range(50):
+			Items(order_id=order.id, item_id=item_id).create()
+		Items(order_id=order.id, item_id=7).create()
+		order_id = order.id
+		db.session.remove()
+
+		response, count = self._count_statements(
+			lambda: self.client.get(f"{BASE_URL}/{order_id}/items/7"))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(count, 1)
+		response, count = self._count_statements(
+			lambda: self.client.delete(f"{BASE_URL}/{order_id}/items/7"))
+		self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+		self.assertEqual(count, 2)  # the DELETE and the bump of the order version
+		self.assertEqual(Items.find_by_order_and_item(order_id, 7).count(), 0)
+		self.assertEqual(Items.find_by_order_id(order_id).count(), 49)
+
 	def test_delete_item(self):
 		""" test delete item by order id and item id"""
 		order1 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
@@ -220,6 +264,117 @@ class TestYourResourceServer(TestCase):
 		response = self.client.get(f"{BASE_URL}?user_id=1&item_id={item.item_id}")
 		self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+	def test_get_archived_order(self):
+		""" It should archive old Orders from the command line and still Get them"""
+		old = Order(user_id=1, create_time=100, status=Status.CANCELLED)
+		old.create()
+		Items(order_id=old.id, item_id=5).create()
+		recent = Order(user_id=1, create_time=int(time()), status=Status.CANCELLED)
+		recent.create()
+		old_id, recent_id = old.id, recent.id
+		self.assertEqual(self.client.get(f"{BASE_URL}/{old_id}").status_code, status.HTTP_200_OK)
+
+		result = app.test_cli_runner().invoke(args=["archive-orders", "--older-than-days", "30", "--pause", "0"])
+		self.assertEqual(result.exit_code, 0, result.output)
+		self.assertIn("Archived 1 orders in 1 batches", result.output)
+		self.assertEqual([order.id for order in Order.all()], [recent_id])
+
+		response = self.client.get(f"{BASE_URL}/{old_id}")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		data = response.get_json()
+		self.assertEqual(data["items"], [5])
+		self.assertTrue(data["archived"])
+		self.assertNotIn("archived", self.client.get(f"{BASE_URL}/{recent_id}").get_json())
+		# archived orders are read only
+		response = self.client.put(f"{BASE_URL}/{old_id}", json={"user_id": 1, "create_time": 100, "status": 3})
+		self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+	def test_get_order_cached(self):
+		""" It should serve an Order from the cache until it changes"""
+		order = self._create_order(count=1)[0]
+		order.create()
+		order_id = order.id
+		Items(order_id=order_id, item_id=1).create()
+		db.session.remove()
+
+		response = self.client.get(f"{BASE_URL}/{order_id}")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		response, count = self._count_statements(lambda: self.client.get(f"{BASE_URL}/{order_id}"))
+		self.assertEqual(response.get_json()["items"], [1])
+		# a hit only reads the version of the order
+		self.assertEqual(count, 1)
+		self.assertGreaterEqual(order_cache.stats()["hits"], 1)
+
+		# a write another worker handled leaves this cache alone but bumps the version
+		db.session.execute(
+			db.update(Order).where(Order.id == order_id).values(status=Status.COMPLETED, version=Order.version + 1))
+		db.session.commit()
+		self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["status"], Status.COMPLETED)
+		Order.query.filter(Order.id == order_id).update({Order.status: Status.CREATED}, synchronize_session=False)
+		db.session.commit()
+
+		self.client.post(f"{BASE_URL}/{order_id}/items", json={"order_id": order_id, "item_id": 2})
+		self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["items"], [1, 2])
+		self.client.delete(f"{BASE_URL}/{order_id}/items/1")
+		self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["items"], [2])
+		self.client.post(f"{BASE_URL}/{order_id}/cancel")
+		self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["status"], Status.CANCELLED)
+		self.client.delete(f"{BASE_URL}/{order_id}")
+		response = self.client.get(f"{BASE_URL}/{order_id}")
+		self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+		response = self.client.get("/health/cache")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertIn("hit_ratio", response.get_json())
+
+	def test_get_order_conditional(self):
+		""" It should answer 304 while the ETag of an Order is unchanged"""
+		order = self._create_order(count=1, user_id_begin=9)[0]
+		order.create()
+		order_id = order.id
+
+		response = self.client.get(f"{BASE_URL}/{order_id}")
+		etag = response.headers["ETag"]
+		response = self.client.get(f"{BASE_URL}/{order_id}", headers={"If-None-Match": etag})
+		self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+		self.assertEqual(response.headers["ETag"], etag)
+
+		response = self.client.get(BASE_URL, query_string="user_id=9")
+		list_etag = response.headers["ETag"]
+		response = self.client.get(BASE_URL, query_string="user_id=9", headers={"If-None-Match": list_etag})
+		self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+		Items(order_id=order_id, item_id=1).create()
+		response = self.client.get(f"{BASE_URL}/{order_id}", headers={"If-None-Match": etag})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(response.headers["ETag"], etag)
+		response = self.client.get(BASE_URL, query_string="user_id=9", headers={"If-None-Match": list_etag})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+	def test_update_order_if_match(self):
+		""" It should only update or cancel an Order at the version the client read"""
+		order = self._create_order(count=1)[0]
+		order.create()
+		order_id = order.id
+		payload = order.serialize()
+		payload["status"] = Status.COMPLETED
+
+		etag = self.client.get(f"{BASE_URL}/{order_id}").headers["ETag"]
+		response = self.client.put(f"{BASE_URL}/{order_id}", json=payload, headers={"If-Match": etag})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		new_etag = response.headers["ETag"]
+		self.assertNotEqual(new_etag, etag)
+
+		response = self.client.put(f"{BASE_URL}/{order_id}", json=payload, headers={"If-Match": etag})
+		self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+		response = self.client.post(f"{BASE_URL}/{order_id}/cancel", headers={"If-Match": etag})
+		self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+		self.assertEqual(Order.find(order_id).status, Status.COMPLETED)
+
+		response = self.client.post(f"{BASE_URL}/{order_id}/cancel", headers={"If-Match": new_etag})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(Order.find(order_id).status, Status.CANCELLED)
+
 	def test_create_order(self):
 		""" It should Create a new Order"""
 		info_item = {
@@ -256,6 +411,29 @@ class TestYourResourceServer(TestCase):
 		self.assertEqual(found[2].order_id, test_order.id)
 		self.assertEqual(found[2].item_id, 3)
 
+	def test_create_orders_in_bulk(self):
+		""" It should Create many Orders in one request"""
+		ts = int(time())
+		payload = [
+			{"user_id": 7, "create_time": ts, "status": Status.CREATED, "items": [1, 2]},
+			{"user_id": 8, "create_time": ts, "status": Status.CREATED, "items": [3]},
+		]
+		response = self.client.post(f"{BASE_URL}/bulk", json=payload)
+		self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+		body = response.get_json()
+		self.assertEqual(len(body), 2)
+		self.assertEqual([order["user_id"] for order in body], [7, 8])
+		self.assertEqual([order["items"] for order in body], [[1, 2], [3]])
+		for order in body:
+			self.assertIsNotNone(Order.find(order["id"]))
+		self.assertEqual(len(Items.all()), 3)
+
+		payload.append({"user_id": "bad", "create_time": ts, "status": Status.CREATED})
+		response = self.client.post(f"{BASE_URL}/bulk", json=payload)
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+		self.assertEqual(len(Order.all()), 2)
+		self.assertEqual(len(Items.all()), 3)
+
 	def test_add_order_item(self):
 		""" It should add an item to the order"""
 		order1 = Order(user_id=123, create_time=(int)(time()), status=Status.CREATED)
@@ -297,6 +475,170 @@ class TestYourResourceServer(TestCase):
 		self.assertIsNotNone(data)
 		self.assertEqual(len(data), 2)
 
+	def test_list_orders_paginated(self):
+		""" It should page through the orders of a user with a cursor"""
+		orders = self._create_order(count=5, user_id_begin=3, user_id_incr=0)
+		for order in orders:
+			order.create()
+		order_ids = sorted(order.id for order in orders)
+
+		seen = []
+		query_string = "user_id=3&limit=2"
+		for _ in range(3):
+			resp = self.client.get(BASE_URL, query_string=query_string)
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			seen += [order["id"] for order in resp.get_json()]
+			cursor = resp.headers.get("X-Next-Cursor")
+			if cursor is None:
+				self.assertNotIn("Link", resp.headers)
+				break
+			self.assertIn('rel="next"', resp.headers["Link"])
+			query_string = f"user_id=3&limit=2&cursor={cursor}"
+		self.assertEqual(seen, order_ids)
+
+		resp = self.client.get(BASE_URL, query_string="user_id=3&limit=0")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+		resp = self.client.get(BASE_URL, query_string="user_id=3&cursor=bad")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_get_all_order_paginated(self):
+		""" It should cap the page size of all orders"""
+		for order in self._create_order(count=3):
+			order.create()
+		page_size_max = app.config["PAGE_SIZE_MAX"]
+		app.config["PAGE_SIZE_MAX"] = 2
+		try:
+			resp = self.client.get(f"{BASE_URL}/all", query_string="limit=100")
+		finally:
+			app.config["PAGE_SIZE_MAX"] = page_size_max
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(len(resp.get_json()), 2)
+		cursor = resp.headers["X-Next-Cursor"]
+		resp = self.client.get(f"{BASE_URL}/all", query_string=f"cursor={cursor}")
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(len(resp.get_json()), 1)
+		self.assertNotIn("X-Next-Cursor", resp.headers)
+
+	def test_get_all_order_serialized_once(self):
+		""" It should return all orders in the shape of GET /orders"""
+		order = self._create_order(count=1, user_id_begin=4)[0]
+		order.create()
+		resp = self.client.get(f"{BASE_URL}/all")
+		self.assertEqual(resp.content_type, "application/json")
+		self.assertTrue(resp.data.endswith(b"\n"))
+		self.assertEqual(resp.get_json(), [order.serialize()])
+		self.assertEqual(resp.get_json(), self.client.get(f"{BASE_URL}?user_id=4").get_json())
+
+	def test_get_order_single_query(self):
+		""" It should read an order with its items in one statement"""
+		order = self._create_order(count=1)[0]
+		order.create()
+		order_id = order.id
+		Items(order_id=order_id, item_id=7).create()
+		order_cache.clear()
+		resp, count = self._count_statements(lambda: self.client.get(f"{BASE_URL}/{order_id}"))
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(resp.get_json()["items"], [7])
+		self.assertEqual(count, 1)
+		resp, count = self._count_statements(lambda: self.client.get(f"{BASE_URL}/{order_id}/items"))
+		self.assertEqual([item["item_id"] for item in resp.get_json()], [7])
+		self.assertEqual(count, 1)
+
+	def test_list_orders_expand_items(self):
+		""" It should embed the items of every listed order with two queries"""
+		orders = self._create_order(count=10, user_id_begin=4)
+		for order in orders:
+			order.create()
+			Items(order_id=order.id, item_id=1).create()
+			Items(order_id=order.id, item_id=2).create()
+		db.session.remove()
+
+		for url, query_string in [(BASE_URL, "user_id=4&expand=items"), (f"{BASE_URL}/all", "expand=items")]:
+			resp, count = self._count_statements(
+				lambda: self.client.get(url, query_string=query_string))
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			body = resp.get_json()
+			self.assertEqual(len(body), 10)
+			for order in body:
+				self.assertEqual(order["items"], [1, 2])
+			self.assertEqual(count, 2)
+
+		resp = self.client.get(f"{BASE_URL}/all")
+		self.assertNotIn("items", resp.get_json()[0])
+		resp = self.client.get(BASE_URL, query_string="user_id=4")
+		self.assertNotIn("items", resp.get_json()[0])
+		resp = self.client.get(BASE_URL, query_string="user_id=4&expand=other")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_export_orders(self):
+		""" It should stream all orders with their items as NDJSON"""
+		orders = self._create_order(count=2, user_id_begin=1, user_id_incr=1)
+		for order in orders:
+			order.create()
+		Items(order_id=orders[0].id, item_id=9).create()
+		resp = self.client.get(f"{BASE_URL}/export")
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(resp.mimetype, "application/x-ndjson")
+		lines = resp.get_data(as_text=True).splitlines()
+		self.assertEqual(len(lines), 2)
+		exported = [json.loads(line) for line in lines]
+		self.assertEqual([order["id"] for order in exported], [order.id for order in orders])
+		self.assertEqual(exported[0]["items"], [9])
+		self.assertEqual(exported[1]["items"], [])
+
+	def test_order_stats(self):
+		""" It should count orders by status, day and user with the top items"""
+		day = 86400 * 19000
+		for user_id, create_time, order_status, item_ids in [
+			(1, day + 10, Status.CREATED, [5, 6]),
+			(1, day + 20, Status.COMPLETED, [5]),
+			(2, day + 86400, Status.CREATED, [7]),
+		]:
+			order = Order(user_id=user_id, create_time=create_time, status=order_status)
+			order.create()
+			for item_id in item_ids:
+				Items(order_id=order.id, item_id=item_id).create()
+		db.session.query(OrderStats).delete()
+		db.session.query(OrderStatsRefresh).delete()
+		db.session.commit()
+
+		expected = {
+			"total": 3,
+			"by_status": {"CREATED": 2, "COMPLETED": 1},
+			"by_time": [{"start": day, "orders": 2}, {"start": day + 86400, "orders": 1}],
+			"by_user": [{"user_id": 1, "orders": 2}, {"user_id": 2, "orders": 1}],
+			"top_items": [{"item_id": 5, "count": 2}, {"item_id": 6, "count": 1}, {"item_id": 7, "count": 1}],
+		}
+		resp = self.client.get(f"{BASE_URL}/stats")
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(resp.get_json(), dict(expected, source="live"))
+
+		resp = self.client.get(f"{BASE_URL}/stats?create_time_from={day + 15}&create_time_to={day + 86400}&bucket=3600")
+		self.assertEqual(resp.get_json()["by_status"], {"COMPLETED": 1})
+		self.assertEqual(resp.get_json()["by_time"], [{"start": day, "orders": 1}])
+		resp = self.client.get(f"{BASE_URL}/stats?bucket=0")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+		app.config["STATS_SUMMARY"] = True
+		try:
+			# requests never build the summary, it is live until flask refresh-stats ran
+			self.assertEqual(self.client.get(f"{BASE_URL}/stats").get_json()["source"], "live")
+			result = app.test_cli_runner().invoke(args=["refresh-stats"])
+			self.assertEqual(result.exit_code, 0, result.output)
+			body = self.client.get(f"{BASE_URL}/stats").get_json()
+			self.assertEqual(body.pop("source"), "summary")
+			self.assertIsNotNone(body.pop("refreshed_at"))
+			self.assertFalse(body.pop("stale"))
+			self.assertEqual(body, expected)
+			body = self.client.get(f"{BASE_URL}/stats?create_time_from={day + 86400}&top=1").get_json()
+			self.assertEqual(body["by_user"], [{"user_id": 2, "orders": 1}])
+			self.assertEqual(body["top_items"], [{"item_id": 7, "count": 1}])
+			# unaligned ranges cannot be served from the daily summary
+			body = self.client.get(f"{BASE_URL}/stats?create_time_from={day + 15}").get_json()
+			self.assertEqual(body["source"], "live")
+		finally:
+			app.config["STATS_SUMMARY"] = False
+
 	def test_list_order_items(self):
 		""" It should list the items in an order"""
 		order = self._create_order(count=1, user_id_begin=0, user_id_incr=0)
@@ -313,6 +655,42 @@ class TestYourResourceServer(TestCase):
 		self.assertIsNotNone(data)
 		self.assertEqual(len(data), 2)
 
+	def test_replace_order_items(self):
+		""" It should replace the items of an order with a diff in one transaction"""
+		order = self._create_order(count=1)[0]
+		order.create()
+		for item_id in (1, 2, 2, 3):
+			Items(order_id=order.id, item_id=item_id).create()
+		kept_rows = [item.id for item in Items.find_by_order_and_item(order.id, 2)]
+		version = Order.find(order.id).version
+		self.client.get(f"{BASE_URL}/{order.id}")  # cached
+		order_id = order.id
+		db.session.remove()
+
+		resp, count = self._count_statements(
+			lambda: self.client.put(f"{BASE_URL}/{order_id}/items", json=[2, 4, 2, "5"]))
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(resp.get_json(), {"order_id": order_id, "items": [2, 2, 4, 5], "added": [4, 5], "removed": [1, 3]})
+		self.assertEqual(count, 4)  # SELECT, DELETE, INSERT and the version bump
+		self.assertEqual([item.id for item in Items.find_by_order_and_item(order_id, 2)], kept_rows)
+		self.assertEqual(sorted(item.item_id for item in Items.find_by_order_id(order_id)), [2, 2, 4, 5])
+		self.assertEqual(Order.find(order_id).version, version + 1)
+		self.assertEqual(self.client.get(f"{BASE_URL}/{order_id}").get_json()["items"], [2, 2, 4, 5])
+
+		resp, count = self._count_statements(
+			lambda: self.client.put(f"{BASE_URL}/{order_id}/items", json=[5, 4, 2, 2]))
+		self.assertEqual(resp.get_json()["added"], [])
+		self.assertEqual(count, 1)
+		resp = self.client.put(f"{BASE_URL}/{order_id}/items", json=[])
+		self.assertEqual(resp.get_json()["removed"], [2, 2, 4, 5])
+		self.assertEqual(Items.find_by_order_id(order_id).count(), 0)
+
+		resp = self.client.put(f"{BASE_URL}/0/items", json=[1])
+		self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+		for body in ('{"items": [1]}', '["x"]', "null"):
+			resp = self.client.put(f"{BASE_URL}/{order_id}/items", data=body, content_type="application/json")
+			self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+
 	def test_cancel_order(self):
 		""" It should cancel an order """
 		order = self._create_order(count=1, user_id_begin=0, user_id_incr=0)[0]
@@ -338,6 +716,48 @@ class TestYourResourceServer(TestCase):
 		# body = resp.get_json()
 		# self.assertIsNone(body)
 
+	def test_cancel_orders_in_bulk(self):
+		""" It should cancel the CREATED orders of a selection with one UPDATE"""
+		orders = self._create_order(count=4, user_id_begin=1)
+		orders[2].status = Status.COMPLETED
+		orders[3].user_id = 2
+		for order in orders:
+			order.create()
+		ids = [order.id for order in orders]
+		self.client.get(f"{BASE_URL}/{ids[0]}")  # cached
+
+		resp, count = self._count_statements(
+			lambda: self.client.post(f"{BASE_URL}/cancel", json={"ids": ids[:3] + [0]}))
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual(resp.get_json(), {"status": 3, "changed": ids[:2], "unchanged": [0, ids[2]]})
+		self.assertLessEqual(count, 2)
+		self.assertEqual(self.client.get(f"{BASE_URL}/{ids[0]}").get_json()["status"], Status.CANCELLED)
+		self.assertEqual(Order.find(ids[2]).status, Status.COMPLETED)
+
+		resp = self.client.post(f"{BASE_URL}/cancel", json={"user_id": 2, "status": 1})
+		self.assertEqual(resp.get_json(), {"status": 3, "changed": [ids[3]]})
+		resp = self.client.post(f"{BASE_URL}/cancel", json={"user_id": 2})
+		self.assertEqual(resp.get_json()["changed"], [])
+
+		for body in ({}, {"status": 1}, {"ids": ["1"]}, {"user_id": 1, "status": 2}):
+			resp = self.client.post(f"{BASE_URL}/cancel", json=body)
+			self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+		resp = self.client.post(f"{BASE_URL}/cancel", data="{}", content_type="text/plain")
+		self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+	def test_change_orders_status_in_bulk(self):
+		""" It should only apply allowed status transitions"""
+		order = self._create_order(count=1, user_id_begin=5)[0]
+		order.create()
+		version = order.version
+		resp = self.client.post(f"{BASE_URL}/status", json={"new_status": 2, "user_id": 5})
+		self.assertEqual(resp.get_json(), {"status": 2, "changed": [order.id]})
+		self.assertEqual(Order.find(order.id).version, version + 1)
+		resp = self.client.post(f"{BASE_URL}/status", json={"new_status": 1, "user_id": 5})
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+		resp = self.client.post(f"{BASE_URL}/status", json={"user_id": 5})
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
 	def test_get_order_by_status(self):
 		"""test getting order by status"""
 		ts = int(time())
@@ -400,6 +820,112 @@ class TestYourResourceServer(TestCase):
 		self.assertEqual(body[1]["id"], item2.order_id)
 		self.assertEqual(body[2]["id"], item3.order_id)
 
+	def test_get_order_by_item_id_single_query(self):
+		""" It should look up orders by item with a bounded number of queries"""
+		orders = self._create_order(count=20, user_id_begin=5, user_id_incr=0)
+		for order in orders:
+			order.create()
+			Items(order_id=order.id, item_id=42).create()
+		other = self._create_order(count=1, user_id_begin=6)[0]
+		other.create()
+		Items(order_id=other.id, item_id=42).create()
+		order_ids = [order.id for order in orders]
+		db.session.remove()
+
+		response, count = self._count_statements(
+			lambda: self.client.get(BASE_URL, query_string="user_id=5&item_id=42"))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		body = response.get_json()
+		self.assertEqual([order["id"] for order in body], order_ids)
+		self.assertLessEqual(count, 2)
+
+	def test_get_order_by_create_time_range(self):
+		""" It should list the orders created in [create_time_from, create_time_to)"""
+		orders = [Order(user_id=4, create_time=create_time, status=create_time % 2 + 1) for create_time in range(10, 15)]
+		for order in orders:
+			order.create()
+		Items(order_id=orders[2].id, item_id=7).create()
+		Items(order_id=orders[4].id, item_id=7).create()
+
+		resp = self.client.get(BASE_URL, query_string="user_id=4&create_time_from=11&create_time_to=14")
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [11, 12, 13])
+		resp = self.client.get(BASE_URL, query_string="user_id=4&create_time_from=13&limit=1")
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [13])
+		self.assertIn("create_time_from=13", resp.headers["Link"])
+		resp = self.client.get(BASE_URL, query_string="user_id=4&create_time_to=11")
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [10])
+
+		# the range applies to the status and item_id filters too
+		resp = self.client.get(BASE_URL, query_string="user_id=4&status=1&create_time_from=11")
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [12, 14])
+		resp = self.client.get(BASE_URL, query_string="user_id=4&item_id=7&create_time_to=13")
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [12])
+		resp = self.client.get(BASE_URL, query_string="user_id=4&item_id=7&create_time_from=15")
+		self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+		resp = self.client.get(BASE_URL, query_string="user_id=4&create_time_from=15")
+		self.assertEqual(resp.get_json(), [])
+
+		resp = self.client.get(BASE_URL, query_string="user_id=4&create_time_from=14&create_time_to=11")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_search_orders_with_combined_filters(self):
+		""" It should combine every filter of GET /orders into one query"""
+		orders = [
+			Order(user_id=8, create_time=create_time, status=status)
+			for create_time, status in ((10, 1), (11, 2), (12, 3), (13, 2), (14, 1))
+		]
+		for order in orders:
+			order.create()
+		Order(user_id=9, create_time=12, status=2).create()
+		for order, item_ids in zip(orders, ([1, 2], [1], [2], [1, 2, 3], [3])):
+			for item_id in item_ids:
+				Items(order_id=order.id, item_id=item_id).create()
+
+		def create_times(query_string):
+			resp = self.client.get(BASE_URL, query_string=query_string)
+			self.assertEqual(resp.status_code, status.HTTP_200_OK)
+			return [order["create_time"] for order in resp.get_json()]
+
+		self.assertEqual(create_times("user_id=8&status=2&status=3"), [11, 12, 13])
+		self.assertEqual(create_times("user_id=8&item_id=1&item_id=2"), [10, 11, 12, 13])
+		self.assertEqual(create_times("user_id=8&item_id=1&item_id=2&item_match=all"), [10, 13])
+		self.assertEqual(create_times("user_id=8&status=1&status=2&item_id=1&create_time_from=11"), [11, 13])
+		self.assertEqual(create_times("user_id=8&status=2&item_id=3&item_match=all"), [13])
+		self.assertEqual(create_times("user_id=8&create_time=12"), [12])
+		self.assertEqual(create_times("user_id=8&status=1&status=2&sort=-create_time"), [14, 13, 11, 10])
+
+		resp = self.client.get(BASE_URL, query_string="user_id=8&item_id=1&sort=-id&limit=2")
+		self.assertEqual([order["id"] for order in resp.get_json()], [orders[3].id, orders[1].id])
+		resp = self.client.get(BASE_URL, query_string={
+			"user_id": 8, "item_id": 1, "sort": "-id", "limit": 2, "cursor": resp.headers["X-Next-Cursor"]})
+		self.assertEqual([order["id"] for order in resp.get_json()], [orders[0].id])
+		self.assertNotIn("X-Next-Cursor", resp.headers)
+
+		# the Link of the next page keeps every value of the repeated filters
+		resp = self.client.get(BASE_URL, query_string="user_id=8&status=1&status=3&limit=2")
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [10, 12])
+		next_url = resp.headers["Link"].split(">")[0].lstrip("<")
+		self.assertIn("status=1&status=3", next_url)
+		resp = self.client.get(next_url)
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [14])
+		self.assertNotIn("Link", resp.headers)
+
+		db.session.remove()
+		resp, count = self._count_statements(lambda: self.client.get(
+			BASE_URL, query_string="user_id=8&status=1&status=2&item_id=1&item_id=2&item_match=all&create_time_to=14"))
+		self.assertEqual([order["create_time"] for order in resp.get_json()], [10, 13])
+		self.assertEqual(count, 1)
+
+		resp = self.client.get(BASE_URL, query_string="user_id=8&status=3&item_id=3")
+		self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+		resp = self.client.get(BASE_URL, query_string="user_id=8&status=1&status=4")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+		resp = self.client.get(BASE_URL, query_string="user_id=8&item_match=some")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+		resp = self.client.get(BASE_URL, query_string="user_id=8&sort=status")
+		self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
 	def test_route_health(self):
 		"""test route health"""
 		response = self.client.get("/health")
@@ -407,6 +933,87 @@ class TestYourResourceServer(TestCase):
 		self.assertEqual(response.status_code, status.HTTP_200_OK)
 		self.assertEqual(body["status"], "OK")
 
+	def test_create_app_without_database(self):
+		"""test the app factory does not connect to the database"""
+		other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:////nonexistent/orders.db"})
+		response = other.test_client().get("/health")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertIn("refresh-stats", other.cli.list_commands(None))
+		self.assertIn("create-db", other.cli.list_commands(None))
+
+	def test_request_id(self):
+		"""test the request id is returned, or generated when missing"""
+		response = self.client.get("/health", headers={"X-Request-ID": "abc123"})
+		self.assertEqual(response.headers["X-Request-ID"], "abc123")
+		response = self.client.get("/health")
+		self.assertRegex(response.headers["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+	def test_route_pool_health(self):
+		"""test the connection pool statistics are exposed"""
+		response = self.client.get("/health/pool")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		body = response.get_json()
+		for key in ["pool", "connects", "checkouts", "checkins", "timeouts", "wait_seconds_total", "wait_seconds_max"]:
+			self.assertIn(key, body)
+
+	def test_route_metrics(self):
+		"""test the Prometheus metrics are labeled by resource and status code"""
+		response = self.client.post(BASE_URL, json={"user_id": 1, "create_time": int(time()), "status": 1, "items": [1]})
+		self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+		self.client.get(f"{BASE_URL}/{response.get_json()['id']}")
+		self.client.get(f"{BASE_URL}/0")
+
+		response = self.client.get("/metrics")
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertTrue(response.content_type.startswith("text/plain"))
+		body = response.get_data(as_text=True)
+		self.assertIn('http_requests_total{method="POST",resource="OrderResource",status="201"}', body)
+		self.assertIn('resource="OrderSingleResource",status="200"', body)
+		self.assertIn('resource="OrderSingleResource",status="404"', body)
+		self.assertIn('http_request_duration_seconds_bucket{', body)
+		self.assertIn('db_statements_per_request_count{resource="OrderResource"}', body)
+		self.assertIn('db_statement_seconds_per_request_sum{resource="OrderSingleResource"}', body)
+		self.assertIn('db_pool_events{event="checkouts"}', body)
+		self.assertIn("order_cache_hit_ratio", body)
+
+	def test_route_metrics_count_streamed_statements(self):
+		"""test the SQL statements of a streamed export are observed once it closes"""
+		Order(user_id=1, create_time=int(time()), status=Status.CREATED).create()
+
+		def statements_sum():
+			body = self.client.get("/metrics").get_data(as_text=True)
+			for line in body.splitlines():
+				if line.startswith('db_statements_per_request_sum{resource="ExportOrderResource"}'):
+					return float(line.split()[-1])
+			return 0.0
+
+		before = statements_sum()
+		response = self.client.get(f"{BASE_URL}/export")
+		response.get_data()
+		response.close()
+		self.assertGreaterEqual(statements_sum() - before, 1)
+
+	def test_sql_profile(self):
+		"""test a request sending the API key is profiled"""
+		order = Order(user_id=1, create_time=int(time()), status=Status.CREATED)
+		order.create()
+		response = self.client.get(f"{BASE_URL}/{order.id}/items")
+		self.assertNotIn("Server-Timing", response.headers)
+		response = self.client.get(f"{BASE_URL}/{order.id}/items", headers={"X-SQL-Profile": "wrong key"})
+		self.assertNotIn("Server-Timing", response.headers)
+
+		app.config["SQL_SLOW_REQUEST_MS"] = 0
+		try:
+			with self.assertLogs(sql_logger(app), "WARNING") as logs:
+				response = self.client.get(
+					f"{BASE_URL}/{order.id}/items", headers={"X-SQL-Profile": app.config["API_KEY"]})
+		finally:
+			app.config["SQL_SLOW_REQUEST_MS"] = 500
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertRegex(response.headers["Server-Timing"], r'^db;dur=[0-9.]+;desc="1 statements", total;dur=[0-9.]+$')
+		self.assertIn(f"Slow request GET /orders/{order.id}/items 200", logs.output[0])
+		self.assertIn("FROM items", logs.output[0])
+
 	def test_request_validation_error(self):
 		"""test_request_validation_error"""
 		err_msg = "sample err message"